@@ -0,0 +1,185 @@
+"""
+Profile how expensive each dag file is to parse.
+
+Every file is parsed on its own, in a process forked from one that already
+imported airflow (like the scheduler's dag file processors), ``--repeat``
+times to show the variance. One extra parse runs under tracemalloc for the
+peak allocation and one under cProfile for the hotspots.
+
+    python -m benchmarks.dag_parse [--dags-folder DIR] [--repeat 5]
+        [--hotspots 10] [--output report.json]
+"""
+import argparse
+import cProfile
+import glob
+import json
+import multiprocessing
+import os
+import pstats
+import statistics
+import sys
+import time
+import tracemalloc
+
+
+def parse(dag_file):
+    from airflow.models import DagBag
+    dagbag = DagBag(dag_folder=dag_file, include_examples=False)
+    return {
+        'dags': len(dagbag.dags),
+        'tasks': sum(len(dag.tasks) for dag in dagbag.dags.values()),
+        'import_errors': dict(dagbag.import_errors),
+    }
+
+
+def timed_parse(dag_file):
+    start = time.perf_counter()
+    result = parse(dag_file)
+    result['wall'] = time.perf_counter() - start
+    return result
+
+
+def traced_parse(dag_file):
+    tracemalloc.start()
+    try:
+        parse(dag_file)
+        return {'peak_bytes': tracemalloc.get_traced_memory()[1]}
+    finally:
+        tracemalloc.stop()
+
+
+def profiled_parse(dag_file, hotspots=10):
+    profile = cProfile.Profile()
+    profile.runcall(parse, dag_file)
+    stats = pstats.Stats(profile)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2],
+                  reverse=True)[:hotspots]
+    return {'hotspots': [{
+        'function': '%s:%d(%s)' % function,
+        'calls': calls,
+        'tottime': tottime,
+        'cumtime': cumtime,
+    } for function, (_, calls, tottime, cumtime, _) in rows]}
+
+
+def _child(target, args, connection):
+    try:
+        connection.send(target(*args))
+    except BaseException as e:
+        # dag files may also sys.exit, report that like any other failure
+        connection.send({'error': repr(e)})
+    finally:
+        connection.close()
+
+
+def isolated(target, *args):
+    """
+    Run target in a forked process so every parse starts from the same state
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(target, args, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        # the child died before sending anything, i.e. os._exit or a crash
+        result = None
+    process.join()
+    if result is None:
+        return {'error': 'parse process exited with code %s' %
+                process.exitcode}
+    return result
+
+
+def profile_file(dag_file, repeat=5, hotspots=10):
+    runs = [isolated(timed_parse, dag_file) for _ in range(repeat)]
+    errors = [run['error'] for run in runs if 'error' in run]
+    if errors:
+        return {'file': dag_file, 'error': errors[0]}
+    walls = [run['wall'] for run in runs]
+    report = {
+        'file': dag_file,
+        'walls': walls,
+        'mean': statistics.mean(walls),
+        'stdev': statistics.stdev(walls) if len(walls) > 1 else 0.0,
+        'min': min(walls),
+        'max': max(walls),
+        'dags': runs[0]['dags'],
+        'tasks': runs[0]['tasks'],
+        'import_errors': runs[0]['import_errors'],
+    }
+    # a failed extra parse only loses its own figures, not the timings
+    for target, args, error_key in [
+            (traced_parse, (dag_file,), 'peak_error'),
+            (profiled_parse, (dag_file, hotspots), 'hotspots_error')]:
+        result = isolated(target, *args)
+        if 'error' in result:
+            report[error_key] = result['error']
+        else:
+            report.update(result)
+    return report
+
+
+def dag_files(dags_folder):
+    return sorted(glob.glob(os.path.join(dags_folder, '**', '*.py'),
+                            recursive=True))
+
+
+def profile_folder(dags_folder, repeat=5, hotspots=10):
+    # warm the parent so children only pay for the dag file itself
+    import airflow  # noqa
+    return {
+        'dags_folder': dags_folder,
+        'repeat': repeat,
+        'python': sys.version,
+        'files': [profile_file(dag_file, repeat, hotspots)
+                  for dag_file in dag_files(dags_folder)],
+    }
+
+
+def print_summary(report, out=sys.stderr):
+    row = '{:<50} {:>5} {:>10} {:>10} {:>12}'
+    print(row.format('file', 'tasks', 'mean_ms', 'stdev_ms', 'peak_kb'),
+          file=out)
+    for entry in sorted(report['files'], key=lambda e: -e.get('mean', 0)):
+        if 'error' in entry:
+            print('%s failed: %s' % (entry['file'], entry['error']), file=out)
+            continue
+        print(row.format(os.path.relpath(entry['file'], report['dags_folder']),
+                         entry['tasks'], '%.1f' % (entry['mean'] * 1000),
+                         '%.1f' % (entry['stdev'] * 1000),
+                         entry['peak_bytes'] // 1024 if 'peak_bytes' in entry
+                         else 'n/a'), file=out)
+        if 'peak_error' in entry:
+            print('    tracing failed: %s' % entry['peak_error'], file=out)
+        if 'hotspots_error' in entry:
+            print('    profiling failed: %s' % entry['hotspots_error'],
+                  file=out)
+        elif entry['hotspots']:
+            print('    hotspot: %s' % entry['hotspots'][0]['function'],
+                  file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--dags-folder')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--hotspots', type=int, default=10)
+    parser.add_argument('--output', help='write the json report here '
+                        'instead of stdout')
+    args = parser.parse_args()
+
+    if args.dags_folder is None:
+        from airflow import settings
+        args.dags_folder = settings.DAGS_FOLDER
+
+    report = profile_folder(args.dags_folder, args.repeat, args.hotspots)
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
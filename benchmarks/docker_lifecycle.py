@@ -0,0 +1,285 @@
+"""
+Measure what the docker operators add on top of the docker daemon, against
+the fake daemon from benchmarks/fake_docker.py (served from its own
+process):
+
+    - phases: ``--runs`` sequential executions in one process, per phase
+      time and the overhead left once the daemon latencies are taken out.
+      The first execution (which imports the docker client) is reported on
+      its own.
+    - throughput: executions per second with ``--concurrency`` forked
+      processes, like as many celery worker slots, running at once
+    - memory: resident memory of one process over ``--runs`` executions
+
+Plugin state (reaper spool, admission ledger, offloaded xcom) goes to a
+temporary directory, removed once done and the reaper stopped.
+
+    python -m benchmarks.docker_lifecycle [--runs 1000]
+        [--concurrency 1 4 16] [--operator removable] [--log-lines 10]
+        [--admission-control]
+        [--pull 0] [--create 0] [--start 0] [--log-line 0] [--run 0]
+        [--stop 0] [--remove 0] [--output report.json]
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.dag_parse import isolated
+
+IMAGE = 'alpine:latest'
+PLUGIN_DIRS = {
+    'AIR_TASKS_REAPER_DIR': 'reaper',
+    'AIR_TASKS_ADMISSION_LEDGER': 'admission.json',
+    'AIR_TASKS_XCOM_DIR': 'xcom',
+    'AIR_TASKS_CACHE_ROOT': 'cache',
+}
+PHASE_LATENCIES = {
+    'pull': ['pull'],
+    'create': ['create'],
+    'start': ['start'],
+    'run': ['run'],
+    'remove': ['stop', 'remove'],
+}
+
+
+def make_operator(operator, docker_url, index, xcom_all, sync_remove,
+                  force_pull, admission_control):
+    from airflow.operators.docker_plugin import DockerConfigurableOperator, \
+        DockerRemovableContainer
+    kwargs = {
+        'task_id': 'benchmark_%d' % index,
+        'image': IMAGE,
+        'command': 'true',
+        'docker_url': docker_url,
+        'start_date': datetime(2017, 5, 1),
+        'xcom_push': True,
+        'xcom_all': xcom_all,
+        'force_pull': force_pull,
+        'admission_control': admission_control,
+    }
+    if operator == 'configurable':
+        return DockerConfigurableOperator(**kwargs)
+    return DockerRemovableContainer(reap_async=not sync_remove, **kwargs)
+
+
+def execute(settings, index):
+    task = make_operator(settings['operator'], settings['docker_url'], index,
+                         settings['xcom_all'], settings['sync_remove'],
+                         settings['force_pull'], settings['admission_control'])
+    start = time.perf_counter()
+    task.execute(None)
+    wall = time.perf_counter() - start
+    return wall, dict(task.timer.phases)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(values):
+    return {
+        'mean_ms': statistics.mean(values) * 1000,
+        'p50_ms': percentile(values, 0.5) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'max_ms': max(values) * 1000,
+    }
+
+
+def expected_latency(settings):
+    """
+    Seconds of every execution the fake daemon spends on purpose
+    """
+    latencies = settings['latencies']
+    expected = sum(latencies.get(name, 0)
+                   for names in PHASE_LATENCIES.values() for name in names
+                   if name != 'pull' or settings['force_pull'])
+    return expected + latencies.get('log_line', 0) * settings['log_lines']
+
+
+def phases(settings, runs):
+    first_wall, first_phases = execute(settings, 0)
+    walls = []
+    by_phase = {}
+    for index in range(1, runs + 1):
+        wall, timed = execute(settings, index)
+        walls.append(wall)
+        for phase, seconds in timed.items():
+            by_phase.setdefault(phase, []).append(seconds)
+    report = summarize(walls)
+    report['overhead_ms'] = (statistics.mean(walls) -
+                             expected_latency(settings)) * 1000
+    report['first_run'] = {'wall_ms': first_wall * 1000,
+                           'phases_ms': dict((phase, seconds * 1000)
+                                             for phase, seconds
+                                             in first_phases.items())}
+    report['phases'] = dict((phase, summarize(values))
+                            for phase, values in by_phase.items())
+    return report
+
+
+def _run_slot(settings, runs, offset):
+    for index in range(runs):
+        execute(settings, offset + index)
+    return runs
+
+
+def throughput(settings, runs, concurrency):
+    import multiprocessing
+    # warm up the parent so forked slots do not each import the client
+    execute(settings, 0)
+    context = multiprocessing.get_context('fork')
+    per_slot = max(runs // concurrency, 1)
+    start = time.perf_counter()
+    with context.Pool(concurrency) as pool:
+        done = sum(pool.starmap(
+            _run_slot, [(settings, per_slot, slot * per_slot)
+                        for slot in range(concurrency)]))
+    wall = time.perf_counter() - start
+    return {'concurrency': concurrency, 'executions': done, 'wall': wall,
+            'per_second': done / wall}
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory(settings, runs, points=10):
+    execute(settings, 0)
+    gc.collect()
+    samples = [{'executions': 0, 'rss_bytes': rss_bytes(),
+                'objects': len(gc.get_objects())}]
+    every = max(runs // points, 1)
+    for index in range(1, runs + 1):
+        execute(settings, index)
+        if index % every == 0 or index == runs:
+            gc.collect()
+            samples.append({'executions': index, 'rss_bytes': rss_bytes(),
+                            'objects': len(gc.get_objects())})
+    growth = samples[-1]['rss_bytes'] - samples[0]['rss_bytes']
+    return {'samples': samples, 'rss_growth_bytes': growth,
+            'rss_growth_per_1000': growth * 1000.0 / runs}
+
+
+def run(runs=1000, concurrency=(1, 4, 16), operator='removable',
+        log_lines=10, xcom_all=True, sync_remove=False, force_pull=False,
+        admission_control=False, ncpu=64, **latencies):
+    work_dir = tempfile.mkdtemp(prefix='docker-lifecycle-')
+    for variable, name in PLUGIN_DIRS.items():
+        os.environ[variable] = os.path.join(work_dir, name)
+    # only now, the plugins read their directories when they are imported
+    import airflow  # noqa
+    from benchmarks.fake_docker import FakeDockerProcess
+    from custom import reaper
+
+    daemon = FakeDockerProcess(
+        os.path.join(work_dir, 'docker.sock'), log_lines=log_lines,
+        ncpu=ncpu, images=[] if force_pull else [IMAGE], **latencies)
+    settings = {
+        'operator': operator,
+        'docker_url': daemon.url,
+        'xcom_all': xcom_all,
+        'sync_remove': sync_remove,
+        'force_pull': force_pull,
+        'admission_control': admission_control,
+        'log_lines': log_lines,
+        'latencies': latencies,
+    }
+    try:
+        with daemon:
+            return {
+                'settings': settings,
+                'python': sys.version,
+                'phases': isolated(phases, settings, runs),
+                'throughput': [isolated(throughput, settings, runs, slots)
+                               for slots in concurrency],
+                'memory': isolated(memory, settings, runs),
+            }
+    finally:
+        reaper.stop(os.environ['AIR_TASKS_REAPER_DIR'])
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_summary(report, out=sys.stderr):
+    phases_report = report['phases']
+    if 'error' in phases_report:
+        print('phases failed: %s' % phases_report['error'], file=out)
+    else:
+        print('first execution %.1fms, then mean %.1fms p95 %.1fms, '
+              '%.1fms over the daemon latencies' % (
+                  phases_report['first_run']['wall_ms'],
+                  phases_report['mean_ms'], phases_report['p95_ms'],
+                  phases_report['overhead_ms']), file=out)
+        row = '{:<12} {:>10} {:>10} {:>10}'
+        print(row.format('phase', 'mean_ms', 'p50_ms', 'p95_ms'), file=out)
+        for phase, stats in sorted(phases_report['phases'].items(),
+                                   key=lambda item: -item[1]['mean_ms']):
+            print(row.format(phase, '%.2f' % stats['mean_ms'],
+                             '%.2f' % stats['p50_ms'],
+                             '%.2f' % stats['p95_ms']), file=out)
+    for entry in report['throughput']:
+        if 'error' in entry:
+            print('throughput failed: %s' % entry['error'], file=out)
+            continue
+        print('concurrency %3d: %8.1f executions/s' % (
+            entry['concurrency'], entry['per_second']), file=out)
+    if 'error' in report['memory']:
+        print('memory failed: %s' % report['memory']['error'], file=out)
+    else:
+        print('rss growth: %d KB per 1000 executions' % (
+            report['memory']['rss_growth_per_1000'] // 1024), file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('--operator', choices=['configurable', 'removable'],
+                        default='removable')
+    parser.add_argument('--log-lines', type=int, default=10)
+    parser.add_argument('--no-xcom-all', dest='xcom_all',
+                        action='store_false',
+                        help='push the last log line instead of all logs')
+    parser.add_argument('--sync-remove', action='store_true',
+                        help='remove containers before execute returns '
+                        'instead of handing them to the reaper')
+    parser.add_argument('--force-pull', action='store_true')
+    parser.add_argument('--admission-control', action='store_true',
+                        help='admit containers against the host capacity')
+    parser.add_argument('--ncpu', type=int, default=64,
+                        help='cpus the fake daemon reports to admission '
+                        'control')
+    for latency in ['pull', 'create', 'start', 'log-line', 'run', 'stop',
+                    'remove']:
+        parser.add_argument('--' + latency, type=float, default=0,
+                            help='seconds of fake daemon latency')
+    parser.add_argument('--output', help='write the json report here '
+                        'instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args.runs, args.concurrency, args.operator, args.log_lines,
+                 args.xcom_all, args.sync_remove, args.force_pull,
+                 args.admission_control, args.ncpu,
+                 pull=args.pull, create=args.create, start=args.start,
+                 log_line=args.log_line, run=args.run, stop=args.stop,
+                 remove=args.remove)
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
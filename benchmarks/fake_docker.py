@@ -0,0 +1,455 @@
+"""
+A fake docker daemon speaking the parts of the Engine API the docker
+operators use, over a unix socket, with configurable latencies. Containers
+do not run anything: they print ``log_lines`` lines and exit with
+``exit_code`` ``run`` seconds after they were started.
+
+    with FakeDockerDaemon(socket_path, pull=0.5, create=0.05) as daemon:
+        operator = DockerRemovableContainer(docker_url=daemon.url, ...)
+
+``FakeDockerDaemon`` serves from a thread of the calling process,
+``FakeDockerProcess`` from a separate process so it does not compete for
+the GIL with what is being measured.
+"""
+import binascii
+import json
+import multiprocessing
+import os
+import re
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+API_VERSION = '1.35'
+VERSION_PREFIX = re.compile(r'^/v[0-9.]+')
+STDOUT = 1
+
+# latency names and the calls they slow down
+LATENCIES = {
+    'pull': 'POST /images/create, spread over the progress messages',
+    'create': 'POST /containers/create',
+    'start': 'POST /containers/{id}/start',
+    'log_line': 'every line streamed by GET /containers/{id}/logs',
+    'run': 'seconds a container runs before it exits',
+    'stop': 'POST /containers/{id}/stop',
+    'remove': 'DELETE /containers/{id}',
+}
+
+
+def _new_id():
+    return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+
+def _image_name(image):
+    return image if ':' in image.rsplit('/', 1)[-1] else image + ':latest'
+
+
+def _filters(query):
+    filters = query.get('filters')
+    if not filters:
+        return {}
+    filters = json.loads(filters[0])
+    # sent as {"label": ["a"]}, or {"label": {"a": true}} by old clients
+    return dict((key, list(value)) for key, value in filters.items())
+
+
+class DaemonState(object):
+    def __init__(self, latencies, log_lines, exit_code, ncpu, mem_total,
+                 images):
+        self.latencies = latencies
+        self.log_lines = log_lines
+        self.exit_code = exit_code
+        self.ncpu = ncpu
+        self.mem_total = mem_total
+        self.images = set(_image_name(image) for image in images)
+        self.containers = {}
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def sleep(self, name, fraction=1):
+        seconds = self.latencies.get(name, 0) * fraction
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+    def status(self, container):
+        started = container['started']
+        if started is None:
+            return 'created'
+        if container['removed_from_run'] or \
+                time.time() >= started + self.latencies.get('run', 0):
+            return 'exited'
+        return 'running'
+
+    def inspect(self, container):
+        status = self.status(container)
+        return {
+            'Id': container['Id'],
+            'Image': container['Image'],
+            'Config': {'Tty': False, 'Image': container['Image'],
+                       'Cmd': container['Cmd'],
+                       'Labels': container['Labels']},
+            'State': {'Status': status, 'Running': status == 'running',
+                      'ExitCode': self.exit_code if status == 'exited' else 0,
+                      'FinishedAt': '0001-01-01T00:00:00Z'},
+        }
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status=204):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def not_found(self, message):
+        self.send_json({'message': message}, status=404)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def route(self, method):
+        url = urlparse(self.path)
+        path = VERSION_PREFIX.sub('', url.path)
+        self.query = parse_qs(url.query)
+        self.body = self.read_json() if method == 'POST' else {}
+        parts = path.strip('/').split('/')
+        self.state.count('%s /%s' % (method, '/'.join(
+            '{id}' if index == 1 and parts[0] == 'containers' and
+            part != 'json' and part != 'create' else part
+            for index, part in enumerate(parts))))
+
+        if parts[0] == 'containers' and len(parts) >= 2 and \
+                parts[1] not in ('json', 'create'):
+            container = self.state.containers.get(parts[1])
+            if container is None:
+                return self.not_found('No such container: %s' % parts[1])
+            action = parts[2] if len(parts) > 2 else None
+            handler = getattr(self, 'container_%s_%s' % (
+                method.lower(), action or 'self'), None)
+            if handler is None:
+                return self.not_found('page not found')
+            return handler(container)
+
+        handler = getattr(self, '%s_%s' % (method.lower(), '_'.join(parts)),
+                          None)
+        if handler is None:
+            return self.not_found('page not found')
+        return handler()
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+    def get__ping(self):
+        body = b'OK'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_version(self):
+        self.send_json({'ApiVersion': API_VERSION, 'Version': 'fake',
+                        'MinAPIVersion': '1.12', 'Os': 'linux'})
+
+    def get_info(self):
+        self.send_json({'NCPU': self.state.ncpu,
+                        'MemTotal': self.state.mem_total,
+                        'Containers': len(self.state.containers)})
+
+    def get_images_json(self):
+        references = _filters(self.query).get('reference') or []
+        references.extend(self.query.get('filter') or [])
+        images = sorted(image for image in self.state.images
+                        if not references or
+                        image in map(_image_name, references))
+        self.send_json([{'Id': 'sha256:' + _new_id(), 'RepoTags': [image]}
+                        for image in images])
+
+    def post_images_create(self):
+        image = self.query['fromImage'][0]
+        tag = (self.query.get('tag') or ['latest'])[0]
+        layer = _new_id()[:12]
+        messages = [{'status': 'Pulling from %s' % image, 'id': tag}]
+        messages.extend({'status': 'Downloading', 'id': layer,
+                         'progressDetail': {'current': current,
+                                            'total': 4096},
+                         'progress': '[>   ]'}
+                        for current in (1024, 2048, 3072, 4096))
+        messages.append({'status': 'Download complete', 'id': layer,
+                         'progressDetail': {}})
+        messages.append({'status': 'Status: Downloaded newer image for '
+                                   '%s:%s' % (image, tag)})
+        self.start_chunked('application/json')
+        for message in messages:
+            self.state.sleep('pull', 1.0 / len(messages))
+            self.write_chunk(json.dumps(message).encode('utf-8') + b'\r\n')
+        self.end_chunked()
+        with self.state.lock:
+            self.state.images.add('%s:%s' % (image, tag))
+
+    def post_containers_create(self):
+        image = _image_name(self.body.get('Image', ''))
+        if image not in self.state.images:
+            return self.not_found('No such image: %s' % image)
+        self.state.sleep('create')
+        container = {
+            'Id': _new_id(),
+            'Image': image,
+            'Cmd': self.body.get('Cmd'),
+            'Labels': self.body.get('Labels') or {},
+            'started': None,
+            'removed_from_run': False,
+        }
+        with self.state.lock:
+            self.state.containers[container['Id']] = container
+        self.send_json({'Id': container['Id'], 'Warnings': None}, status=201)
+
+    def get_containers_json(self):
+        filters = _filters(self.query)
+        show_all = (self.query.get('all') or ['0'])[0] in ('1', 'True',
+                                                           'true')
+        listed = []
+        for container in list(self.state.containers.values()):
+            status = self.state.status(container)
+            if not show_all and status != 'running':
+                continue
+            if filters.get('status') and status not in filters['status']:
+                continue
+            if any(label.partition('=')[0] not in container['Labels'] or
+                   ('=' in label and container['Labels'][
+                       label.partition('=')[0]] != label.partition('=')[2])
+                   for label in filters.get('label') or []):
+                continue
+            listed.append({'Id': container['Id'], 'Image': container['Image'],
+                           'Labels': container['Labels'], 'State': status})
+        self.send_json(listed)
+
+    def container_get_json(self, container):
+        self.send_json(self.state.inspect(container))
+
+    def container_post_start(self, container):
+        self.state.sleep('start')
+        container['started'] = time.time()
+        self.send_empty()
+
+    def container_get_logs(self, container):
+        follow = (self.query.get('follow') or ['0'])[0] in ('1', 'True',
+                                                            'true')
+        self.start_chunked('application/vnd.docker.raw-stream')
+        for index in range(self.state.log_lines):
+            if follow:
+                self.state.sleep('log_line')
+            line = ('log line %d\n' % index).encode('utf-8')
+            self.write_chunk(struct.pack('>BxxxL', STDOUT, len(line)) + line)
+        if follow:
+            self.wait_for_exit(container)
+        self.end_chunked()
+
+    def wait_for_exit(self, container):
+        if container['started'] is None:
+            return
+        remaining = (container['started'] + self.state.latencies.get('run', 0)
+                     - time.time())
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def container_post_wait(self, container):
+        self.wait_for_exit(container)
+        self.send_json({'StatusCode': self.state.exit_code, 'Error': None})
+
+    def container_get_stats(self, container):
+        self.send_json({
+            'read': '2017-05-01T00:00:00Z',
+            'memory_stats': {'usage': 8 * 1024 * 1024,
+                             'stats': {'rss': 4 * 1024 * 1024}},
+            'cpu_stats': {'cpu_usage': {'total_usage': int(time.time() * 1e9)
+                                        % 10 ** 12}},
+            'blkio_stats': {'io_service_bytes_recursive': []},
+            'networks': {},
+        })
+
+    def container_post_stop(self, container):
+        self.state.sleep('stop')
+        container['removed_from_run'] = True
+        self.send_empty()
+
+    def container_post_kill(self, container):
+        container['removed_from_run'] = True
+        self.send_empty()
+
+    def container_delete_self(self, container):
+        self.state.sleep('remove')
+        with self.state.lock:
+            self.state.containers.pop(container['Id'], None)
+        self.send_empty()
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+    # the default backlog of 5 refuses connections from concurrent tasks
+    request_queue_size = 128
+
+    def __init__(self, socket_path, state):
+        self.state = state
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               FakeDockerHandler)
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects an (address, port) client address
+        return request, ('fake-docker', 0)
+
+
+class FakeDockerDaemon(object):
+    """
+    :param socket_path: unix socket to listen on
+    :type socket_path: str
+    :param log_lines: lines every container prints
+    :type log_lines: int
+    :param exit_code: exit code of every container
+    :type exit_code: int
+    :param images: images present before anything is pulled
+    :type images: list of str
+    :param latencies: seconds per call, see ``LATENCIES``
+    :type latencies: float
+    """
+    def __init__(self, socket_path, log_lines=10, exit_code=0, ncpu=4,
+                 mem_total=16 * 1024 * 1024 * 1024, images=(), **latencies):
+        unknown = set(latencies) - set(LATENCIES)
+        if unknown:
+            raise TypeError('Unknown latencies %s' %
+                            ', '.join(sorted(unknown)))
+        self.socket_path = socket_path
+        self.state = DaemonState(latencies, log_lines, exit_code, ncpu,
+                                 mem_total, images)
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'unix://' + os.path.abspath(self.socket_path)
+
+    @property
+    def containers(self):
+        return self.state.containers
+
+    @property
+    def calls(self):
+        return self.state.calls
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = FakeDockerServer(self.socket_path, self.state)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='fake-docker')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _serve(started, socket_path, kwargs):
+    daemon = FakeDockerDaemon(socket_path, **kwargs).start()
+    started.set()
+    daemon.thread.join()
+
+
+class FakeDockerProcess(object):
+    """
+    Same as FakeDockerDaemon, served from a child process
+    """
+    def __init__(self, socket_path, **kwargs):
+        self.socket_path = socket_path
+        self.kwargs = kwargs
+        self.process = None
+
+    @property
+    def url(self):
+        return 'unix://' + os.path.abspath(self.socket_path)
+
+    def start(self, timeout=10):
+        context = multiprocessing.get_context('fork')
+        started = context.Event()
+        self.process = context.Process(
+            target=_serve, args=(started, self.socket_path, self.kwargs))
+        self.process.daemon = True
+        self.process.start()
+        if not started.wait(timeout):
+            self.stop()
+            raise RuntimeError('Fake docker daemon did not start')
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,124 @@
+"""
+Measure the celery serialization profiles on representative airflow
+payloads: encode and decode time per message, body size and the bytes a
+fan-out of ``--messages`` messages puts on the broker.
+
+Profiles whose packages are missing are reported as unavailable.
+
+    python -m benchmarks.serialization [--messages 100000]
+        [--threshold 1024] [--output report.json]
+"""
+import argparse
+import json
+import sys
+import timeit
+import uuid
+
+PROFILES = ['json', 'msgpack', 'pickle', 'pickle-zlib', 'pickle-lz4']
+COMMAND = ('airflow run example_interleaved print_hello_3 '
+           '2017-05-01T00:00:00 --local '
+           '-sd /usr/local/airflow/dags/examples/interleaved.py')
+EMBED = {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}
+
+
+def payloads():
+    """
+    Bodies as celery builds them (task protocol 2 and result meta)
+    """
+    task_id = str(uuid.uuid4())
+    return {
+        # what airflow's celery executor sends for every task instance
+        'execute_command': [[COMMAND], {}, EMBED],
+        'result_success': {'task_id': task_id, 'status': 'SUCCESS',
+                           'result': None, 'traceback': None,
+                           'children': []},
+        'result_failure': {'task_id': task_id, 'status': 'FAILURE',
+                           'result': {'exc_type': 'AirflowException',
+                                      'exc_message': 'Celery command failed'},
+                           'traceback': ''.join(
+                               '  File "/usr/local/lib/python3.6/site-'
+                               'packages/airflow/models.py", line %d, in '
+                               'run\n    result = task_copy.execute('
+                               'context=context)\n' % line
+                               for line in range(1400, 1440)),
+                           'children': []},
+        # a task carrying its own parameters, like a multi trigger chunk
+        'params_chunk': [[COMMAND], {'params': [
+            {'chunk': [x, y, z], 'bbox': [x * 512, y * 512, z * 64,
+                                          (x + 1) * 512, (y + 1) * 512,
+                                          (z + 1) * 64]}
+            for x in range(8) for y in range(8) for z in range(4)]}, EMBED],
+    }
+
+
+def measure(profile, payload, number=200):
+    from kombu.serialization import dumps, loads
+    content_type, encoding, body = dumps(payload, serializer=profile)
+    encode = min(timeit.repeat(
+        lambda: dumps(payload, serializer=profile),
+        number=number, repeat=3)) / number
+    decode = min(timeit.repeat(
+        lambda: loads(body, content_type, encoding, accept=[content_type]),
+        number=number, repeat=3)) / number
+    return {
+        'content_type': content_type,
+        'bytes': len(body),
+        'encode_us': encode * 1e6,
+        'decode_us': decode * 1e6,
+    }
+
+
+def run(messages, threshold):
+    import airflow  # noqa puts the config folder on the path
+    from airflow.exceptions import AirflowConfigException
+    from celery_serialization import register
+
+    report = {'python': sys.version, 'messages': messages,
+              'threshold': threshold, 'results': []}
+    for profile in PROFILES:
+        try:
+            register(profile, threshold)
+        except AirflowConfigException as e:
+            report['results'].append({'profile': profile,
+                                      'unavailable': str(e)})
+            continue
+        for name, payload in sorted(payloads().items()):
+            result = measure(profile, payload)
+            result.update({'profile': profile, 'payload': name,
+                           'broker_bytes': result['bytes'] * messages})
+            report['results'].append(result)
+    return report
+
+
+def print_summary(report, out=sys.stderr):
+    row = '{:<12} {:<16} {:>8} {:>10} {:>10} {:>12}'
+    print(row.format('profile', 'payload', 'bytes', 'encode_us', 'decode_us',
+                     'broker_mb'), file=out)
+    for result in report['results']:
+        if 'unavailable' in result:
+            print('%-12s %s' % (result['profile'], result['unavailable']),
+                  file=out)
+            continue
+        print(row.format(result['profile'], result['payload'],
+                         result['bytes'], '%.1f' % result['encode_us'],
+                         '%.1f' % result['decode_us'],
+                         '%.1f' % (result['broker_bytes'] / 1024 / 1024)),
+              file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--threshold', type=int, default=1024)
+    parser.add_argument('--output', help='write the json report here '
+                        'instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args.messages, args.threshold)
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
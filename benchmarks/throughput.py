@@ -0,0 +1,436 @@
+"""
+Measure end to end throughput of the example dags on one box.
+
+A scheduler and ``--workers`` celery workers run as subprocesses, like in the
+compose stack, from a temporary AIRFLOW_HOME built from config/airflow.cfg.
+The metadata database is a throwaway PostgreSQL cluster (or
+``--sql-alchemy-conn``), which also stands in for rabbitmq through the kombu
+sqlalchemy transport, so nothing has to be deployed. The harness then
+triggers ``--fanouts`` runs of example_multi_trigger_scheduler (each fanning
+out example_multi_trigger_target runs) and ``--interleaved`` runs of
+example_interleaved, waits for every run to finish and reports:
+
+    - tasks_per_second: finished task instances over the time from
+      triggering to the last task ending
+    - queued_to_running: how long task instances waited in the broker and
+      for a worker slot, and scheduled_to_queued: how long after their dag
+      run started the scheduler queued them
+    - queries: statements sent to the metadata database per process role
+      (scheduler, worker, run), counted by a sitecustomize hook
+
+Change airflow.cfg or the plugins, or override single options with ``--set
+scheduler.max_threads=2``, and compare the reports.
+
+    python -m benchmarks.throughput [--fanouts 1] [--interleaved 10]
+        [--workers 2] [--concurrency 4] [--timeout 600]
+        [--sql-alchemy-conn URL] [--set section.option=value]
+        [--output report.json]
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.docker_lifecycle import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAG_FILES = ['dags/examples/multi_trigger.py', 'dags/examples/interleaved.py']
+FANOUT_DAG_ID = 'example_multi_trigger_scheduler'
+INTERLEAVED_DAG_ID = 'example_interleaved'
+PG_PORT = 5432
+
+# Put first on the PYTHONPATH of every airflow process. Counts the
+# statements sent through any sqlalchemy engine and dumps them, at most
+# every second and at exit, to <QUERIES_DIR>/<pid>.json
+SITECUSTOMIZE = '''
+import atexit
+import json
+import multiprocessing.util
+import os
+import sys
+import time
+
+QUERIES_DIR = %(queries_dir)r
+ROLE = (sys.argv[1] if len(sys.argv) > 1 and
+        os.path.basename(sys.argv[0]) == 'airflow'
+        else os.path.basename(sys.argv[0] or 'python'))
+counts = {}
+last_dump = [0]
+
+
+def dump():
+    if counts:
+        path = os.path.join(QUERIES_DIR, '%%d.json' %% os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'role': ROLE, 'statements': counts}, f)
+        os.rename(path + '.tmp', path)
+
+
+def count(conn, cursor, statement, parameters, context, executemany):
+    verb = (statement.split(None, 1) or [''])[0].upper()
+    counts[verb] = counts.get(verb, 0) + 1
+    if time.time() - last_dump[0] > 1:
+        last_dump[0] = time.time()
+        dump()
+
+
+def after_fork(counts):
+    # the scheduler's dag file processors count on their own
+    counts.clear()
+    multiprocessing.util.Finalize(None, dump, exitpriority=0)
+
+
+try:
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+except ImportError:
+    pass
+else:
+    event.listen(Engine, 'before_cursor_execute', count)
+    atexit.register(dump)
+    multiprocessing.util.register_after_fork(counts, after_fork)
+'''
+
+
+def find_postgres_bin():
+    for candidate in [os.path.dirname(shutil.which('initdb') or '')] + \
+            sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True):
+        if candidate and os.path.exists(os.path.join(candidate, 'pg_ctl')):
+            return candidate
+    return None
+
+
+class Postgres(object):
+    """
+    A PostgreSQL cluster in ``directory``, only listening on a unix socket
+    there
+    """
+    def __init__(self, directory, bin_dir):
+        self.directory = directory
+        self.bin_dir = bin_dir
+        self.data = os.path.join(directory, 'pgdata')
+
+    @property
+    def url(self):
+        return 'postgresql+psycopg2://airflow@/postgres?host=%s&port=%d' % (
+            self.directory, PG_PORT)
+
+    def pg(self, command, *args):
+        subprocess.check_call(
+            [os.path.join(self.bin_dir, command)] + list(args),
+            stdout=subprocess.DEVNULL)
+
+    def __enter__(self):
+        self.pg('initdb', '-D', self.data, '-U', 'airflow', '--auth=trust')
+        self.pg('pg_ctl', '-D', self.data, '-w', '-l',
+                os.path.join(self.directory, 'postgres.log'), '-o',
+                "-k %s -p %d -c listen_addresses='' -c max_connections=500"
+                % (self.directory, PG_PORT), 'start')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pg('pg_ctl', '-D', self.data, '-w', '-m', 'immediate', 'stop')
+
+
+def airflow_env(work_dir, sql_alchemy_conn, overrides):
+    env = dict(os.environ)
+    env.update({
+        'AIRFLOW_HOME': work_dir,
+        'PYTHONPATH': os.pathsep.join(
+            [os.path.join(work_dir, 'site'), ROOT,
+             os.path.join(ROOT, 'config')] +
+            [path for path in [os.environ.get('PYTHONPATH')] if path]),
+        'AIRFLOW__CORE__DAGS_FOLDER': os.path.join(work_dir, 'dags'),
+        'AIRFLOW__CORE__PLUGINS_FOLDER': os.path.join(ROOT, 'plugins'),
+        'AIRFLOW__CORE__BASE_LOG_FOLDER': os.path.join(work_dir, 'logs'),
+        'AIRFLOW__CORE__SQL_ALCHEMY_CONN': sql_alchemy_conn,
+        'AIRFLOW__CORE__EXECUTOR': 'CeleryExecutor',
+        'AIRFLOW__CORE__LOAD_EXAMPLES': 'False',
+        'AIRFLOW__CORE__DAGS_ARE_PAUSED_AT_CREATION': 'False',
+        'AIRFLOW__CELERY__BROKER_URL': 'sqla+' + sql_alchemy_conn,
+        'AIRFLOW__CELERY__CELERY_RESULT_BACKEND': 'db+' + sql_alchemy_conn,
+        'AIRFLOW__SCHEDULER__CHILD_PROCESS_LOG_DIRECTORY': os.path.join(
+            work_dir, 'logs', 'scheduler'),
+        # plugin state of the docker operators
+        'AIR_TASKS_REAPER_DIR': os.path.join(work_dir, 'reaper'),
+        'AIR_TASKS_ADMISSION_LEDGER': os.path.join(work_dir,
+                                                   'admission.json'),
+        'AIR_TASKS_XCOM_DIR': os.path.join(work_dir, 'xcom'),
+    })
+    for override in overrides:
+        option, _, value = override.partition('=')
+        section, _, key = option.partition('.')
+        env['AIRFLOW__%s__%s' % (section.upper(), key.upper())] = value
+    return env
+
+
+def prepare(work_dir):
+    shutil.copy(os.path.join(ROOT, 'config', 'airflow.cfg'),
+                os.path.join(work_dir, 'airflow.cfg'))
+    for name in ['dags', 'logs', 'queries', 'site']:
+        os.makedirs(os.path.join(work_dir, name))
+    for dag_file in DAG_FILES:
+        os.symlink(os.path.join(ROOT, dag_file),
+                   os.path.join(work_dir, 'dags', os.path.basename(dag_file)))
+    with open(os.path.join(work_dir, 'site', 'sitecustomize.py'), 'w') as f:
+        f.write(SITECUSTOMIZE % {
+            'queries_dir': os.path.join(work_dir, 'queries')})
+
+
+def start(args, env, log_path):
+    with open(log_path, 'w') as log:
+        # own process group, so stopping it also stops its task processes
+        return subprocess.Popen(['airflow'] + args, env=env, stdout=log,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+
+
+def stop(processes, timeout=30):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + timeout
+    for process in processes:
+        try:
+            process.wait(max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def trigger(fanouts, interleaved):
+    """
+    :return: the time the first run was created
+    """
+    from airflow import settings
+    from airflow.models import DagBag
+    from airflow.utils.state import State
+    dagbag = DagBag(settings.DAGS_FOLDER)
+    session = settings.Session()
+    started = datetime.now()
+    for dag_id, runs in [(FANOUT_DAG_ID, fanouts),
+                         (INTERLEAVED_DAG_ID, interleaved)]:
+        for index in range(runs):
+            session.add(dagbag.get_dag(dag_id).create_dagrun(
+                run_id='benchmark_%d' % index,
+                execution_date=started + timedelta(seconds=index),
+                state=State.RUNNING,
+                external_trigger=True))
+    session.commit()
+    session.close()
+    return started
+
+
+def running_dag_runs():
+    from airflow import settings
+    from airflow.models import DagRun
+    from airflow.utils.state import State
+    session = settings.Session()
+    try:
+        return session.query(DagRun).filter(
+            DagRun.state == State.RUNNING).count()
+    finally:
+        session.close()
+
+
+def wait(processes, timeout, poll_interval=1):
+    """
+    :return: whether every dag run finished within timeout
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError('%s exited with %s, see the logs' % (
+                    ' '.join(process.args), process.returncode))
+        if not running_dag_runs():
+            return True
+        time.sleep(poll_interval)
+    return False
+
+
+def _seconds(later, earlier):
+    return (later - earlier).total_seconds()
+
+
+def task_report(started):
+    from airflow import settings
+    from airflow.models import DagRun, TaskInstance
+    from airflow.utils.state import State
+    session = settings.Session()
+    try:
+        task_instances = session.query(TaskInstance).all()
+        dag_runs = session.query(DagRun).all()
+    finally:
+        session.close()
+    run_starts = dict(((run.dag_id, run.execution_date), run.start_date)
+                      for run in dag_runs)
+    states = {}
+    for ti in task_instances:
+        states[ti.state] = states.get(ti.state, 0) + 1
+    finished = [ti for ti in task_instances if ti.end_date is not None and
+                ti.state in State.finished()]
+    report = {
+        'dag_runs': {},
+        'task_instances': states,
+        'finished': len(finished),
+    }
+    for run in dag_runs:
+        by_state = report['dag_runs'].setdefault(run.dag_id, {})
+        by_state[run.state] = by_state.get(run.state, 0) + 1
+    if finished:
+        wall = _seconds(max(ti.end_date for ti in finished), started)
+        report['wall'] = wall
+        report['tasks_per_second'] = len(finished) / wall
+    queued = [_seconds(ti.start_date, ti.queued_dttm)
+              for ti in task_instances if ti.start_date and ti.queued_dttm]
+    if queued:
+        report['queued_to_running'] = summarize(queued)
+    scheduled = [
+        _seconds(ti.queued_dttm, run_starts[(ti.dag_id, ti.execution_date)])
+        for ti in task_instances
+        if ti.queued_dttm and run_starts.get((ti.dag_id, ti.execution_date))]
+    if scheduled:
+        report['scheduled_to_queued'] = summarize(scheduled)
+    return report
+
+
+def query_report(queries_dir, tasks):
+    roles = {}
+    for path in glob.glob(os.path.join(queries_dir, '*.json')):
+        with open(path) as f:
+            counted = json.load(f)
+        role = roles.setdefault(counted['role'], {
+            'processes': 0, 'total': 0, 'statements': {}})
+        role['processes'] += 1
+        for verb, count in counted['statements'].items():
+            role['statements'][verb] = role['statements'].get(verb, 0) + count
+            role['total'] += count
+    total = sum(role['total'] for role in roles.values())
+    return {'roles': roles, 'total': total,
+            'per_task': total / float(tasks) if tasks else None}
+
+
+def run(fanouts=1, interleaved=10, workers=2, concurrency=None, timeout=600,
+        sql_alchemy_conn=None, overrides=()):
+    work_dir = tempfile.mkdtemp(prefix='throughput-')
+    try:
+        if sql_alchemy_conn is None:
+            bin_dir = find_postgres_bin()
+            if bin_dir is None:
+                raise RuntimeError('initdb and pg_ctl were not found, give '
+                                   'a database with --sql-alchemy-conn')
+            with Postgres(work_dir, bin_dir) as postgres:
+                return measure(work_dir, postgres.url, fanouts, interleaved,
+                               workers, concurrency, timeout, overrides)
+        return measure(work_dir, sql_alchemy_conn, fanouts, interleaved,
+                       workers, concurrency, timeout, overrides)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure(work_dir, sql_alchemy_conn, fanouts, interleaved, workers,
+            concurrency, timeout, overrides):
+    prepare(work_dir)
+    env = airflow_env(work_dir, sql_alchemy_conn, overrides)
+    subprocess.check_call(['airflow', 'initdb'], env=env,
+                          stdout=subprocess.DEVNULL)
+    # only now, airflow reads its configuration when it is imported
+    os.environ.update(env)
+    sys.path.insert(0, os.path.join(ROOT, 'config'))
+
+    queries_dir = os.path.join(work_dir, 'queries')
+    for path in glob.glob(os.path.join(queries_dir, '*.json')):
+        os.remove(path)
+    processes = [start(['scheduler'], env,
+                       os.path.join(work_dir, 'logs', 'scheduler.log'))]
+    for index in range(workers):
+        worker_env = dict(env, AIRFLOW__CELERY__WORKER_LOG_SERVER_PORT=str(
+            8793 + index))
+        if concurrency:
+            # the workers consume the default queue, whose profile sets the
+            # concurrency (see config/worker_profiles.py)
+            worker_env['AIRFLOW__CELERY_WORKER_WORKER__CONCURRENCY'] = str(
+                concurrency)
+        processes.append(start(['worker'], worker_env, os.path.join(
+            work_dir, 'logs', 'worker_%d.log' % index)))
+    try:
+        started = trigger(fanouts, interleaved)
+        finished = wait(processes, timeout)
+    finally:
+        stop(processes)
+    report = {
+        'settings': {
+            'fanouts': fanouts,
+            'interleaved': interleaved,
+            'workers': workers,
+            'concurrency': concurrency,
+            'overrides': list(overrides),
+        },
+        'python': sys.version,
+        'timed_out': not finished,
+    }
+    report.update(task_report(started))
+    report['queries'] = query_report(queries_dir, report['finished'])
+    return report
+
+
+def print_summary(report, out=sys.stderr):
+    if report['timed_out']:
+        print('timed out, the numbers only cover finished tasks', file=out)
+    print('%d task instances finished, %.2f tasks/s' % (
+        report['finished'], report.get('tasks_per_second', 0)), file=out)
+    for name in ['queued_to_running', 'scheduled_to_queued']:
+        if name in report:
+            print('%-20s mean %.1fms p50 %.1fms p95 %.1fms' % (
+                name, report[name]['mean_ms'], report[name]['p50_ms'],
+                report[name]['p95_ms']), file=out)
+    queries = report['queries']
+    per_task = queries['per_task']
+    print('%d queries%s' % (queries['total'], ', %.1f per task' % per_task
+                            if per_task else ''), file=out)
+    for role, counted in sorted(queries['roles'].items()):
+        print('    %-12s %8d in %d processes' % (
+            role, counted['total'], counted['processes']), file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--fanouts', type=int, default=1,
+                        help='runs of %s to trigger' % FANOUT_DAG_ID)
+    parser.add_argument('--interleaved', type=int, default=10,
+                        help='runs of %s to trigger' % INTERLEAVED_DAG_ID)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int,
+                        help='task slots per worker instead of the ones '
+                        'from its queue profile')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--sql-alchemy-conn',
+                        help='empty metadata database to use instead of '
+                        'a throwaway PostgreSQL cluster')
+    parser.add_argument('--set', dest='overrides', action='append',
+                        default=[], metavar='SECTION.OPTION=VALUE',
+                        help='override an airflow.cfg option')
+    parser.add_argument('--output', help='write the json report here '
+                        'instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args.fanouts, args.interleaved, args.workers,
+                 args.concurrency, args.timeout, args.sql_alchemy_conn,
+                 args.overrides)
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -0,0 +1,143 @@
+"""
+Compare building a layered dag with LayeredDagBuilder against wiring it with
+per task set_upstream calls.
+
+The dag is the interleaved example scaled up: begin, three layers of
+``width`` tasks, the first fanning out from begin and the others connected to
+their neighbours with ``window(-1, 0)``, then end. Every build runs in its own
+forked process, once for wall time and once under tracemalloc for the peak
+allocation. The per task build grows much faster than linearly, so it is
+skipped above ``--naive-limit`` tasks.
+
+    python -m benchmarks.topology [--tasks 1000 10000 100000]
+        [--naive-limit 10000] [--output report.json]
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.dag_parse import isolated
+
+LAYERS = 3
+
+
+def make_dag(tasks):
+    from airflow import DAG
+    return DAG('benchmark_topology_%d' % tasks, schedule_interval=None,
+               default_args={'owner': 'airflow',
+                             'start_date': datetime(2017, 5, 1)})
+
+
+def build_with_builder(dag, width):
+    from airflow.operators.bash_operator import BashOperator
+    from custom.topology import LayeredDagBuilder, all_to_all, window
+    builder = LayeredDagBuilder(dag).add_layer(
+        BashOperator, task_id='begin', bash_command='true')
+    for layer in range(LAYERS):
+        builder.add_layer(BashOperator, width=width,
+                          pattern=all_to_all if layer == 0 else window(-1, 0),
+                          task_id='layer_%d_{index}' % layer,
+                          bash_command='true')
+    builder.add_layer(BashOperator, task_id='end', bash_command='true')
+    builder.build()
+
+
+def build_naive(dag, width):
+    from airflow.operators.bash_operator import BashOperator
+    begin = BashOperator(task_id='begin', bash_command='true', dag=dag)
+    previous = [begin]
+    for layer in range(LAYERS):
+        tasks = [BashOperator(task_id='layer_%d_%d' % (layer, index),
+                              bash_command='true', dag=dag)
+                 for index in range(width)]
+        for index, task in enumerate(tasks):
+            if layer == 0:
+                task.set_upstream(begin)
+            else:
+                task.set_upstream(previous[max(index - 1, 0):index + 1])
+        previous = tasks
+    end = BashOperator(task_id='end', bash_command='true', dag=dag)
+    end.set_upstream(previous)
+
+
+def measure(method, tasks, trace=False):
+    width = max(1, (tasks - 2) // LAYERS)
+    dag = make_dag(tasks)
+    build = build_with_builder if method == 'builder' else build_naive
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        build(dag, width)
+        result = {'wall': time.perf_counter() - start}
+        if trace:
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result.update({
+        'method': method,
+        'tasks': len(dag.task_dict),
+        'edges': sum(len(task.upstream_task_ids)
+                     for task in dag.task_dict.values()),
+    })
+    return result
+
+
+def measure_both(method, tasks):
+    """
+    Time without tracemalloc, its overhead would swamp the build itself
+    """
+    result = isolated(measure, method, tasks)
+    if 'error' not in result:
+        result['peak_bytes'] = isolated(
+            measure, method, tasks, True).get('peak_bytes')
+    return result
+
+
+def run(sizes, naive_limit):
+    # warm the parent so children only pay for building
+    import airflow  # noqa puts the plugins folder on the path
+    import airflow.operators.bash_operator  # noqa
+    import custom.topology  # noqa
+    results = []
+    for tasks in sizes:
+        results.append(measure_both('builder', tasks))
+        if tasks <= naive_limit:
+            results.append(measure_both('naive', tasks))
+    return {'python': sys.version, 'results': results}
+
+
+def print_summary(report, out=sys.stderr):
+    row = '{:<8} {:>8} {:>8} {:>10} {:>10}'
+    print(row.format('method', 'tasks', 'edges', 'wall_s', 'peak_mb'),
+          file=out)
+    for result in report['results']:
+        if 'error' in result:
+            print('failed: %s' % result['error'], file=out)
+            continue
+        print(row.format(result['method'], result['tasks'], result['edges'],
+                         '%.3f' % result['wall'],
+                         '%.1f' % (result['peak_bytes'] / 1024 / 1024)),
+              file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--tasks', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--naive-limit', type=int, default=10000)
+    parser.add_argument('--output', help='write the json report here '
+                        'instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args.tasks, args.naive_limit)
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
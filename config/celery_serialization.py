@@ -0,0 +1,182 @@
+"""
+Serialisation profiles for celery task messages and results.
+
+Profiles are kombu serializer names:
+
+    - ``json``: readable, safe, enough for the airflow command airflow sends
+    - ``msgpack``: compact binary json, needs the msgpack package
+    - ``pickle``: any python object
+    - ``pickle-zlib``, ``pickle-lz4``: pickle, compressed with zlib or lz4
+      (needs the lz4 package) once the pickle is ``compress_threshold`` bytes
+      or more. The first byte of the body says whether it was compressed.
+
+They are picked in the ``[celery_serialization]`` section of airflow.cfg:
+
+    [celery_serialization]
+    task_profile = pickle
+    queue_profiles = worker-gpu:pickle-lz4, manager:json
+    result_profile = pickle
+    compress_threshold = 1024
+
+``queue_profiles`` overrides ``task_profile`` for the task messages sent to
+each listed queue. Every profile in use is accepted by every worker, so the
+same config has to be deployed everywhere before a profile is switched on.
+"""
+import pickle
+import zlib
+
+from airflow.exceptions import AirflowConfigException
+# the plugins folder is on the path once airflow is imported
+from custom.util import get_option
+
+SECTION = 'celery_serialization'
+# the one task airflow's celery executor sends
+EXECUTE_COMMAND = 'airflow.executors.celery_executor.execute_command'
+DEFAULT_PROFILE = 'pickle'
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+UNCOMPRESSED = b'\x00'
+COMPRESSED = b'\x01'
+
+
+def _zlib():
+    return zlib.compress, zlib.decompress
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+def _msgpack():
+    # kombu would only complain about it when sending the first message
+    import msgpack  # noqa
+
+
+COMPRESSORS = {
+    'pickle-zlib': _zlib,
+    'pickle-lz4': _lz4,
+}
+REQUIREMENTS = {
+    'json': lambda: None,
+    'pickle': lambda: None,
+    'msgpack': _msgpack,
+    'pickle-zlib': _zlib,
+    'pickle-lz4': _lz4,
+}
+
+
+class CompressedPickle(object):
+    """
+    Pickles, then compresses bodies of at least ``threshold`` bytes. Small
+    bodies, like a single airflow command, would only grow by compressing.
+    """
+    def __init__(self, compress, decompress, threshold):
+        self.compress = compress
+        self.decompress = decompress
+        self.threshold = threshold
+
+    def dumps(self, obj):
+        from kombu.serialization import pickle_protocol
+        data = pickle.dumps(obj, protocol=pickle_protocol)
+        if len(data) < self.threshold:
+            return UNCOMPRESSED + data
+        return COMPRESSED + self.compress(data)
+
+    def loads(self, data):
+        data = bytes(data)
+        if data[:1] == COMPRESSED:
+            return pickle.loads(self.decompress(data[1:]))
+        return pickle.loads(data[1:])
+
+
+def content_type(profile):
+    return 'application/x-python-serialize-%s' % profile.split('-', 1)[1]
+
+
+def register(profile, threshold=DEFAULT_COMPRESS_THRESHOLD):
+    """
+    Make sure kombu can encode and decode with profile, registering the
+    compressed pickle profiles with it.
+
+    :raises AirflowConfigException: for unknown profiles or missing packages
+    """
+    if profile not in REQUIREMENTS:
+        raise AirflowConfigException(
+            'Unknown serialization profile %s, expected one of %s' %
+            (profile, ', '.join(sorted(REQUIREMENTS))))
+    try:
+        REQUIREMENTS[profile]()
+    except ImportError as e:
+        raise AirflowConfigException(
+            'Serialization profile %s is not available: %s' % (profile, e))
+
+    if profile in COMPRESSORS:
+        from kombu.serialization import register as register_serializer
+        serializer = CompressedPickle(*COMPRESSORS[profile](),
+                                      threshold=threshold)
+        register_serializer(profile, serializer.dumps, serializer.loads,
+                            content_type=content_type(profile),
+                            content_encoding='binary')
+
+
+def parse_queue_profiles(value):
+    """
+    Parse ``queue:profile, queue:profile``
+    """
+    queue_profiles = {}
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        queue, _, profile = entry.partition(':')
+        if not profile.strip():
+            raise AirflowConfigException(
+                'Expected queue:profile in [%s] queue_profiles, got %s' %
+                (SECTION, entry.strip()))
+        queue_profiles[queue.strip()] = profile.strip()
+    return queue_profiles
+
+
+class QueueRouter(object):
+    """
+    Celery router picking the serializer from the queue a task is sent to
+    """
+    def __init__(self, queue_profiles):
+        self.queue_profiles = queue_profiles
+
+    def __call__(self, name, args, kwargs, options, task=None, **kw):
+        queue = options.get('queue')
+        profile = self.queue_profiles.get(getattr(queue, 'name', queue))
+        if profile is not None:
+            return {'serializer': profile}
+
+
+def celery_options():
+    """
+    Celery settings for the configured profiles, to merge into CELERY_CONFIG
+    """
+    task_profile = get_option(SECTION, 'task_profile', DEFAULT_PROFILE)
+    result_profile = get_option(SECTION, 'result_profile', DEFAULT_PROFILE)
+    queue_profiles = parse_queue_profiles(
+        get_option(SECTION, 'queue_profiles', ''))
+    threshold = int(get_option(SECTION, 'compress_threshold',
+                               DEFAULT_COMPRESS_THRESHOLD))
+
+    profiles = set([task_profile, result_profile])
+    profiles.update(queue_profiles.values())
+    for profile in profiles:
+        register(profile, threshold)
+
+    options = {
+        'task_serializer': task_profile,
+        'result_serializer': result_profile,
+        # keep accepting the default profiles so messages already queued
+        # still decode after switching
+        'accept_content': sorted(profiles | set(['json', DEFAULT_PROFILE])),
+    }
+    if queue_profiles:
+        # the task picks up task_serializer when it is bound, which would win
+        # over the serializer from the route
+        options['task_annotations'] = {EXECUTE_COMMAND: {'serializer': None}}
+        options['task_routes'] = (QueueRouter(queue_profiles),)
+    return options
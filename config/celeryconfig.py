@@ -1,11 +1,10 @@
 from airflow import configuration
+from celery_serialization import celery_options
+import worker_profiles  # noqa applies [celery_worker_<queue>] profiles
 
 # Broker settings.
 CELERY_CONFIG = {
-    'accept_content': ['json', 'pickle'],
     'event_serializer': 'json',
-    'result_serializer': 'pickle',
-    'task_serializer': 'pickle',
     'worker_prefetch_multiplier': 1,
     'task_acks_late': True,
     'task_reject_on_worker_lost': True,
@@ -15,5 +14,11 @@ CELERY_CONFIG = {
         configuration.getint('celery', 'CELERYD_CONCURRENCY'),
     'task_default_queue': configuration.get('celery', 'DEFAULT_QUEUE'),
     'task_default_exchange': configuration.get('celery', 'DEFAULT_QUEUE'),
-    'worker_send_task_events': True
+    'worker_send_task_events': True,
+    # only used by workers whose queue profile sets autoscale
+    'worker_autoscaler': 'resource_autoscaler:ResourceAwareAutoscaler',
 }
+
+# task_serializer, result_serializer and accept_content come from the
+# [celery_serialization] profiles
+CELERY_CONFIG.update(celery_options())
@@ -0,0 +1,174 @@
+"""
+Celery pool autoscaler sizing the pool from queue depth and host resources.
+
+Celery's own autoscaler sizes the pool from the tasks the worker has already
+reserved. With a prefetch multiplier of 1 that is at most one more than it is
+running, and it never looks at the host. ``ResourceAwareAutoscaler`` also
+counts the messages waiting in the queues the worker consumes from, and grows
+one process at a time, only while the host has headroom:
+
+    - the 1 minute load average per cpu is below ``max_load``
+    - at least ``min_free_memory`` megabytes are available
+
+Once the load goes over ``shed_load`` or memory runs under
+``min_free_memory`` it sheds a process at a time, idle ones only. This lets a
+worker fill its node before the cluster scaler has to add another one.
+
+Enabled for a queue by setting ``autoscale = max,min`` in its worker profile
+(see worker_profiles.py). Limits are read from ``[celery_autoscale]``.
+"""
+import logging
+import os
+import time
+
+from airflow import configuration
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+
+logger = logging.root.getChild(__name__)
+
+SECTION = 'celery_autoscale'
+MEGABYTE = 1024 * 1024
+
+
+def _option(value, key, default):
+    """
+    value if given, else the option from airflow.cfg, else default
+    """
+    if value is not None:
+        return value
+    if configuration.has_option(SECTION, key):
+        return float(configuration.get(SECTION, key))
+    return default
+
+
+def load_per_cpu():
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def available_memory(meminfo='/proc/meminfo'):
+    """
+    Bytes of memory available on the host, None if unknown
+    """
+    try:
+        with open(meminfo) as meminfo_file:
+            for line in meminfo_file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class ResourceAwareAutoscaler(Autoscaler):
+    """
+    :param max_load: only grow while the load average per cpu is below this
+    :type max_load: float
+    :param shed_load: shed processes while the load average per cpu is above
+        this, defaults to 1.5 * ``max_load``
+    :type shed_load: float
+    :param min_free_memory: megabytes that must stay available to grow,
+        processes are shed below it
+    :type min_free_memory: float
+    :param queue_check_interval: seconds between broker queue depth checks
+    :type queue_check_interval: float
+    """
+    def __init__(self, pool, max_concurrency, min_concurrency=0, worker=None,
+                 max_load=None, shed_load=None, min_free_memory=None,
+                 queue_check_interval=None, load=load_per_cpu,
+                 memory=available_memory, clock=time.monotonic, **kwargs):
+        super(ResourceAwareAutoscaler, self).__init__(
+            pool, max_concurrency, min_concurrency, worker=worker, **kwargs)
+        self.max_load = _option(max_load, 'max_load', 1.0)
+        self.shed_load = _option(shed_load, 'shed_load', self.max_load * 1.5)
+        self.min_free_memory = _option(
+            min_free_memory, 'min_free_memory', 512) * MEGABYTE
+        self.queue_check_interval = _option(
+            queue_check_interval, 'queue_check_interval', 5)
+        self.load = load
+        self.memory = memory
+        self.clock = clock
+        self._connection = None
+        self._depth = 0
+        self._depth_checked = None
+
+    def queue_depth(self):
+        """
+        Messages waiting in the broker for the queues this worker consumes
+        from, checked at most every ``queue_check_interval`` seconds
+        """
+        now = self.clock()
+        if self._depth_checked is not None and \
+                now - self._depth_checked < self.queue_check_interval:
+            return self._depth
+        self._depth_checked = now
+        try:
+            if self._connection is None:
+                self._connection = self.worker.app.connection_for_read()
+            channel = self._connection.default_channel
+            self._depth = sum(
+                channel.queue_declare(queue=name, passive=True).message_count
+                for name in self.worker.app.amqp.queues.consume_from)
+        except Exception as e:
+            logger.warning('Could not check queue depth: %s', e)
+            self._release_connection()
+            self._depth = 0
+        return self._depth
+
+    def _release_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.release()
+            except Exception:
+                pass
+        self._connection = None
+
+    def has_headroom(self):
+        memory = self.memory()
+        return self.load() < self.max_load and (
+            memory is None or memory >= self.min_free_memory)
+
+    def is_overloaded(self):
+        memory = self.memory()
+        return self.load() > self.shed_load or (
+            memory is not None and memory < self.min_free_memory)
+
+    @property
+    def qty(self):
+        return len(state.reserved_requests) + self.queue_depth()
+
+    def target(self, processes, overloaded=False):
+        """
+        Number of processes the pool should have next
+        """
+        demand = min(max(self.qty, self.min_concurrency),
+                     self.max_concurrency)
+        if overloaded:
+            return max(min(demand, processes - 1), self.min_concurrency)
+        if demand > processes:
+            return processes + 1 if self.has_headroom() else processes
+        return demand
+
+    def _maybe_scale(self, req=None):
+        processes = self.processes
+        overloaded = self.is_overloaded()
+        target = self.target(processes, overloaded)
+        if target > processes:
+            self.scale_up(target - processes)
+            return True
+        if target < processes:
+            if overloaded:
+                # do not wait out keepalive when the host is struggling
+                self._shrink(processes - target)
+            else:
+                self.scale_down(processes - target)
+            return True
+
+    def info(self):
+        info = super(ResourceAwareAutoscaler, self).info()
+        info.update({
+            'queue_depth': self._depth,
+            'load_per_cpu': self.load(),
+            'available_memory': self.memory(),
+        })
+        return info
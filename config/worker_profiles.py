@@ -0,0 +1,111 @@
+"""
+Per queue celery worker tuning.
+
+Workers are started with ``airflow worker -q <queue>``, which only hands the
+queue and ``celeryd_concurrency`` to celery. The tuning profile of the queue
+a worker consumes from is read from the ``[celery_worker_<queue>]`` section
+of airflow.cfg and applied when the worker initializes, before its pool and
+consumer are created:
+
+    [celery_worker_manager]
+    concurrency = 2
+    prefetch_multiplier = 4
+    acks_late = False
+    # max,min pool processes, see resource_autoscaler.py
+    autoscale = 8,1
+
+Options that are left out keep the values from celeryconfig. A worker
+consuming from several queues uses the profile of the first queue that has
+one. An explicit ``airflow worker --concurrency N`` wins over the profile's
+``concurrency``, which otherwise replaces ``celeryd_concurrency``.
+"""
+import logging
+import re
+import sys
+
+from airflow import configuration
+from celery.signals import worker_init
+from celery_serialization import EXECUTE_COMMAND
+
+logger = logging.root.getChild(__name__)
+
+SECTION_PREFIX = 'celery_worker_'
+CONCURRENCY_ARGUMENT = re.compile(r'^(-c[0-9]*|--concurrency(=.*)?)$')
+
+
+def parse_bool(value):
+    return str(value).strip().lower() in ('true', 't', '1', 'yes')
+
+
+def parse_autoscale(value):
+    """
+    Parse celery's ``max,min`` autoscale format
+    """
+    max_concurrency, _, min_concurrency = str(value).partition(',')
+    return [int(max_concurrency), int(min_concurrency or 0)]
+
+
+PROFILE_OPTIONS = [
+    ('concurrency', int),
+    ('prefetch_multiplier', int),
+    ('acks_late', parse_bool),
+    ('autoscale', parse_autoscale),
+]
+
+
+def load_profile(queue):
+    section = SECTION_PREFIX + queue
+    profile = {}
+    for option, parse in PROFILE_OPTIONS:
+        if configuration.has_option(section, option):
+            profile[option] = parse(configuration.get(section, option))
+    return profile
+
+
+def queue_profile(queues):
+    """
+    :return: the first queue with a profile and its profile, or (None, {})
+    """
+    for queue in queues:
+        profile = load_profile(queue)
+        if profile:
+            return queue, profile
+    return None, {}
+
+
+def concurrency_given(argv):
+    """
+    Whether ``--concurrency`` was passed to ``airflow worker``, airflow
+    always hands celery a concurrency so the worker can not tell
+    """
+    return any(CONCURRENCY_ARGUMENT.match(arg) for arg in argv[1:])
+
+
+def apply_profile(worker, profile, argv=None):
+    argv = sys.argv if argv is None else argv
+    if 'concurrency' in profile:
+        if concurrency_given(argv):
+            logger.info('Keeping the concurrency of %s from the command '
+                        'line', worker.concurrency)
+        else:
+            worker.concurrency = profile['concurrency']
+    if 'prefetch_multiplier' in profile:
+        worker.prefetch_multiplier = profile['prefetch_multiplier']
+    if 'autoscale' in profile:
+        # read by the pool bootstep, which airflow gives no way to pass it to
+        worker.options['autoscale'] = profile['autoscale']
+    if 'acks_late' in profile:
+        worker.app.conf.task_acks_late = profile['acks_late']
+        # the task already picked up the global value when it was bound
+        if EXECUTE_COMMAND in worker.app.tasks:
+            worker.app.tasks[EXECUTE_COMMAND].acks_late = profile['acks_late']
+
+
+@worker_init.connect
+def apply_queue_profile(sender=None, **kwargs):
+    queue, profile = queue_profile(sorted(
+        sender.app.amqp.queues.consume_from))
+    if profile:
+        logger.info('Applying worker profile for queue %s: %s', queue,
+                    profile)
+        apply_profile(sender, profile)
@@ -0,0 +1,42 @@
+# Every task mounts the same reference data read-only from a host cache that
+# is only downloaded by the first task to need it on each host
+
+from airflow import DAG
+from datetime import datetime, timedelta
+from airflow.operators.docker_plugin import DockerConfigurableOperator
+from custom.cache import CacheVolume
+
+DAG_ID = 'example_docker_cache_volume'
+
+default_args = {
+    'owner': 'airflow',
+    'depends_on_past': False,
+    'start_date': datetime(2017, 5, 1),
+    'catchup_by_default': False,
+    'retries': 1,
+    'retry_delay': timedelta(seconds=2),
+    'retry_exponential_backoff': True,
+}
+
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args=default_args,
+    schedule_interval=None
+)
+
+reference_data = CacheVolume(
+    name='reference',
+    key='v1',
+    mount_point='/reference',
+    populate_command='sh -c "seq 1 1000 > /reference/numbers.txt"'
+)
+
+for i in range(4):
+    DockerConfigurableOperator(
+        task_id='docker_task_%d' % i,
+        command='sh -c "wc -l /reference/numbers.txt"',
+        default_args=default_args,
+        image='alpine:latest',
+        cache_volumes=[reference_data],
+        dag=dag
+    )
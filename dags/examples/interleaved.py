@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
 from airflow import DAG
 from airflow.operators.bash_operator import BashOperator
+from custom.topology import LayeredDagBuilder, window
 
 
 default_args = {
@@ -16,63 +17,23 @@ dag = DAG(
     "example_interleaved", default_args=default_args, schedule_interval=None)
 
 
-def create_print_date(dag, count_print_date):
-    return BashOperator(
-        task_id='print_date_' + str(count_print_date),
-        bash_command='date',
-        dag=dag)
-
-
-def create_print_hello(dag, count_print_hello):
-    return BashOperator(
-        task_id='print_hello_' + str(count_print_hello),
-        bash_command='echo "hello world!"',
-        dag=dag)
-
-
-def create_docker_print(dag, count_docker_print):
-    return BashOperator(
-        task_id='bash_print_' + str(count_docker_print),
-        bash_command='echo "watershed printing!"',
-        dag=dag)
-
-
-begin_task = BashOperator(
-    task_id='begin_task',
-    bash_command='echo "Start here"',
-    dag=dag)
-
+# Each layer only depends on its neighbours in the previous layer. The
+# builder wires the layers in bulk, so this stays cheap to parse at widths of
+# thousands of tasks per layer
 width = 5
-print_date_tasks = [create_print_date(dag, i) for i in range(width)]
-print_hello_tasks = [create_print_hello(dag, i) for i in range(width)]
-docker_print_tasks = [create_docker_print(dag, i) for i in range(width)]
-
-done_task = BashOperator(
-    task_id='end_task',
-    bash_command='echo "I AM DONE"',
-    dag=dag)
-
-for print_date_task in print_date_tasks:
-    print_date_task.set_upstream(begin_task)
-
-print_hello_tasks[0].set_upstream(print_date_tasks[0])
-print_hello_tasks[0].set_downstream(docker_print_tasks[0])
-print_hello_tasks[0].set_downstream(docker_print_tasks[1])
-
-for layer_2_index in range(1, width - 1):
-    print_hello_tasks[layer_2_index].set_upstream(
-            print_date_tasks[layer_2_index - 1])
-    print_hello_tasks[layer_2_index].set_upstream(
-            print_date_tasks[layer_2_index])
-
-    print_hello_tasks[layer_2_index].set_downstream(
-            docker_print_tasks[layer_2_index + 1])
-    print_hello_tasks[layer_2_index].set_downstream(
-            docker_print_tasks[layer_2_index])
-
-print_hello_tasks[-1].set_upstream(print_date_tasks[-1])
-print_hello_tasks[-1].set_upstream(print_date_tasks[-2])
-print_hello_tasks[-1].set_downstream(docker_print_tasks[-1])
-
-for docker_print_task in docker_print_tasks:
-    docker_print_task.set_downstream(done_task)
+(
+    LayeredDagBuilder(dag)
+    .add_layer(BashOperator, task_id='begin_task',
+               bash_command='echo "Start here"')
+    .add_layer(BashOperator, width=width, task_id='print_date_{index}',
+               bash_command='date')
+    .add_layer(BashOperator, width=width, pattern=window(-1, 0),
+               task_id='print_hello_{index}',
+               bash_command='echo "hello world!"')
+    .add_layer(BashOperator, width=width, pattern=window(-1, 0),
+               task_id='bash_print_{index}',
+               bash_command='echo "watershed printing!"')
+    .add_layer(BashOperator, task_id='end_task',
+               bash_command='echo "I AM DONE"')
+    .build()
+)
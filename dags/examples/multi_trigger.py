@@ -34,6 +34,8 @@ operator = MultiTriggerDagRunOperator(
     task_id='trigger_%s' % TARGET_DAG_ID,
     trigger_dag_id=TARGET_DAG_ID,
     params_list=get_generator,
+    # released in fair-share batches, see custom/fairshare.py
+    tenant='examples',
     default_args=default_args,
     dag=scheduler_dag)
 
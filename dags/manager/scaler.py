@@ -1,6 +1,8 @@
 """
 This dag autoscales your cluster. This only works with docker-compose (local)
-and Infrakit (swarm).
+and Infrakit (swarm). Idle infrakit groups are kept in standby at size 0 and
+cold started between runs as soon as their queue has a message, see
+plugins/custom/infrakit.py.
 
 For Infrakit, the following environment variables must be set:
     - INFRAKIT_IMAGE - what docker image to use for infrakit
@@ -15,10 +17,15 @@ from airflow.operators.bash_operator import BashOperator
 from airflow.operators.python_operator import PythonOperator
 from airflow.operators.latest_only_operator import LatestOnlyOperator
 from airflow.utils.db import provide_session
-from airflow import models
-import requests
+from airflow import configuration, models
+from custom import fairshare
+from custom.infrakit import ColdStartWatcher, Infrakit
+from custom.metrics import get_metrics
+from custom.xcom_store import offload, resolve_xcom
 import json
 import logging
+import os
+import time
 logger = logging.root.getChild(__name__)
 
 DAG_ID = 'z_manager_cluster_scaler'
@@ -43,26 +50,25 @@ MANAGER_QUEUE = u'manager'
 QUEUE_SIZES_TASK_ID = 'queue_sizes'
 BRANCH_RESIZE_TASK_ID = 'branch_resize'
 RESCALE_TASK_ID = 'rescale_compose'
+RESCALE_INFRAKIT_TASK_ID = 'rescale_infrakit'
+COLD_START_TASK_ID = 'cold_start_watch'
+# watch until shortly before the next run of this dag starts its own watch.
+# The watch holds a manager worker slot meanwhile, the [celery_worker_manager]
+# autoscale floor in airflow.cfg keeps enough slots for the other tasks
+COLD_START_WATCH_SECONDS = 50
 QUEUE_URL = 'http://rabbitmq:15672/api/queues/%2f/{}'
 QUEUE_USERNAME = 'guest'
 QUEUE_PASSWORD = 'guest'
 
 
-# To use infrakit with > 1 queue, we will have to modify this code to use
-# separate groups file for each queue!
 templated_resize_command = """
-{% set queue_sizes = task_instance.xcom_pull(task_ids=params.task_id) %}
+{% set queue_sizes = macros.custom_plugin.resolve_xcom(
+    task_instance.xcom_pull(task_ids=params.task_id)) %}
 {%
 set docker_compose_command='docker-compose -f ' +
     conf.get('core', 'airflow_home') + '/deploy/docker-compose-CeleryExecutor.yml' +
     ' up -d --no-recreate --no-deps --no-build --no-color'
 %}
-{%
-set docker_infrakit_command='docker run --rm \
--v /var/run/docker.sock:/var/run/docker.sock -v /infrakit/:/infrakit \
--e INFRAKIT_HOME=/infrakit -e INFRAKIT_PLUGINS_DIR=/infrakit/plugins \
--e INFRAKIT_HOST=manager-cluster ${INFRAKIT_IMAGE} infrakit'
-%}
 if mount | grep '{{conf.get('core', 'airflow_home')}}/[dags|plugins]' > /dev/null; then
     echo 'Dag folder or plugin folder is mounted! Will not autoscale!'
 else
@@ -73,26 +79,7 @@ else
         {{docker_compose_command}} --scale \
 {% for queue, size in queue_sizes.items() %} worker-{{queue}}={{size}} {% endfor %}
     else
-        echo "Scaling infrakit"
-        {% for queue, size in queue_sizes.items() %}
-        if [ {{size}} -gt 0 ]; then
-            if ! {{docker_infrakit_command}} group describe workers-{{queue}}; then
-                echo 'Recommitting missing group...'
-                {{docker_infrakit_command}} manager commit ${{'{'}}INFRAKIT_GROUPS_URL{{'}'}}
-            else
-                echo 'Group workers-{{queue}} already exists, no need to commit'
-            fi
-            echo 'Scaling...'
-            {{docker_infrakit_command}} group scale workers-{{queue}} {{size}}
-        else
-            if {{docker_infrakit_command}} group describe workers-{{queue}}; then
-                echo 'Destroying Group workers-{{queue}}'
-                {{docker_infrakit_command}} group destroy workers-{{queue}}
-            else
-                echo 'Group workers-{{queue}} already destroyed'
-            fi
-        fi
-        {% endfor %}
+        echo "Infrakit groups are scaled by {{params.infrakit_task_id}}"
     fi
     {% endif %}
 fi
@@ -111,7 +98,17 @@ def find_queues(session=None):
     return queues
 
 
+def queue_depth(queue_name):
+    # imported here so parsing this dag file does not pay for requests
+    import requests
+    response = requests.get(QUEUE_URL.format(queue_name),
+                            auth=(QUEUE_USERNAME, QUEUE_PASSWORD))
+    stats = json.loads(response.text)
+    return stats['messages_ready'] + stats['messages_unacknowledged']
+
+
 def get_queue_sizes():
+    metrics = get_metrics()
     queue_sizes = {}
     for queue in find_queues():
         queue_name = queue[0]
@@ -119,16 +116,68 @@ def get_queue_sizes():
             continue
 
         try:
-            response = requests.get(QUEUE_URL.format(queue_name),
-                                    auth=(QUEUE_USERNAME, QUEUE_PASSWORD))
-            stats = json.loads(response.text)
-            size = stats['messages_ready'] + stats['messages_unacknowledged']
-            queue_sizes[queue_name] = size
+            with metrics.timer('scaler_queue_check_seconds', queue=queue_name):
+                queue_sizes[queue_name] = queue_depth(queue_name)
         except Exception:
             logger.exception('No tasks found for %s', queue_name)
+            metrics.counter('scaler_queue_check_failures', queue=queue_name)
             queue_sizes[queue_name] = 0
-
-    return queue_sizes
+        # the compose and infrakit groups are scaled to the queue size
+        metrics.gauge('scaler_queue_depth', queue_sizes[queue_name],
+                      queue=queue_name)
+
+    # scale up ahead of the runs fair-share dispatchers are about to start
+    try:
+        upcoming = fairshare.releases_by_queue(fairshare.load_quotas(),
+                                               fairshare.active_runs(),
+                                               fairshare.pending_fanouts())
+    except Exception:
+        logger.exception('Could not read pending fair-share runs')
+        upcoming = {}
+    for queue_name, runs in upcoming.items():
+        if queue_name != MANAGER_QUEUE:
+            queue_sizes[queue_name] = queue_sizes.get(queue_name, 0) + runs
+    metrics.flush()
+
+    # stays in the database unless there are a great many queues
+    return offload(queue_sizes)
+
+
+def mounted_for_development():
+    home = configuration.get('core', 'airflow_home')
+    with open('/proc/mounts') as mounts:
+        targets = set(line.split()[1] for line in mounts if line.strip())
+    return bool(targets & set([os.path.join(home, 'dags'),
+                               os.path.join(home, 'plugins')]))
+
+
+def uses_infrakit():
+    if not os.environ.get('INFRAKIT_IMAGE'):
+        return False
+    if mounted_for_development():
+        logger.warning('Dag folder or plugin folder is mounted! '
+                       'Will not autoscale!')
+        return False
+    return True
+
+
+def rescale_infrakit(**context):
+    if not uses_infrakit():
+        return
+    queue_sizes = context['ti'].xcom_pull(task_ids=QUEUE_SIZES_TASK_ID)
+    # cold_start_watch runs alongside, do not scale down what it started
+    # since the sizes were measured
+    measured = context['dag_run'].get_task_instance(QUEUE_SIZES_TASK_ID)
+    Infrakit().rescale(resolve_xcom(queue_sizes) or {},
+                       queue_depth=queue_depth,
+                       measured_at=time.mktime(
+                           measured.start_date.timetuple()))
+
+
+def watch_cold_starts():
+    if not uses_infrakit():
+        return
+    ColdStartWatcher(Infrakit(), queue_depth).watch(COLD_START_WATCH_SECONDS)
 
 
 latest = LatestOnlyOperator(
@@ -146,8 +195,24 @@ rescale_task = BashOperator(
     task_id=RESCALE_TASK_ID,
     bash_command=templated_resize_command,
     queue="manager",
-    params={'task_id': QUEUE_SIZES_TASK_ID},
+    params={'task_id': QUEUE_SIZES_TASK_ID,
+            'infrakit_task_id': RESCALE_INFRAKIT_TASK_ID},
+    dag=dag)
+
+rescale_infrakit_task = PythonOperator(
+    task_id=RESCALE_INFRAKIT_TASK_ID,
+    python_callable=rescale_infrakit,
+    provide_context=True,
+    queue="manager",
+    dag=dag)
+
+cold_start_task = PythonOperator(
+    task_id=COLD_START_TASK_ID,
+    python_callable=watch_cold_starts,
+    queue="manager",
     dag=dag)
 
 latest.set_downstream(queue_sizes_task)
+latest.set_downstream(cold_start_task)
 queue_sizes_task.set_downstream(rescale_task)
+queue_sizes_task.set_downstream(rescale_infrakit_task)
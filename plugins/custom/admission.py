@@ -0,0 +1,216 @@
+"""
+Host admission control for docker tasks.
+
+Celery concurrency is a fixed number of slots, but docker tasks differ a lot
+in ``cpus`` and ``mem_limit``. The ``AdmissionController`` keeps containers
+from oversubscribing the docker host. Docker operators opt in with
+``admission_control=True``:
+
+    - every container started by the docker operators is labelled with the
+      cpus and memory it reserved, so the running containers on the daemon
+      are the source of truth for what is currently reserved
+    - a task that wants to start a container takes a ticket in a FIFO queue
+      kept in a ledger file shared by every worker on the host (/tmp is
+      mounted from the host) and waits until it is at the head of the queue
+      and its reservation fits
+    - once admitted, the reservation is held in the ledger until the
+      container has started and its labels take over
+
+Tickets are refreshed while waiting so tickets of crashed workers expire.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from custom.util import locked, write_atomic
+
+logger = logging.root.getChild(__name__)
+
+CPUS_LABEL = 'air-tasks.cpus'
+MEM_LABEL = 'air-tasks.mem'
+DEFAULT_LEDGER = os.environ.get('AIR_TASKS_ADMISSION_LEDGER',
+                                '/tmp/air-tasks-admission.json')
+
+
+def parse_mem(mem_limit):
+    """
+    mem_limit as accepted by docker (int bytes or i.e. '512m') to bytes
+    """
+    if not mem_limit:
+        return 0
+    if isinstance(mem_limit, str):
+        from docker.utils import parse_bytes
+        return parse_bytes(mem_limit)
+    return int(mem_limit)
+
+
+def labels(cpus, mem):
+    """
+    Labels to put on a container so its reservation is accounted for
+    """
+    return {CPUS_LABEL: str(float(cpus or 0)), MEM_LABEL: str(int(mem))}
+
+
+class AdmissionController(object):
+    """
+    :param cli: docker api client of the host to control
+    :param ledger_path: ledger file shared by every worker on the host
+    :type ledger_path: str
+    :param cpu_overcommit: factor applied to the host's cpus
+    :type cpu_overcommit: float
+    :param mem_overcommit: factor applied to the host's memory
+    :type mem_overcommit: float
+    :param reserved_cpus: cpus held back for airflow itself, none by default
+    :type reserved_cpus: float
+    :param reserved_mem: bytes held back for airflow itself, none by default
+    :type reserved_mem: int
+    :param poll_interval: seconds between admission attempts
+    :type poll_interval: float
+    :param ticket_ttl: seconds after which a ticket that was not refreshed
+        is considered abandoned
+    :type ticket_ttl: float
+    :param start_grace: seconds an admitted reservation is held for a
+        container that never reports as running
+    :type start_grace: float
+    """
+    def __init__(self, cli, ledger_path=DEFAULT_LEDGER, cpu_overcommit=1.0,
+                 mem_overcommit=1.0, reserved_cpus=0, reserved_mem=0,
+                 poll_interval=2,
+                 ticket_ttl=30, start_grace=120, clock=time.time):
+        self.cli = cli
+        self.ledger_path = ledger_path
+        self.cpu_overcommit = cpu_overcommit
+        self.mem_overcommit = mem_overcommit
+        self.reserved_cpus = reserved_cpus
+        self.reserved_mem = reserved_mem
+        self.poll_interval = poll_interval
+        self.ticket_ttl = ticket_ttl
+        self.start_grace = start_grace
+        self.clock = clock
+        self._capacity = None
+
+    def capacity(self):
+        """
+        (cpus, mem) available to containers on the docker host
+        """
+        if self._capacity is None:
+            info = self.cli.info()
+            self._capacity = (
+                info['NCPU'] * self.cpu_overcommit - self.reserved_cpus,
+                info['MemTotal'] * self.mem_overcommit - self.reserved_mem)
+        return self._capacity
+
+    def running(self):
+        """
+        (cpus, mem) reserved by running labelled containers
+        """
+        cpus = mem = 0
+        for container in self.cli.containers(
+                filters={'label': CPUS_LABEL, 'status': 'running'}):
+            container_labels = container.get('Labels') or {}
+            cpus += float(container_labels.get(CPUS_LABEL, 0))
+            mem += int(container_labels.get(MEM_LABEL, 0))
+        return cpus, mem
+
+    @contextmanager
+    def _ledger(self):
+        with locked(self.ledger_path):
+            try:
+                with open(self.ledger_path) as ledger_file:
+                    ledger = json.load(ledger_file)
+            except (IOError, OSError, ValueError):
+                ledger = {'queue': [], 'admitted': []}
+            now = self.clock()
+            ledger['queue'] = [ticket for ticket in ledger['queue']
+                               if now - ticket['seen'] < self.ticket_ttl]
+            ledger['admitted'] = [ticket for ticket in ledger['admitted']
+                                  if now - ticket['seen'] < self.start_grace]
+            yield ledger
+            write_atomic(self.ledger_path, json.dumps(ledger))
+
+    def fits(self, cpus, mem, ledger):
+        capacity_cpus, capacity_mem = self.capacity()
+        running_cpus, running_mem = self.running()
+        reserved_cpus = running_cpus + sum(ticket['cpus']
+                                           for ticket in ledger['admitted'])
+        reserved_mem = running_mem + sum(ticket['mem']
+                                         for ticket in ledger['admitted'])
+        if not reserved_cpus and not reserved_mem:
+            # never wait forever on a request larger than the host
+            return True
+        return (reserved_cpus + cpus <= capacity_cpus and
+                reserved_mem + mem <= capacity_mem)
+
+    def try_admit(self, ticket):
+        """
+        Refresh the ticket and admit it if it is at the head of the queue
+        and fits. Returns whether it was admitted.
+        """
+        with self._ledger() as ledger:
+            ticket['seen'] = self.clock()
+            queue = [queued for queued in ledger['queue']
+                     if queued['id'] != ticket['id']]
+            position = len(queue)
+            for index, queued in enumerate(ledger['queue']):
+                if queued['id'] == ticket['id']:
+                    position = index
+            queue.insert(position, ticket)
+            ledger['queue'] = queue
+
+            if position == 0 and self.fits(ticket['cpus'], ticket['mem'],
+                                           ledger):
+                ledger['queue'].pop(0)
+                ledger['admitted'].append(ticket)
+                return True
+            return False
+
+    def release(self, ticket):
+        with self._ledger() as ledger:
+            ledger['queue'] = [queued for queued in ledger['queue']
+                               if queued['id'] != ticket['id']]
+            ledger['admitted'] = [admitted for admitted in ledger['admitted']
+                                  if admitted['id'] != ticket['id']]
+
+    @contextmanager
+    def admit(self, cpus, mem_limit):
+        """
+        Wait until the reservation fits on the host. Create and start the
+        container inside this context, the reservation is released when the
+        context exits as the container labels take over from there.
+        """
+        ticket = {'id': uuid.uuid4().hex, 'cpus': float(cpus or 0),
+                  'mem': parse_mem(mem_limit)}
+        waited = self.clock()
+        try:
+            while not self.try_admit(ticket):
+                time.sleep(self.poll_interval)
+            logger.info('Admitted %s cpus / %s bytes after %.1fs: %s',
+                        ticket['cpus'], ticket['mem'], self.clock() - waited,
+                        self.utilisation())
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def utilisation(self):
+        """
+        Current capacity, reservations and queue length of the host
+        """
+        with self._ledger() as ledger:
+            capacity_cpus, capacity_mem = self.capacity()
+            running_cpus, running_mem = self.running()
+            admitted_cpus = sum(ticket['cpus'] for ticket in ledger['admitted'])
+            admitted_mem = sum(ticket['mem'] for ticket in ledger['admitted'])
+            return {
+                'capacity_cpus': capacity_cpus,
+                'capacity_mem': capacity_mem,
+                'reserved_cpus': running_cpus + admitted_cpus,
+                'reserved_mem': running_mem + admitted_mem,
+                'cpu_utilisation': (running_cpus + admitted_cpus) /
+                capacity_cpus if capacity_cpus > 0 else 0,
+                'mem_utilisation': (running_mem + admitted_mem) /
+                capacity_mem if capacity_mem > 0 else 0,
+                'waiting': len(ledger['queue']),
+            }
@@ -0,0 +1,193 @@
+"""
+Keyed shared cache volumes for task input data.
+
+A ``CacheVolume`` is a named, content-keyed directory on the docker host
+(under /tmp, which is shared between the host and the worker containers).
+The first task on a host to need a given (name, key) populates it by running
+``populate_command`` in a short lived container with the directory mounted
+read-write. Every task then gets it mounted read-only. Entries are evicted
+least recently used first once the cache grows over its disk budget.
+
+Locking uses flock on a per entry lock file: populating holds an exclusive
+lock, tasks using an entry hold a shared lock for as long as their container
+runs so an entry in use is never evicted.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+logger = logging.root.getChild(__name__)
+
+DEFAULT_CACHE_ROOT = os.environ.get('AIR_TASKS_CACHE_ROOT',
+                                    '/tmp/air-tasks-cache')
+DEFAULT_BUDGET = 20 * 1024 * 1024 * 1024
+COMPLETE_MARKER = '.complete'
+LOCK_SUFFIX = '.lock'
+ACQUIRE_ATTEMPTS = 3
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def remove_directory(path):
+    """
+    :return: whether the directory is gone
+    """
+    try:
+        shutil.rmtree(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return True
+        logger.warning('Could not remove %s: %s', path, e)
+        return False
+    return True
+
+
+class CacheVolume(object):
+    """
+    :param name: name of the cached data, i.e. ``models``
+    :type name: str
+    :param key: content key, change it whenever the data should change
+        i.e. a version or the url of the data
+    :type key: str
+    :param mount_point: where to mount the cache in the task container
+    :type mount_point: str
+    :param populate_command: command run (in ``populate_image``) to fill
+        ``mount_point`` the first time the entry is needed on a host
+    :type populate_command: str or list
+    :param populate_image: image to populate with, defaults to the task image
+    :type populate_image: str
+    :param budget: bytes the cache root may hold before evicting
+    :type budget: int
+    :param root: cache root on the docker host
+    :type root: str
+    """
+    def __init__(self, name, key, mount_point, populate_command,
+                 populate_image=None, budget=DEFAULT_BUDGET,
+                 root=DEFAULT_CACHE_ROOT):
+        self.name = name
+        self.key = key
+        self.mount_point = mount_point
+        self.populate_command = populate_command
+        self.populate_image = populate_image
+        self.budget = budget
+        self.root = root
+
+    @property
+    def entry(self):
+        digest = hashlib.sha256(str(self.key).encode('utf-8')).hexdigest()
+        return '%s-%s' % (self.name, digest[:16])
+
+    @property
+    def path(self):
+        return os.path.join(self.root, self.entry)
+
+    def bind(self):
+        return '{0}:{1}:ro'.format(self.path, self.mount_point)
+
+    def is_complete(self):
+        return os.path.exists(os.path.join(self.path, COMPLETE_MARKER))
+
+    def acquire(self, populate):
+        """
+        Make sure the entry is populated and return a file holding a shared
+        lock on it. Close the file once the entry is no longer in use.
+
+        :param populate: callable filling the entry directory, only called by
+            the first task on the host
+        """
+        os.makedirs(self.root, exist_ok=True)
+        lock_file = open(self.path + LOCK_SUFFIX, 'a')
+        try:
+            for _ in range(ACQUIRE_ATTEMPTS):
+                # flock does not downgrade atomically, the entry can be
+                # evicted between the exclusive and the shared lock, so it is
+                # only known to be complete while holding the shared lock
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                if self.is_complete():
+                    break
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # someone else may have populated it while we waited
+                if not self.is_complete():
+                    self._populate(populate)
+            else:
+                raise IOError('Cache %s was evicted %d times while acquiring '
+                              'it' % (self.entry, ACQUIRE_ATTEMPTS))
+        except Exception:
+            lock_file.close()
+            raise
+        os.utime(self.path + LOCK_SUFFIX, None)
+        return lock_file
+
+    def _populate(self, populate):
+        logger.info('Populating cache %s (%s)', self.entry, self.key)
+        start = time.time()
+        # leftovers of a failed populate, populating over them would mix
+        # them into the entry
+        if not remove_directory(self.path):
+            raise IOError('Could not clear cache %s' % self.path)
+        os.makedirs(self.path)
+        try:
+            populate(self)
+        except Exception:
+            shutil.rmtree(self.path, ignore_errors=True)
+            raise
+        open(os.path.join(self.path, COMPLETE_MARKER), 'w').close()
+        logger.info('Populated cache %s in %.1fs', self.entry,
+                    time.time() - start)
+        evict(self.root, self.budget, keep=self.entry)
+
+
+def evict(root, budget, keep=None):
+    """
+    Remove least recently used entries until the cache fits the budget.
+    Entries in use (shared locked) or being populated are skipped.
+    """
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.endswith(LOCK_SUFFIX) or name == keep or \
+                not os.path.isdir(path):
+            continue
+        try:
+            last_used = os.path.getmtime(path + LOCK_SUFFIX)
+        except OSError:
+            last_used = os.path.getmtime(path)
+        entries.append((last_used, name, directory_size(path)))
+
+    total = sum(size for _, _, size in entries)
+    if keep is not None:
+        total += directory_size(os.path.join(root, keep))
+
+    for _, name, size in sorted(entries):
+        if total <= budget:
+            break
+        path = os.path.join(root, name)
+        with open(path + LOCK_SUFFIX, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            logger.info('Evicting cache %s (%d bytes)', name, size)
+            # drop the marker first so a crash mid delete is not mistaken for
+            # a complete entry
+            try:
+                os.remove(os.path.join(path, COMPLETE_MARKER))
+            except OSError:
+                pass
+            if remove_directory(path):
+                total -= size
@@ -1,6 +1,6 @@
 from airflow.plugins_manager import AirflowPlugin
-from datetime import datetime
 import logging
+import time
 import types
 import collections
 
@@ -9,6 +9,10 @@ from airflow.models import DagBag
 from airflow.utils.decorators import apply_defaults
 from airflow.utils.state import State
 from airflow import settings
+from custom.fairshare import FairShareDispatcher, PENDING_XCOM_KEY, \
+    make_run_id
+from custom.metrics import get_metrics
+from custom.xcom_store import resolve_xcom
 
 
 class MultiTriggerDagRunOperator(BaseOperator):
@@ -23,6 +27,14 @@ class MultiTriggerDagRunOperator(BaseOperator):
     :param params_list: list of dicts or a thunked generator for DAG level parameters that are made acesssible
         in templates namespaced under params for each dag run.
     :type params: Iterable<dict> or types.GeneratorType
+    :param tenant: release the runs in fair-share batches against this tenant's quota instead of all at once, see
+        custom/fairshare.py
+    :type tenant: str
+    :param share_weight: weight of this fan-out against the tenant's other fan-outs
+    :type share_weight: float
+    :param poll_interval: seconds to wait for capacity when the tenant may not start more runs. The task holds its
+        worker slot while it waits, for as long as the whole fan-out takes to release
+    :type poll_interval: float
     """
 
     @apply_defaults
@@ -30,10 +42,16 @@ class MultiTriggerDagRunOperator(BaseOperator):
             self,
             trigger_dag_id,
             params_list,
+            tenant=None,
+            share_weight=1,
+            poll_interval=30,
             *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.trigger_dag_id = trigger_dag_id
         self.params_list = params_list
+        self.tenant = tenant
+        self.share_weight = share_weight
+        self.poll_interval = poll_interval
 
         if hasattr(self.params_list, '__len__'):
             assert len(self.params_list) > 0
@@ -47,35 +65,68 @@ class MultiTriggerDagRunOperator(BaseOperator):
                  'iterable or generator') % type(generator)
 
     def execute(self, context):
+        metrics = get_metrics()
+        started = time.time()
         session = settings.Session()
         dbag = DagBag(settings.DAGS_FOLDER)
         trigger_dag = dbag.get_dag(self.trigger_dag_id)
 
         assert trigger_dag is not None
 
-        trigger_id = 0
-        for params in self.params_list if not callable(self.params_list) else self.params_list():
-            dr = trigger_dag.create_dagrun(run_id='trig_%s_%d_%s' %
-                                           (self.trigger_dag_id, trigger_id,
-                                            datetime.now().isoformat()),
+        created = 0
+
+        def create(trigger_id, params):
+            nonlocal created
+            dr = trigger_dag.create_dagrun(run_id=make_run_id(self.trigger_dag_id,
+                                                              trigger_id,
+                                                              self.tenant),
                                            state=State.RUNNING,
                                            conf=params,
                                            external_trigger=True)
             logging.info("Creating DagRun {}".format(dr))
             session.add(dr)
-            trigger_id = trigger_id + 1
-            if trigger_id % 10:
+            created += 1
+            if created % 10 == 0:
+                session.commit()
+
+        params_list = self.params_list if not callable(self.params_list) else self.params_list()
+        if self.tenant is None:
+            for trigger_id, params in enumerate(params_list):
+                create(trigger_id, params)
+        else:
+            def publish(pending):
+                # other dispatchers count the runs of this batch as active
                 session.commit()
+                context['ti'].xcom_push(key=PENDING_XCOM_KEY, value=pending)
+
+            FairShareDispatcher(
+                key=(self.dag_id, self.task_id, context['execution_date']),
+                tenant=self.tenant,
+                share_weight=self.share_weight,
+                queues=[task.queue for task in trigger_dag.tasks],
+                publish=publish,
+                poll_interval=self.poll_interval).dispatch(params_list, create)
         session.commit()
         session.close()
 
+        elapsed = time.time() - started
+        metrics.counter('trigger_dag_runs', created,
+                        dag_id=self.trigger_dag_id)
+        metrics.histogram('trigger_seconds', elapsed,
+                          dag_id=self.trigger_dag_id)
+        if elapsed > 0:
+            metrics.gauge('trigger_dag_runs_per_second', created / elapsed,
+                          dag_id=self.trigger_dag_id)
+        metrics.flush()
+
 
 class CustomPlugin(AirflowPlugin):
     name = "custom_plugin"
     operators = [MultiTriggerDagRunOperator]
     hooks = []
     executors = []
-    macros = []
+    # available in templates as macros.custom_plugin.resolve_xcom
+    macros = [resolve_xcom]
     admin_views = []
     flask_blueprints = []
     menu_links = []
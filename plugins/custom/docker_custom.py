@@ -1,20 +1,111 @@
+import ast
 import os
 import json
-from docker import APIClient as Client
+from contextlib import ExitStack
 from airflow.exceptions import AirflowException
+from airflow.models import BaseOperator
 from airflow.plugins_manager import AirflowPlugin
-from airflow.models import Variable
-from airflow.operators.docker_operator import DockerOperator
+from airflow.utils.decorators import apply_defaults
 from airflow.utils.file import TemporaryDirectory
+from custom import admission
+from custom import reaper
+from custom import resources
+from custom import timing
+from custom.variables import get_variables
+from custom.xcom_store import XComStore
 
+# Directory shared with the docker host to write variable files to, i.e.
+# /dev/shm when the worker service bind mounts the host's /dev/shm there, so
+# secrets stay in memory. Every container has a /dev/shm of its own, so this
+# is only used when set. Otherwise files go to the temporary directory.
+VARIABLES_DIR = os.environ.get('AIR_TASKS_VARIABLES_DIR')
 
-class DockerConfigurableOperator(DockerOperator):
+
+class DockerConfigurableOperator(BaseOperator):
     """
-    This is modified from https://github.com/apache/incubator-airflow/blob/1.8.2/airflow/operators/docker_operator.py
+    This is modified from https://github.com/apache/incubator-airflow/blob/1.9.0/airflow/operators/docker_operator.py
     with the exception that we are able to inject container and host arguments
     before the container is run.
+
+    It takes the same arguments as DockerOperator but does not extend it: the
+    docker client is only imported on execute, so loading this plugin (which
+    every airflow process does) does not pay for importing docker.
+
+    Every lifecycle phase (image check, pull, create, start, run, wait...) is
+    timed and the record is handed to ``timing_sinks`` when the task is done.
+    See custom/timing.py for the available sinks.
+
+    While the container runs, ``cli.stats`` is sampled every
+    ``sample_interval`` seconds and a summary of the resources actually used is
+    pushed to XCom (see custom/resources.py) to help right-size ``cpus`` and
+    ``mem_limit``.
+
+    When ``AIR_TASKS_XCOM_DIR`` points at shared storage, pushed output over
+    the ``xcom_store`` threshold, i.e. the logs of a chatty container with
+    ``xcom_all``, is offloaded out of the metadata database and only a
+    reference is pushed (see custom/xcom_store.py). Pull it with
+    ``resolve_xcom``.
+
+    With ``admission_control``, containers are only created once the docker
+    host has room for their ``cpus`` and ``mem_limit`` (see
+    custom/admission.py), tasks wait in a host-wide queue until then.
+
+    :param container_args: extra arguments for create_container
+    :type container_args: dict
+    :param host_args: extra arguments for create_host_config
+    :type host_args: dict
+    :param timing_sinks: where to publish the per-phase timings, defaults to
+        XCom under the key ``docker_timings`` and the metrics backend
+    :type timing_sinks: list
+    :param sample_interval: seconds between resource samples, None disables
+        sampling
+    :type sample_interval: float
+    :param admission_control: wait for the host to have room for the
+        container before creating it, off by default
+    :type admission_control: bool
+    :param cache_volumes: shared, keyed cache directories populated once per
+        host and mounted read-only (see custom/cache.py)
+    :type cache_volumes: list of custom.cache.CacheVolume
+    :param xcom_store: where to offload large pushed output, defaults to the
+        store at ``AIR_TASKS_XCOM_DIR`` (no offloading when it is not set)
+    :type xcom_store: custom.xcom_store.XComStore
     """ # noqa
-    def __init__(self, container_args=None, host_args=None, *args, **kwargs):
+    template_fields = ('command',)
+    template_ext = ('.sh', '.bash',)
+
+    @apply_defaults
+    def __init__(
+            self,
+            image,
+            container_args=None,
+            host_args=None,
+            timing_sinks=None,
+            sample_interval=10,
+            admission_control=False,
+            cache_volumes=None,
+            xcom_store=None,
+            api_version=None,
+            command=None,
+            cpus=1.0,
+            docker_url='unix://var/run/docker.sock',
+            environment=None,
+            force_pull=False,
+            mem_limit=None,
+            network_mode=None,
+            tls_ca_cert=None,
+            tls_client_cert=None,
+            tls_client_key=None,
+            tls_hostname=None,
+            tls_ssl_version=None,
+            tmp_dir='/tmp/airflow',
+            user=None,
+            volumes=None,
+            working_dir=None,
+            xcom_push=False,
+            xcom_all=False,
+            docker_conn_id=None,
+            *args, **kwargs):
+        super().__init__(*args, **kwargs)
         if container_args is None:
             self.container_args = {}
         else:
@@ -24,48 +115,175 @@ class DockerConfigurableOperator(DockerOperator):
             self.host_args = {}
         else:
             self.host_args = host_args
-        super().__init__(*args, **kwargs)
 
-    # This needs to be updated whenever we update to a new version of airflow!
-    def execute(self, context):
-        self.log.info('Starting docker container from image %s', self.image)
+        if timing_sinks is None:
+            self.timing_sinks = [timing.XComTimingSink(),
+                                 timing.MetricsTimingSink()]
+        else:
+            self.timing_sinks = timing_sinks
+        self.sample_interval = sample_interval
+        self.admission_control = admission_control
+        self.cache_volumes = cache_volumes or []
+        self.xcom_store = xcom_store or XComStore()
+        self.timer = None
+        self.sampler = None
+
+        self.api_version = api_version
+        self.command = command
+        self.cpus = cpus
+        self.docker_url = docker_url
+        self.environment = environment or {}
+        self.force_pull = force_pull
+        self.image = image
+        self.mem_limit = mem_limit
+        self.network_mode = network_mode
+        self.tls_ca_cert = tls_ca_cert
+        self.tls_client_cert = tls_client_cert
+        self.tls_client_key = tls_client_key
+        self.tls_hostname = tls_hostname
+        self.tls_ssl_version = tls_ssl_version
+        self.tmp_dir = tmp_dir
+        self.user = user
+        self.volumes = volumes or []
+        self.working_dir = working_dir
+        self.xcom_push_flag = xcom_push
+        self.xcom_all = xcom_all
+        self.docker_conn_id = docker_conn_id
+
+        self.cli = None
+        self.container = None
 
-        tls_config = self._DockerOperator__get_tls_config()
+    def get_hook(self):
+        from airflow.hooks.docker_hook import DockerHook
+        return DockerHook(
+            docker_conn_id=self.docker_conn_id,
+            base_url=self.docker_url,
+            version=self.api_version,
+            tls=self.get_tls_config()
+        )
 
-        if self.docker_conn_id:
-            self.cli = self.get_hook().get_conn()
+    def get_command(self):
+        if self.command is not None and self.command.strip().find('[') == 0:
+            commands = ast.literal_eval(self.command)
         else:
-            self.cli = Client(
-                base_url=self.docker_url,
-                version=self.api_version,
-                tls=tls_config
+            commands = self.command
+        return commands
+
+    def get_tls_config(self):
+        tls_config = None
+        if self.tls_ca_cert and self.tls_client_cert and self.tls_client_key:
+            from docker import tls
+            tls_config = tls.TLSConfig(
+                ca_cert=self.tls_ca_cert,
+                client_cert=(self.tls_client_cert, self.tls_client_key),
+                verify=True,
+                ssl_version=self.tls_ssl_version,
+                assert_hostname=self.tls_hostname
             )
+            self.docker_url = self.docker_url.replace('tcp://', 'https://')
+        return tls_config
+
+    def on_kill(self):
+        if self.cli is not None and self.container is not None:
+            self.log.info('Stopping docker container')
+            self.cli.stop(self.container['Id'])
+
+    def execute(self, context):
+        self.timer = timing.PhaseTimer()
+        try:
+            return self.run_container(context)
+        finally:
+            try:
+                self.cleanup_container(context)
+            finally:
+                self.publish_timings(context)
+
+    def cleanup_container(self, context):
+        """
+        Called once the container is done, whether it succeeded or not
+        """
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.publish_resources(context)
+
+    def publish_resources(self, context):
+        summary = self.sampler.summary(
+            dag_id=self.dag_id,
+            task_id=self.task_id,
+            requested_cpus=self.cpus,
+            requested_mem_limit=self.mem_limit)
+        self.log.info('Docker resource usage: %s', summary)
+        if context and 'ti' in context:
+            context['ti'].xcom_push(key=resources.RESOURCES_XCOM_KEY,
+                                    value=summary)
+
+    def publish_timings(self, context):
+        record = self.timer.record(
+            dag_id=self.dag_id,
+            task_id=self.task_id,
+            execution_date=(context['execution_date'].isoformat()
+                            if context and 'execution_date' in context
+                            else None),
+            image=self.image)
+        self.log.info('Docker phase timings: %s', record)
+        timing.publish(record, context, self.timing_sinks)
+
+    # This needs to be updated whenever we update to a new version of airflow!
+    def run_container(self, context):
+        self.log.info('Starting docker container from image %s', self.image)
+
+        with self.timer.phase('connect'):
+            from docker import APIClient as Client
+            tls_config = self.get_tls_config()
+
+            if self.docker_conn_id:
+                self.cli = self.get_hook().get_conn()
+            else:
+                self.cli = Client(
+                    base_url=self.docker_url,
+                    version=self.api_version,
+                    tls=tls_config
+                )
 
         if ':' not in self.image:
             image = self.image + ':latest'
         else:
             image = self.image
 
-        if self.force_pull or len(self.cli.images(name=image)) == 0:
+        with self.timer.phase('image_check'):
+            missing = self.force_pull or len(self.cli.images(name=image)) == 0
+
+        if missing:
             self.log.info('Pulling docker image %s', image)
-            for l in self.cli.pull(image, stream=True):
-                output = json.loads(l.decode('utf-8'))
-                self.log.info("%s", output['status'])
+            with self.timer.phase('pull'):
+                for l in self.cli.pull(image, stream=True):
+                    output = json.loads(l.decode('utf-8'))
+                    self.timer.track_pull(output)
+                    self.log.info("%s", output['status'])
 
         cpu_shares = int(round(self.cpus * 1024))
 
-        with TemporaryDirectory(prefix='airflowtmp') as host_tmp_dir:
+        with TemporaryDirectory(prefix='airflowtmp') as host_tmp_dir, \
+                ExitStack() as cache_locks:
             self.environment['AIRFLOW_TMP_DIR'] = self.tmp_dir
             self.volumes.append('{0}:{1}'.format(host_tmp_dir, self.tmp_dir))
 
+            # held until the container is done so the entries are not evicted
+            with self.timer.phase('cache'):
+                for volume in self.cache_volumes:
+                    cache_locks.enter_context(volume.acquire(
+                        lambda volume: self.populate_cache(volume, image)))
+
             host_args = {
-                'binds': self.volumes,
+                'binds': self.volumes + [volume.bind()
+                                         for volume in self.cache_volumes],
                 'cpu_shares': cpu_shares,
                 'mem_limit': self.mem_limit,
                 'network_mode': self.network_mode
             }
             host_args.update(self.host_args)
 
+            mem = admission.parse_mem(host_args['mem_limit'])
             container_args = {
                 'command': self.get_command(),
                 'environment': self.environment,
@@ -76,27 +294,80 @@ class DockerConfigurableOperator(DockerOperator):
             }
 
             container_args.update(self.container_args)
+            # label the reservation so admission control can account for it,
+            # the user's labels must not replace it
+            container_args['labels'] = dict(
+                self.container_args.get('labels') or {})
+            container_args['labels'].update(admission.labels(self.cpus, mem))
+
+            with ExitStack() as admitted:
+                if self.admission_control:
+                    with self.timer.phase('admission'):
+                        admitted.enter_context(
+                            admission.AdmissionController(self.cli).admit(
+                                self.cpus, mem))
+
+                with self.timer.phase('create'):
+                    self.container = self.cli.create_container(
+                        **container_args)
 
-            self.container = self.cli.create_container(**container_args)
+                with self.timer.phase('start'):
+                    self.cli.start(self.container['Id'])
 
-            self.cli.start(self.container['Id'])
+            if self.sample_interval:
+                self.sampler = resources.ContainerStatsSampler(
+                    self.cli, self.container['Id'], self.sample_interval)
+                self.sampler.start()
 
             line = ''
-            for line in self.cli.logs(
-                    container=self.container['Id'], stream=True):
-                line = line.strip()
-                if hasattr(line, 'decode'):
-                    line = line.decode('utf-8')
-                self.log.info(line)
-
-            exit_code = self.cli.wait(self.container['Id'])['StatusCode']
+            with self.timer.phase('run'):
+                for line in self.cli.logs(
+                        container=self.container['Id'], stream=True):
+                    line = line.strip()
+                    if hasattr(line, 'decode'):
+                        line = line.decode('utf-8')
+                    self.log.info(line)
+
+            with self.timer.phase('wait'):
+                exit_code = self.cli.wait(self.container['Id'])['StatusCode']
             if exit_code != 0:
                 raise AirflowException('docker container failed')
 
             if self.xcom_push_flag:
-                return self.cli.logs(
-                    container=self.container['Id']) if self.xcom_all else str(
-                        line)
+                with self.timer.phase('xcom'):
+                    return self.xcom_store.offload(self.cli.logs(
+                        container=self.container['Id']) if self.xcom_all
+                        else str(line))
+
+    def populate_cache(self, volume, image):
+        """
+        Fill a cache volume by running its populate command with the cache
+        directory mounted read-write
+        """
+        self.log.info('Populating cache volume %s with %s', volume.entry,
+                      volume.populate_command)
+        populate_image = volume.populate_image or image
+        if len(self.cli.images(name=populate_image)) == 0:
+            for l in self.cli.pull(populate_image, stream=True):
+                self.log.info("%s", json.loads(l.decode('utf-8'))['status'])
+
+        container = self.cli.create_container(
+            command=volume.populate_command,
+            environment=self.environment,
+            host_config=self.cli.create_host_config(
+                binds=['{0}:{1}'.format(volume.path, volume.mount_point)],
+                network_mode=self.network_mode),
+            image=populate_image,
+            user=self.user)
+        try:
+            self.cli.start(container['Id'])
+            for line in self.cli.logs(container=container['Id'], stream=True):
+                self.log.info(line.strip().decode('utf-8'))
+            if self.cli.wait(container['Id'])['StatusCode'] != 0:
+                raise AirflowException('populating cache volume %s failed' %
+                                       volume.entry)
+        finally:
+            self.cli.remove_container(container['Id'], force=True)
 
 
 class DockerRemovableContainer(DockerConfigurableOperator):
@@ -106,44 +377,90 @@ class DockerRemovableContainer(DockerConfigurableOperator):
     AutoRemove is done on docker side and will automatically remove the
     container along with its logs automatically before we can display the logs
     and get the exit code!
+
+    By default removal is handed off to the host's background reaper (see
+    custom/reaper.py) so the task does not wait on the docker daemon. Removable
+    containers are labelled so the reaper can also sweep containers left
+    behind by crashed workers.
+
+    :param remove: remove the container once it has exited
+    :type remove: bool
+    :param reap_async: let the background reaper remove the container instead
+        of removing it before execute returns
+    :type reap_async: bool
     """
     def __init__(self,
                  remove=True,
+                 reap_async=True,
                  *args, **kwargs):
         self.remove = remove
+        self.reap_async = reap_async
         super().__init__(*args, **kwargs)
+        if self.remove:
+            labels = dict(self.container_args.get('labels') or {})
+            labels.setdefault(reaper.REAP_LABEL, 'true')
+            self.container_args = dict(self.container_args, labels=labels)
 
-    def execute(self, context):
-        try:
-            return super().execute(context)
-        finally:
-            if self.cli and self.container and self.remove:
-                self.cli.stop(self.container, timeout=1)
-                self.cli.remove_container(self.container)
+    def can_reap_async(self):
+        # the reaper builds its own plain client, it can not reuse
+        # connection hooks or tls settings
+        return (self.reap_async and not self.docker_conn_id and
+                not self.tls_ca_cert and not self.tls_client_cert)
+
+    def cleanup_container(self, context):
+        super().cleanup_container(context)
+        if self.cli and self.container and self.remove:
+            with self.timer.phase('remove'):
+                if self.can_reap_async():
+                    reaper.submit(self.container['Id'],
+                                  docker_url=self.docker_url,
+                                  api_version=self.api_version)
+                else:
+                    self.cli.stop(self.container, timeout=1)
+                    self.cli.remove_container(self.container)
 
 
 class DockerWithVariablesOperator(DockerRemovableContainer):
+    """
+    Mounts the given airflow variables as files (one per key) in the
+    container. All keys are fetched with a single query (see
+    custom/variables.py). Files are written to
+    ``AIR_TASKS_VARIABLES_DIR`` when it is set, i.e. the host's /dev/shm to
+    keep them off disk.
+
+    :param variables: variable keys to mount
+    :type variables: Iterable<str>
+    :param mount_point: where to mount the variables in the container
+    :type mount_point: str
+    :param variables_dir: host directory to write the variable files to,
+        defaults to ``AIR_TASKS_VARIABLES_DIR``
+    :type variables_dir: str
+    """
     DEFAULT_MOUNT_POINT = '/run/variables'
 
     def __init__(self,
                  variables,
                  mount_point=DEFAULT_MOUNT_POINT,
+                 variables_dir=None,
                  *args, **kwargs):
         self.variables = variables
         self.mount_point = mount_point
+        self.variables_dir = variables_dir
         super().__init__(*args, **kwargs)
 
-    def execute(self, context):
-        with TemporaryDirectory(prefix='dockervariables') as tmp_var_dir:
-            for key in self.variables:
-                value = Variable.get(key)
-                with open(os.path.join(tmp_var_dir, key), 'w') as value_file:
-                    # import pdb
-                    # pdb.set_trace()
-                    value_file.write(value)
+    def run_container(self, context):
+        variables_dir = self.variables_dir or VARIABLES_DIR
+        with TemporaryDirectory(prefix='dockervariables',
+                                dir=variables_dir) as tmp_var_dir:
+            with self.timer.phase('variables'):
+                values = get_variables(self.variables)
+                for key, value in values.items():
+                    with open(os.path.join(tmp_var_dir, key),
+                              'w') as value_file:
+                        value_file.write(value)
             self.volumes.append('{0}:{1}'.format(tmp_var_dir,
                                                  self.mount_point))
-            return super().execute(context)
+            return super().run_container(context)
 
 
 class CustomPlugin(AirflowPlugin):
@@ -0,0 +1,306 @@
+"""
+Fair-share dispatch of triggered dag runs.
+
+Without it a ``MultiTriggerDagRunOperator`` creates every run of its fan-out
+at once, and the tasks of one huge fan-out queue up in front of everybody
+else's. Given a ``tenant``, the operator instead releases its runs in
+batches. Before every batch it works out how many runs its tenant may have
+active right now, from the ``fair_share_quotas`` variable:
+
+    {
+        "capacity": 200,
+        "default": {"weight": 1},
+        "tenants": {
+            "alice": {"weight": 3},
+            "batch": {"weight": 1, "max_active_runs": 50}
+        }
+    }
+
+``capacity`` is how many triggered runs may be active at once across every
+tenant. It is shared out one run at a time to the tenant using the least of
+it relative to its ``weight``, among the tenants with runs still waiting, so
+a tenant with a few runs gets them started right away while a big fan-out
+takes whatever capacity is left over. ``max_active_runs`` caps a tenant even
+when there is capacity to spare. Without ``capacity`` only
+``max_active_runs`` applies.
+
+Fan-outs of the same tenant split the tenant's runs by their
+``share_weight``. Every dispatcher pushes the runs it still holds back to
+XCom (``fair_share_pending``) so the others, and the scaler, know about
+them. The tenant is kept at the end of the run id of every triggered run,
+which is how active runs are counted.
+
+Runs are taken from ``params_list`` lazily, at most ``lookahead`` ahead of
+the ones released, so the pending count of a fan-out larger than that is
+only a lower bound.
+
+The operator keeps its worker slot while it waits for capacity, for as long
+as the whole fan-out takes to release. Its session is committed before every
+wait, so it does not hold a database connection in the meantime.
+"""
+import collections
+import heapq
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from airflow.models import DagRun, XCom
+from airflow.utils.db import provide_session
+from airflow.utils.state import State
+from custom.variables import get_variables
+
+logger = logging.root.getChild(__name__)
+
+QUOTAS_VARIABLE = 'fair_share_quotas'
+PENDING_XCOM_KEY = 'fair_share_pending'
+TENANT_SEPARATOR = '__tenant__'
+# a dispatcher that has not reported for this long is considered gone
+PENDING_TTL = 10 * 60
+
+
+def load_quotas():
+    try:
+        value = get_variables([QUOTAS_VARIABLE])[QUOTAS_VARIABLE]
+    except ValueError:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        logger.error('Variable %s is not valid json, ignoring quotas',
+                     QUOTAS_VARIABLE)
+        return {}
+
+
+def tenant_quota(quotas, tenant):
+    quota = {'weight': 1, 'max_active_runs': None}
+    quota.update(quotas.get('default') or {})
+    quota.update((quotas.get('tenants') or {}).get(tenant) or {})
+    return quota
+
+
+def allowance(quotas, active, waiting):
+    """
+    How many more runs each tenant may start now
+
+    :param quotas: the ``fair_share_quotas`` variable
+    :type quotas: dict
+    :param active: active runs per tenant
+    :type active: dict
+    :param waiting: runs held back per tenant
+    :type waiting: dict
+    :return: runs to start per tenant in ``waiting``
+    :rtype: dict
+    """
+    capacity = quotas.get('capacity')
+    demand = {}
+    for tenant, count in waiting.items():
+        limit = tenant_quota(quotas, tenant)['max_active_runs']
+        if limit is not None:
+            count = min(count, max(limit - active.get(tenant, 0), 0))
+        demand[tenant] = count
+    if capacity is None:
+        return demand
+
+    free = capacity - sum(active.values())
+    granted = dict((tenant, 0) for tenant in demand)
+    # lowest weighted usage first, ties broken by name to stay deterministic
+    heap = [(active.get(tenant, 0) / tenant_quota(quotas, tenant)['weight'],
+             tenant) for tenant, count in demand.items() if count > 0]
+    heapq.heapify(heap)
+    while free > 0 and heap:
+        _, tenant = heapq.heappop(heap)
+        granted[tenant] += 1
+        free -= 1
+        if granted[tenant] < demand[tenant]:
+            usage = active.get(tenant, 0) + granted[tenant]
+            heapq.heappush(heap, (
+                usage / tenant_quota(quotas, tenant)['weight'], tenant))
+    return granted
+
+
+def split(runs, weights):
+    """
+    Split runs between fan-outs by weight, largest remainders first
+
+    :param weights: weight per fan-out
+    :type weights: dict
+    :rtype: dict
+    """
+    total = float(sum(weights.values()))
+    if not total:
+        return dict((key, 0) for key in weights)
+    shares = dict((key, runs * weight / total)
+                  for key, weight in weights.items())
+    result = dict((key, int(share)) for key, share in shares.items())
+    left = runs - sum(result.values())
+    for key in sorted(shares, key=lambda key: (result[key] - shares[key],
+                                               key))[:left]:
+        result[key] += 1
+    return result
+
+
+def make_run_id(dag_id, index, tenant=None, now=None):
+    run_id = 'trig_%s_%d_%s' % (dag_id, index,
+                                (now or datetime.now()).isoformat())
+    if tenant is not None:
+        run_id += TENANT_SEPARATOR + tenant
+    return run_id
+
+
+def run_tenant(run_id):
+    _, separator, tenant = run_id.rpartition(TENANT_SEPARATOR)
+    return tenant if separator else None
+
+
+@provide_session
+def active_runs(session=None):
+    """
+    Active triggered runs per tenant
+    """
+    active = {}
+    run_ids = session.query(DagRun.run_id).filter(
+        DagRun.state == State.RUNNING,
+        DagRun.run_id.like('trig_%' + TENANT_SEPARATOR + '%'))
+    for run_id, in run_ids:
+        tenant = run_tenant(run_id)
+        active[tenant] = active.get(tenant, 0) + 1
+    return active
+
+
+@provide_session
+def pending_fanouts(now=None, session=None):
+    """
+    Runs held back by every dispatcher that reported recently
+
+    :return: {(dag_id, task_id, execution_date): pending record}
+    """
+    now = time.time() if now is None else now
+    # the timestamp column is in database time, only use it to skip rows
+    # that are certainly old
+    cutoff = datetime.now() - timedelta(seconds=PENDING_TTL, days=1)
+    fanouts = {}
+    for xcom in session.query(XCom).filter(XCom.key == PENDING_XCOM_KEY,
+                                           XCom.timestamp >= cutoff):
+        record = xcom.value
+        if isinstance(record, dict) and record.get('pending') and \
+                now - record.get('updated', 0) < PENDING_TTL:
+            fanouts[(xcom.dag_id, xcom.task_id, xcom.execution_date)] = record
+    return fanouts
+
+
+def waiting_by_tenant(fanouts):
+    waiting = {}
+    for record in fanouts.values():
+        waiting[record['tenant']] = (waiting.get(record['tenant'], 0) +
+                                     record['pending'])
+    return waiting
+
+
+def releases(quotas, active, fanouts):
+    """
+    Runs every fan-out may start now
+
+    :return: {fan-out key: runs}
+    """
+    granted = allowance(quotas, active, waiting_by_tenant(fanouts))
+    released = {}
+    for tenant, runs in granted.items():
+        released.update(split(runs, dict(
+            (key, record.get('share_weight', 1))
+            for key, record in fanouts.items()
+            if record['tenant'] == tenant)))
+    return released
+
+
+def releases_by_queue(quotas, active, fanouts):
+    """
+    Runs about to be started per queue their tasks run on, for the scaler
+    """
+    by_queue = {}
+    for key, runs in releases(quotas, active, fanouts).items():
+        for queue in fanouts[key].get('queues') or []:
+            by_queue[queue] = by_queue.get(queue, 0) + runs
+    return by_queue
+
+
+class FairShareDispatcher(object):
+    """
+    Releases one fan-out's runs in batches, see the module docstring
+
+    :param key: identifies the fan-out, the (dag_id, task_id,
+        execution_date) of the trigger task
+    :type key: tuple
+    :param tenant: whose quota the runs count against
+    :type tenant: str
+    :param share_weight: weight against the tenant's other fan-outs
+    :type share_weight: float
+    :param queues: queues the triggered dag's tasks run on
+    :type queues: list of str
+    :param publish: called with the pending record after every batch
+    :type publish: callable
+    :param poll_interval: seconds to wait when no run can be started
+    :type poll_interval: float
+    :param lookahead: runs to take from params_list ahead of the released ones
+    :type lookahead: int
+    """
+    def __init__(self, key, tenant, share_weight=1, queues=(), publish=None,
+                 poll_interval=30, lookahead=1000, clock=time.time,
+                 sleep=time.sleep):
+        self.key = key
+        self.tenant = tenant
+        self.share_weight = share_weight
+        self.queues = sorted(set(queues))
+        self.publish = publish
+        self.poll_interval = poll_interval
+        self.lookahead = lookahead
+        self.clock = clock
+        self.sleep = sleep
+
+    def record(self, pending):
+        return {'tenant': self.tenant, 'share_weight': self.share_weight,
+                'pending': pending, 'queues': self.queues,
+                'updated': self.clock()}
+
+    def report(self, pending):
+        if self.publish is not None:
+            self.publish(self.record(pending))
+
+    def next_batch(self, pending):
+        fanouts = pending_fanouts(now=self.clock())
+        fanouts[self.key] = self.record(pending)
+        return releases(load_quotas(), active_runs(), fanouts)[self.key]
+
+    def dispatch(self, params_list, create):
+        """
+        :param params_list: conf of every run to trigger
+        :type params_list: Iterable<dict>
+        :param create: called with the index and conf of every run to start
+        :type create: callable
+        :return: the number of runs created
+        """
+        params_iter = iter(params_list)
+        pending = collections.deque()
+
+        def look_ahead():
+            # instead of materialising the whole fan-out
+            for params in params_iter:
+                pending.append(params)
+                if len(pending) >= self.lookahead:
+                    break
+
+        look_ahead()
+        index = 0
+        while pending:
+            batch = self.next_batch(len(pending))
+            for _ in range(batch):
+                create(index, pending.popleft())
+                index += 1
+            look_ahead()
+            self.report(len(pending))
+            if batch:
+                logger.info('Released %s runs for %s, %s held back', batch,
+                            self.tenant, len(pending))
+            elif pending:
+                self.sleep(self.poll_interval)
+        return index
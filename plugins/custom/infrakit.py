@@ -0,0 +1,329 @@
+"""
+Scale-to-zero for the infrakit worker groups.
+
+Every queue ``<queue>`` has its workers in the infrakit group
+``workers-<queue>``, defined by the groups json at ``INFRAKIT_GROUPS_URL``.
+A queue without tasks is scaled down according to ``idle`` in the
+``[infrakit]`` section of airflow.cfg:
+
+    - ``standby`` (default): the group stays committed at size 0. Nothing
+      runs, but bringing it back only takes a ``group scale``
+    - ``destroy``: the group is destroyed and has to be committed again
+
+The groups json is cached under ``/tmp/air-tasks-infrakit`` (set
+``AIR_TASKS_INFRAKIT_DIR`` to move it) for ``groups_cache_ttl`` seconds, so
+committing a group does not wait on the network, and still works when the
+url can not be reached.
+
+Queues in standby are only looked at by the scaler once a minute. The
+``ColdStartWatcher`` checks them every ``cold_start_poll_interval`` seconds
+in between and scales a group up as soon as its queue has a message.
+"""
+import errno
+import json
+import logging
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+
+from custom.metrics import get_metrics
+from custom.util import get_option, locked, write_atomic
+
+logger = logging.root.getChild(__name__)
+
+SECTION = 'infrakit'
+DEFAULT_DIRECTORY = os.environ.get('AIR_TASKS_INFRAKIT_DIR',
+                                   '/tmp/air-tasks-infrakit')
+# where the directory is mounted in the infrakit container
+CONTAINER_DIRECTORY = '/air-tasks-infrakit'
+GROUPS_FILE = 'groups.json'
+STANDBY_FILE = 'standby.json'
+DEFAULT_GROUPS_TTL = 24 * 60 * 60
+STANDBY = 'standby'
+DESTROY = 'destroy'
+
+
+def group_name(queue):
+    return 'workers-%s' % queue
+
+
+def fetch_url(url):
+    # imported here so parsing dags does not pay for requests
+    import requests
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+class Infrakit(object):
+    """
+    Runs the infrakit cli in a container, like the manager nodes do
+
+    :param image: infrakit image, defaults to ``INFRAKIT_IMAGE``
+    :type image: str
+    :param groups_url: groups json, defaults to ``INFRAKIT_GROUPS_URL``
+    :type groups_url: str
+    :param idle: ``standby`` or ``destroy``, see the module docstring
+    :type idle: str
+    :param groups_ttl: seconds to reuse the cached groups json for
+    :type groups_ttl: float
+    :param directory: where the groups json and standby queues are kept
+    :type directory: str
+    """
+    def __init__(self, image=None, groups_url=None, idle=None,
+                 groups_ttl=None, directory=DEFAULT_DIRECTORY,
+                 run=subprocess.call, fetch=fetch_url, clock=time.time):
+        self.image = image or os.environ.get('INFRAKIT_IMAGE')
+        self.groups_url = groups_url or os.environ.get('INFRAKIT_GROUPS_URL')
+        self.idle = (idle or
+                     get_option(SECTION, 'idle', STANDBY)).strip().lower()
+        self.groups_ttl = float(
+            groups_ttl if groups_ttl is not None else
+            get_option(SECTION, 'groups_cache_ttl', DEFAULT_GROUPS_TTL))
+        self.directory = directory
+        self.run = run
+        self.fetch = fetch
+        self.clock = clock
+
+    @property
+    def groups_path(self):
+        return os.path.join(self.directory, GROUPS_FILE)
+
+    @property
+    def standby_path(self):
+        return os.path.join(self.directory, STANDBY_FILE)
+
+    def command(self, *args):
+        return [
+            'docker', 'run', '--rm',
+            '-v', '/var/run/docker.sock:/var/run/docker.sock',
+            '-v', '/infrakit/:/infrakit',
+            '-v', '%s:%s:ro' % (self.directory, CONTAINER_DIRECTORY),
+            '-e', 'INFRAKIT_HOME=/infrakit',
+            '-e', 'INFRAKIT_PLUGINS_DIR=/infrakit/plugins',
+            '-e', 'INFRAKIT_HOST=manager-cluster',
+            self.image, 'infrakit'] + list(args)
+
+    def infrakit(self, *args):
+        """
+        :return: whether the command succeeded
+        """
+        return self.run(self.command(*args)) == 0
+
+    def _write(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomic(path, data)
+
+    def cache_groups(self):
+        """
+        Refresh the cached groups json once it is older than groups_ttl
+
+        :return: whether a cached copy is available
+        """
+        try:
+            age = self.clock() - os.stat(self.groups_path).st_mtime
+        except OSError:
+            age = None
+        if age is not None and age < self.groups_ttl:
+            return True
+        try:
+            self._write(self.groups_path, self.fetch(self.groups_url))
+            return True
+        except Exception:
+            if age is None:
+                logger.exception('Could not fetch groups from %s',
+                                 self.groups_url)
+                return False
+            logger.exception('Could not refresh groups from %s, using the '
+                             'copy from %d seconds ago', self.groups_url, age)
+            return True
+
+    def commit_url(self):
+        if self.cache_groups():
+            return 'file://%s/%s' % (CONTAINER_DIRECTORY, GROUPS_FILE)
+        return self.groups_url
+
+    def ensure_group(self, queue):
+        if self.infrakit('group', 'describe', group_name(queue)):
+            return True
+        logger.info('Committing missing group %s', group_name(queue))
+        return self.infrakit('manager', 'commit', self.commit_url())
+
+    @contextmanager
+    def _state(self):
+        """
+        The standby queues and the time each queue was last cold started,
+        held under a lock so the scaler and the cold start watcher do not
+        lose each other's updates
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with locked(self.standby_path):
+            state = self._read_state()
+            yield state
+            self._write(self.standby_path, json.dumps({
+                'standby': sorted(state['standby']),
+                'cold_starts': state['cold_starts'],
+            }).encode('utf-8'))
+
+    def _read_state(self):
+        try:
+            with open(self.standby_path) as f:
+                state = json.load(f)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            state = {}
+        except ValueError:
+            logger.warning('Ignoring unreadable %s', self.standby_path)
+            state = {}
+        return {'standby': set(state.get('standby') or []),
+                'cold_starts': dict(state.get('cold_starts') or {})}
+
+    def standby_queues(self):
+        return self._read_state()['standby']
+
+    def cold_started(self, queue):
+        """
+        :return: when the queue was last cold started, or None
+        """
+        return self._read_state()['cold_starts'].get(queue)
+
+    def scale(self, queue, size, cold_start=False):
+        if not self.ensure_group(queue):
+            logger.error('Group %s could not be committed', group_name(queue))
+            return False
+        if not self.infrakit('group', 'scale', group_name(queue), str(size)):
+            return False
+        with self._state() as state:
+            if size == 0:
+                state['standby'].add(queue)
+            else:
+                state['standby'].discard(queue)
+            if cold_start:
+                state['cold_starts'][queue] = self.clock()
+        return True
+
+    def destroy(self, queue):
+        with self._state() as state:
+            state['standby'].discard(queue)
+        if not self.infrakit('group', 'describe', group_name(queue)):
+            logger.info('Group %s already destroyed', group_name(queue))
+            return True
+        return self.infrakit('group', 'destroy', group_name(queue))
+
+    def idle_size(self, queue, queue_depth=None, measured_at=None):
+        """
+        Size for a queue that had no tasks when its size was measured, None
+        to leave its group alone
+
+        :param queue_depth: returns the messages waiting on a queue now
+        :type queue_depth: callable
+        :param measured_at: when the queue sizes were measured
+        :type measured_at: float
+        """
+        cold_started = self.cold_started(queue)
+        if measured_at is not None and cold_started is not None and \
+                cold_started >= measured_at:
+            logger.info('Group %s was cold started after its size was '
+                        'measured, leaving it', group_name(queue))
+            return None
+        if queue_depth is None:
+            return 0
+        try:
+            return queue_depth(queue)
+        except Exception:
+            logger.exception('Could not check %s again, leaving %s', queue,
+                             group_name(queue))
+            return None
+
+    def rescale(self, queue_sizes, queue_depth=None, measured_at=None):
+        """
+        Scale every queue's group to its size, idle ones according to
+        ``idle``
+
+        :param queue_sizes: tasks waiting per queue
+        :type queue_sizes: dict
+        :param queue_depth: returns the messages waiting on a queue, checked
+            again before scaling a group down to nothing
+        :type queue_depth: callable
+        :param measured_at: when queue_sizes were measured, groups cold
+            started since are not scaled down
+        :type measured_at: float
+        """
+        standby = self.standby_queues()
+        for queue, size in sorted(queue_sizes.items()):
+            if size <= 0:
+                size = self.idle_size(queue, queue_depth, measured_at)
+                if size is None:
+                    continue
+            if size > 0:
+                logger.info('Scaling %s to %s', group_name(queue), size)
+                self.scale(queue, size)
+            elif self.idle == DESTROY:
+                self.destroy(queue)
+            elif queue not in standby:
+                logger.info('Putting %s in standby', group_name(queue))
+                self.scale(queue, 0)
+
+
+class ColdStartWatcher(object):
+    """
+    Scales groups in standby up as soon as their queue has messages
+
+    :param infrakit: the groups to watch
+    :type infrakit: Infrakit
+    :param queue_depth: returns the messages waiting on a queue
+    :type queue_depth: callable
+    :param poll_interval: seconds between checks
+    :type poll_interval: float
+    """
+    def __init__(self, infrakit, queue_depth, poll_interval=None,
+                 clock=time.time, sleep=time.sleep):
+        self.infrakit = infrakit
+        self.queue_depth = queue_depth
+        self.poll_interval = float(
+            poll_interval if poll_interval is not None else
+            get_option(SECTION, 'cold_start_poll_interval', 2))
+        self.clock = clock
+        self.sleep = sleep
+
+    def check(self):
+        """
+        :return: the queues scaled up
+        """
+        started = []
+        for queue in sorted(self.infrakit.standby_queues()):
+            try:
+                depth = self.queue_depth(queue)
+            except Exception:
+                logger.exception('Could not check %s', queue)
+                continue
+            if depth <= 0:
+                continue
+            detected = self.clock()
+            logger.info('Cold starting %s for %s tasks', group_name(queue),
+                        depth)
+            if self.infrakit.scale(queue, depth, cold_start=True):
+                metrics = get_metrics()
+                metrics.counter('scaler_cold_starts', queue=queue)
+                metrics.histogram('scaler_cold_start_seconds',
+                                  self.clock() - detected, queue=queue)
+                started.append(queue)
+        return started
+
+    def watch(self, duration):
+        """
+        Check every poll_interval for duration seconds
+
+        :return: the queues scaled up
+        """
+        deadline = self.clock() + duration
+        started = []
+        while True:
+            started.extend(self.check())
+            if self.clock() + self.poll_interval >= deadline:
+                break
+            self.sleep(self.poll_interval)
+        get_metrics().flush()
+        return started
@@ -0,0 +1,369 @@
+"""
+Counters, gauges and histograms for the scaler, trigger and docker plugins.
+
+Every process gets one ``Metrics`` from ``get_metrics()``, built from the
+``[metrics]`` section of airflow.cfg the first time it is used:
+
+    [metrics]
+    # none, statsd, prometheus_textfile or prometheus_http
+    backend = statsd
+    prefix = air_tasks
+    statsd_host = localhost
+    statsd_port = 8125
+    # prometheus backends
+    textfile_dir = /tmp/air-tasks-metrics
+    http_port = 9108
+
+Recording never blocks and never raises:
+
+    - ``statsd``: one UDP datagram per sample from a non-blocking socket,
+      dropped if it can not be sent right away. Labels are appended to the
+      name, i.e. ``air_tasks.scaler_queue_depth.worker-cpu:3|g``
+    - ``prometheus_textfile``: samples are kept in memory and merged into
+      ``air_tasks.prom`` under ``textfile_dir`` for the node_exporter
+      textfile collector, on ``flush()`` and at most every
+      ``flush_interval`` seconds while recording. Counters and histograms
+      add up across every process of the host sharing the directory.
+    - ``prometheus_http``: the textfile backend, with the merged file also
+      served on ``http_port`` by the first process of the host to bind it.
+      The server is a daemon thread of that process, and every task runs in
+      its own short lived ``airflow run`` process, so most scrapes find
+      nobody serving. Prefer ``prometheus_textfile`` with node_exporter,
+      this backend only suits hosts with a long running process (i.e. the
+      scheduler) that records metrics
+"""
+import atexit
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from custom.util import get_option, locked, write_atomic
+
+logger = logging.root.getChild(__name__)
+
+SECTION = 'metrics'
+DEFAULT_PREFIX = 'air_tasks'
+DEFAULT_TEXTFILE_DIR = '/tmp/air-tasks-metrics'
+DEFAULT_HTTP_PORT = 9108
+TEXTFILE = 'air_tasks.prom'
+# seconds, from a fast api call up to a long image pull
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+                   300, 600)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+def _sanitize(name):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(name))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (key, _escape(labels[key]))
+                    for key in sorted(labels))
+
+
+class NullBackend(object):
+    def record(self, kind, name, value, labels):
+        pass
+
+    def flush(self):
+        pass
+
+
+class StatsdBackend(object):
+    """
+    Sends every sample right away, histograms as statsd ``h`` samples
+    (understood by the prometheus statsd_exporter and DogStatsD)
+    """
+    TYPES = {COUNTER: 'c', GAUGE: 'g', HISTOGRAM: 'h'}
+
+    def __init__(self, host='localhost', port=8125, prefix=DEFAULT_PREFIX):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = None
+        self._pid = None
+
+    @property
+    def socket(self):
+        # a forked child must not share its parent's socket
+        if self._socket is None or self._pid != os.getpid():
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            self._pid = os.getpid()
+        return self._socket
+
+    def line(self, kind, name, value, labels):
+        parts = [self.prefix, name] if self.prefix else [name]
+        parts.extend(_sanitize(labels[key]) for key in sorted(labels))
+        return '%s:%s|%s' % ('.'.join(parts), value, self.TYPES[kind])
+
+    def record(self, kind, name, value, labels):
+        try:
+            self.socket.sendto(
+                self.line(kind, name, value, labels).encode('utf-8'),
+                self.address)
+        except (IOError, OSError, socket.error):
+            pass
+
+    def flush(self):
+        pass
+
+
+class PrometheusTextfileBackend(object):
+    """
+    :param directory: where to write the textfile
+    :type directory: str
+    :param prefix: prepended to every metric name
+    :type prefix: str
+    :param flush_interval: seconds between flushes while recording
+    :type flush_interval: float
+    :param buckets: histogram bucket upper bounds
+    :type buckets: tuple of float
+    """
+    def __init__(self, directory=DEFAULT_TEXTFILE_DIR, prefix=DEFAULT_PREFIX,
+                 flush_interval=10, buckets=DEFAULT_BUCKETS,
+                 clock=time.time):
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.types = {}
+        # (sample name, labels) to (kind, value) not yet in the textfile
+        self.pending = {}
+        self.last_flush = clock()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, TEXTFILE)
+
+    def _add(self, name, labels, kind, value):
+        key = (name, format_labels(labels))
+        if kind == GAUGE or key not in self.pending:
+            self.pending[key] = (kind, value)
+        else:
+            self.pending[key] = (kind, self.pending[key][1] + value)
+
+    def record(self, kind, name, value, labels):
+        name = '%s_%s' % (self.prefix, name) if self.prefix else name
+        with self.lock:
+            self.types[name] = kind
+            if kind == HISTOGRAM:
+                for bound in self.buckets:
+                    self._add(name + '_bucket', dict(labels, le=repr(bound)),
+                              COUNTER, 1 if value <= bound else 0)
+                self._add(name + '_bucket', dict(labels, le='+Inf'),
+                          COUNTER, 1)
+                self._add(name + '_sum', labels, COUNTER, value)
+                self._add(name + '_count', labels, COUNTER, 1)
+            else:
+                self._add(name, labels, kind, value)
+            due = self.clock() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            types = dict(self.types)
+            self.last_flush = self.clock()
+        if not pending:
+            return
+        try:
+            self.merge(pending, types)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write metrics to %s: %s', self.path, e)
+
+    def merge(self, pending, types):
+        """
+        Add pending samples to the ones already in the textfile, holding a
+        lock so processes do not lose each other's updates
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with locked(self.path):
+            samples, file_types = read_textfile(self.path)
+            file_types.update(types)
+            for key, (kind, value) in pending.items():
+                if kind == GAUGE or key not in samples:
+                    samples[key] = value
+                else:
+                    samples[key] += value
+            write_atomic(self.path, format_textfile(samples, file_types))
+
+
+def _family(sample_name, types):
+    for suffix in ('_bucket', '_sum', '_count'):
+        family = sample_name[:-len(suffix)]
+        if sample_name.endswith(suffix) and types.get(family) == HISTOGRAM:
+            return family
+    return sample_name
+
+
+def read_textfile(path):
+    """
+    :return: ({(sample name, labels): value}, {metric name: type})
+    """
+    samples = {}
+    types = {}
+    try:
+        with open(path) as prom_file:
+            lines = prom_file.read().splitlines()
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return samples, types
+    for line in lines:
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ', 3)
+            types[name] = kind
+        elif line and not line.startswith('#'):
+            sample, _, value = line.rpartition(' ')
+            name, _, labels = sample.partition('{')
+            samples[(name, labels[:-1])] = float(value)
+    return samples, types
+
+
+def format_textfile(samples, types):
+    by_family = {}
+    for name, labels in samples:
+        by_family.setdefault(_family(name, types), []).append((name, labels))
+    lines = []
+    for family in sorted(by_family):
+        lines.append('# TYPE %s %s' % (family, types.get(family, 'untyped')))
+        for name, labels in sorted(by_family[family]):
+            lines.append('%s{%s} %r' % (name, labels,
+                                        samples[(name, labels)]))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusHttpBackend(PrometheusTextfileBackend):
+    """
+    Also serves the textfile on ``port``. Processes come and go, so every
+    flush tries to take over serving if nobody on the host is. The port is
+    only served while the process that took it runs, which for a task is
+    seconds, see the module docstring.
+    """
+    def __init__(self, port=DEFAULT_HTTP_PORT, **kwargs):
+        super(PrometheusHttpBackend, self).__init__(**kwargs)
+        self.port = int(port)
+        self.server = None
+
+    def flush(self):
+        super(PrometheusHttpBackend, self).flush()
+        if self.server is None:
+            self.serve()
+
+    def serve(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        path = self.path
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    with open(path, 'rb') as prom_file:
+                        body = prom_file.read()
+                except (IOError, OSError):
+                    body = b''
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = HTTPServer(('', self.port), Handler)
+        except (IOError, OSError, socket.error):
+            return False
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='metrics-http')
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class Metrics(object):
+    """
+    Records samples to a backend, labels are given as keyword arguments:
+
+        metrics.counter('trigger_dag_runs', dag_id='my_dag')
+        metrics.gauge('scaler_queue_depth', 12, queue='worker-gpu')
+        with metrics.timer('docker_pull_seconds', image='alpine'):
+            pull()
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def counter(self, name, value=1, **labels):
+        self.backend.record(COUNTER, name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        self.backend.record(GAUGE, name, value, labels)
+
+    def histogram(self, name, value, **labels):
+        self.backend.record(HISTOGRAM, name, value, labels)
+
+    @contextmanager
+    def timer(self, name, clock=time.time, **labels):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.histogram(name, clock() - start, **labels)
+
+    def flush(self):
+        self.backend.flush()
+
+
+def backend_from_config():
+    backend = get_option(SECTION, 'backend', 'none').strip().lower()
+    prefix = get_option(SECTION, 'prefix', DEFAULT_PREFIX)
+    if backend == 'statsd':
+        return StatsdBackend(
+            host=get_option(SECTION, 'statsd_host', 'localhost'),
+            port=get_option(SECTION, 'statsd_port', 8125), prefix=prefix)
+    textfile_args = {
+        'directory': get_option(SECTION, 'textfile_dir',
+                                DEFAULT_TEXTFILE_DIR),
+        'prefix': prefix,
+        'flush_interval': float(get_option(SECTION, 'flush_interval', 10)),
+    }
+    if backend == 'prometheus_textfile':
+        return PrometheusTextfileBackend(**textfile_args)
+    if backend == 'prometheus_http':
+        return PrometheusHttpBackend(
+            port=get_option(SECTION, 'http_port', DEFAULT_HTTP_PORT),
+            **textfile_args)
+    if backend != 'none':
+        logger.warning('Unknown metrics backend %s, metrics are disabled',
+                       backend)
+    return NullBackend()
+
+
+_metrics = None
+
+
+def get_metrics():
+    """
+    The process' Metrics, built from airflow.cfg on first use
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics(backend_from_config())
+        atexit.register(_metrics.flush)
+    return _metrics
@@ -0,0 +1,322 @@
+"""
+Background removal of exited task containers.
+
+Stopping and removing a container from inside ``execute`` adds seconds to the
+tail of every docker task and keeps the celery slot busy while the daemon does
+its housekeeping. Instead, tasks drop a small spool file describing the
+container into a spool directory and return immediately. A detached reaper
+process (one per host, guarded by a lock file in the spool directory) picks up
+the spool files, removes the containers in parallel batches and retries
+failures with a backoff.
+
+The reaper also periodically sweeps exited containers carrying ``REAP_LABEL``
+that have no spool file. These are left behind by workers that crashed before
+they could hand off their container.
+
+``stop`` asks the reaper of a spool directory to exit, i.e. before the
+directory is removed.
+
+The reaper process runs this module with ``python -m custom.reaper`` from the
+plugins folder, outside of airflow, so it and custom/util.py must only depend
+on the standard library and the docker client.
+"""
+import calendar
+import errno
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from custom.util import try_lock, write_atomic
+
+logger = logging.root.getChild(__name__)
+
+REAP_LABEL = 'air-tasks.reap'
+# /tmp is shared between the host and every worker container, so a spool
+# directory here is shared by every worker using the same docker daemon
+DEFAULT_SPOOL_DIR = os.environ.get('AIR_TASKS_REAPER_DIR',
+                                   '/tmp/air-tasks-reaper')
+DEFAULT_DOCKER_URL = 'unix://var/run/docker.sock'
+LOCK_FILE = 'reaper.lock'
+LOG_FILE = 'reaper.log'
+STOP_FILE = 'reaper.stop'
+SPOOL_SUFFIX = '.json'
+PLUGINS_FOLDER = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))
+
+
+def _list_spool(spool_dir):
+    try:
+        return os.listdir(spool_dir)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            # removed under us, nothing left to reap
+            return []
+        raise
+
+
+def _finished_at(state):
+    """
+    Parse docker's RFC3339 (nanosecond) FinishedAt into epoch seconds
+    """
+    finished = state.get('FinishedAt', '')[:19]
+    try:
+        return calendar.timegm(time.strptime(finished, '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def submit(container_id, docker_url=DEFAULT_DOCKER_URL, api_version=None,
+           stop_timeout=1, spool_dir=DEFAULT_SPOOL_DIR):
+    """
+    Hand the container off to the host reaper, starting the reaper if it is
+    not already running.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    write_atomic(os.path.join(spool_dir, container_id + SPOOL_SUFFIX),
+                 json.dumps({
+                     'id': container_id,
+                     'docker_url': docker_url,
+                     'api_version': api_version,
+                     'stop_timeout': stop_timeout,
+                     'attempts': 0,
+                     'next_attempt': 0,
+                 }))
+    ensure_running(spool_dir)
+
+
+def ensure_running(spool_dir=DEFAULT_SPOOL_DIR):
+    """
+    Start a detached reaper process unless one already holds the lock. Two
+    tasks racing here may both spawn a reaper, the loser exits right away.
+    """
+    lock_file = try_lock(os.path.join(spool_dir, LOCK_FILE))
+    if lock_file is None:
+        return
+    lock_file.close()
+
+    with open(os.path.join(spool_dir, LOG_FILE), 'a') as log_file:
+        subprocess.Popen(
+            [sys.executable, '-m', 'custom.reaper',
+             os.path.abspath(spool_dir)],
+            cwd=PLUGINS_FOLDER,
+            stdin=subprocess.DEVNULL, stdout=log_file, stderr=log_file,
+            close_fds=True, start_new_session=True)
+
+
+def stop(spool_dir=DEFAULT_SPOOL_DIR, timeout=10, poll_interval=0.1):
+    """
+    Ask the reaper of spool_dir to exit and wait for it to let go of its lock.
+
+    :return: whether no reaper is running anymore
+    """
+    stop_path = os.path.join(spool_dir, STOP_FILE)
+    try:
+        open(stop_path, 'a').close()
+        os.utime(stop_path, None)
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            # no spool directory, no reaper
+            return True
+        raise
+    deadline = time.time() + timeout
+    try:
+        while True:
+            lock_file = try_lock(os.path.join(spool_dir, LOCK_FILE))
+            if lock_file is not None:
+                lock_file.close()
+                return True
+            if time.time() >= deadline:
+                logger.warning('Reaper of %s did not stop within %ss',
+                               spool_dir, timeout)
+                return False
+            time.sleep(poll_interval)
+    finally:
+        try:
+            os.remove(stop_path)
+        except OSError:
+            pass
+
+
+class ContainerReaper(object):
+    """
+    Removes containers handed off through the spool directory.
+
+    :param spool_dir: directory to watch for spool files
+    :type spool_dir: str
+    :param batch_size: how many containers to remove in parallel
+    :type batch_size: int
+    :param max_attempts: give up on a container after this many failures,
+        the sweep will still pick it up later
+    :type max_attempts: int
+    :param retry_delay: base delay in seconds, doubled for every failure
+    :type retry_delay: float
+    :param poll_interval: seconds to wait between spool scans when idle
+    :type poll_interval: float
+    :param sweep_interval: seconds between sweeps for orphaned containers
+    :type sweep_interval: float
+    :param sweep_grace: only sweep containers that exited at least this many
+        seconds ago, so we never race a live task still reading logs
+    :type sweep_grace: float
+    :param idle_timeout: exit after this many seconds without work
+    :type idle_timeout: float
+    """
+    def __init__(self, spool_dir=DEFAULT_SPOOL_DIR, batch_size=8,
+                 max_attempts=5, retry_delay=2, poll_interval=0.5,
+                 sweep_interval=300, sweep_grace=600, idle_timeout=900):
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.sweep_grace = sweep_grace
+        self.idle_timeout = idle_timeout
+        self.clients = {}
+
+    def get_client(self, docker_url=DEFAULT_DOCKER_URL, api_version=None):
+        key = (docker_url, api_version)
+        if key not in self.clients:
+            from docker import APIClient as Client
+            self.clients[key] = Client(base_url=docker_url,
+                                       version=api_version)
+        return self.clients[key]
+
+    def pending(self, now=None):
+        """
+        Spool entries that are due for an attempt, oldest first
+        """
+        now = time.time() if now is None else now
+        entries = []
+        for name in _list_spool(self.spool_dir):
+            if not name.endswith(SPOOL_SUFFIX):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path) as spool_file:
+                    job = json.load(spool_file)
+            except (IOError, OSError, ValueError):
+                # vanished or still being written, see you next scan
+                continue
+            if job.get('next_attempt', 0) <= now:
+                entries.append((os.path.getmtime(path), path, job))
+        entries.sort(key=lambda entry: entry[0])
+        return [(path, job) for _, path, job in entries]
+
+    def remove(self, job):
+        """
+        Stop and remove a single container, a container that is already gone
+        counts as removed.
+        """
+        from docker.errors import NotFound
+        cli = self.get_client(job['docker_url'], job.get('api_version'))
+        try:
+            cli.stop(job['id'], timeout=job.get('stop_timeout', 1))
+            cli.remove_container(job['id'])
+        except NotFound:
+            pass
+
+    def _attempt(self, path, job):
+        try:
+            self.remove(job)
+        except Exception as e:
+            job['attempts'] = job.get('attempts', 0) + 1
+            if job['attempts'] >= self.max_attempts:
+                logger.error('Giving up on container %s after %s attempts: %s',
+                             job['id'], job['attempts'], e)
+            else:
+                job['next_attempt'] = (time.time() + self.retry_delay *
+                                       2 ** (job['attempts'] - 1))
+                logger.warning('Failed to remove container %s (attempt %s): '
+                               '%s', job['id'], job['attempts'], e)
+                write_atomic(path, json.dumps(job))
+                return False
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return True
+
+    def reap(self, executor):
+        """
+        Remove one batch of due containers. Returns the number of entries
+        attempted.
+        """
+        batch = self.pending()[:self.batch_size]
+        if batch:
+            list(executor.map(lambda entry: self._attempt(*entry), batch))
+        return len(batch)
+
+    def sweep(self, now=None):
+        """
+        Remove exited containers carrying REAP_LABEL that nobody handed off
+        """
+        now = time.time() if now is None else now
+        spooled = set(name[:-len(SPOOL_SUFFIX)]
+                      for name in _list_spool(self.spool_dir)
+                      if name.endswith(SPOOL_SUFFIX))
+        urls = set(key[0] for key in self.clients) or {DEFAULT_DOCKER_URL}
+        for docker_url in urls:
+            cli = self.get_client(docker_url)
+            for container in cli.containers(
+                    all=True,
+                    filters={'label': REAP_LABEL, 'status': 'exited'}):
+                if container['Id'] in spooled:
+                    continue
+                finished = _finished_at(
+                    cli.inspect_container(container['Id'])['State'])
+                if finished is None or now - finished < self.sweep_grace:
+                    continue
+                logger.info('Sweeping orphaned container %s', container['Id'])
+                try:
+                    self.remove({'id': container['Id'],
+                                 'docker_url': docker_url})
+                except Exception:
+                    logger.exception('Failed to sweep container %s',
+                                     container['Id'])
+
+    def stopping(self, started):
+        """
+        Whether stop was called since the reaper started, an older stop file
+        is left over from a caller that died
+        """
+        try:
+            return os.path.getmtime(
+                os.path.join(self.spool_dir, STOP_FILE)) >= started
+        except OSError:
+            return False
+
+    def run(self):
+        from concurrent.futures import ThreadPoolExecutor
+        lock_file = try_lock(os.path.join(self.spool_dir, LOCK_FILE))
+        if lock_file is None:
+            logger.info('Another reaper is running on %s', self.spool_dir)
+            return
+        logger.info('Reaper %s watching %s', os.getpid(), self.spool_dir)
+        with lock_file, ThreadPoolExecutor(self.batch_size) as executor:
+            started = last_work = time.time()
+            next_sweep = 0
+            while time.time() - last_work < self.idle_timeout:
+                if self.stopping(started):
+                    logger.info('Reaper %s asked to stop', os.getpid())
+                    return
+                if time.time() >= next_sweep:
+                    try:
+                        self.sweep()
+                    except Exception:
+                        logger.exception('Sweep failed')
+                    next_sweep = time.time() + self.sweep_interval
+                if self.reap(executor):
+                    last_work = time.time()
+                else:
+                    time.sleep(self.poll_interval)
+        logger.info('Reaper %s idle, exiting', os.getpid())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] %(process)d %(levelname)s - %(message)s')
+    ContainerReaper(*sys.argv[1:2]).run()
@@ -0,0 +1,206 @@
+"""
+Resource sampling of running task containers.
+
+``ContainerStatsSampler`` polls ``cli.stats`` at a low rate while a container
+runs and summarises what it actually used: peak RSS, average and peak CPU
+(in cores) and block/network I/O. The docker operators push the summary to
+XCom under ``RESOURCES_XCOM_KEY`` and ``recommend`` turns the summaries of many
+runs into ``cpus``/``mem_limit`` suggestions (see
+scripts/docker_resource_report.py).
+"""
+import logging
+import math
+import threading
+import time
+
+logger = logging.root.getChild(__name__)
+
+RESOURCES_XCOM_KEY = 'docker_resources'
+MEGABYTE = 1024 * 1024
+
+
+def memory_rss(memory_stats):
+    """
+    Resident memory excluding page cache (cgroup v1 and v2)
+    """
+    usage = memory_stats.get('usage', 0)
+    stats = memory_stats.get('stats') or {}
+    cache = stats.get('total_inactive_file', stats.get('inactive_file',
+                                                       stats.get('cache', 0)))
+    return max(usage - cache, 0)
+
+
+def io_bytes(stats):
+    """
+    Cumulative (read, write, rx, tx) bytes from a single stats sample
+    """
+    read = write = 0
+    blkio = (stats.get('blkio_stats') or {}).get(
+        'io_service_bytes_recursive') or []
+    for entry in blkio:
+        op = entry.get('op', '').lower()
+        if op == 'read':
+            read += entry.get('value', 0)
+        elif op == 'write':
+            write += entry.get('value', 0)
+    networks = (stats.get('networks') or {}).values()
+    rx = sum(network.get('rx_bytes', 0) for network in networks)
+    tx = sum(network.get('tx_bytes', 0) for network in networks)
+    return read, write, rx, tx
+
+
+class ContainerStatsSampler(object):
+    """
+    Samples ``cli.stats`` every ``interval`` seconds from a daemon thread.
+
+    :param cli: docker api client
+    :param container_id: container to sample
+    :type container_id: str
+    :param interval: seconds between samples
+    :type interval: float
+    :param stop_timeout: seconds ``stop`` waits for an in flight stats call
+    :type stop_timeout: float
+    """
+    def __init__(self, cli, container_id, interval=10, stop_timeout=5,
+                 clock=time.time):
+        self.cli = cli
+        self.container_id = container_id
+        self.interval = interval
+        self.stop_timeout = stop_timeout
+        self.clock = clock
+        self.samples = 0
+        self.peak_rss = 0
+        self.peak_cpu = 0.0
+        self.io = (0, 0, 0, 0)
+        self._first = None
+        self._last = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='stats-%s' % self.container_id)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling. Waits up to stop_timeout for an in flight stats call,
+        which can take a couple of seconds, so it does not land after the
+        summary was taken.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.stop_timeout)
+            if self._thread.is_alive():
+                logger.warning('Stats of %s still sampling after %ss',
+                               self.container_id, self.stop_timeout)
+
+    def _run(self):
+        while True:
+            try:
+                self.add(self.cli.stats(self.container_id, stream=False))
+            except Exception:
+                # stats are best effort, the container may have exited
+                logger.debug('Could not sample %s', self.container_id,
+                             exc_info=True)
+            if self._stopped.wait(self.interval):
+                return
+
+    def add(self, stats, now=None):
+        now = self.clock() if now is None else now
+        memory_stats = stats.get('memory_stats') or {}
+        if not memory_stats:
+            # an exited container reports empty stats
+            return
+        cpu_usage = ((stats.get('cpu_stats') or {}).get('cpu_usage') or {}) \
+            .get('total_usage', 0)
+        with self._lock:
+            self.samples += 1
+            self.peak_rss = max(self.peak_rss, memory_rss(memory_stats))
+            if self._last is not None and now > self._last[0]:
+                cores = ((cpu_usage - self._last[1]) / 1e9 /
+                         (now - self._last[0]))
+                self.peak_cpu = max(self.peak_cpu, cores)
+            if self._first is None:
+                self._first = (now, cpu_usage)
+            self._last = (now, cpu_usage)
+            self.io = io_bytes(stats)
+
+    @property
+    def avg_cpu(self):
+        if self._first is None or self._last[0] <= self._first[0]:
+            return 0.0
+        return ((self._last[1] - self._first[1]) / 1e9 /
+                (self._last[0] - self._first[0]))
+
+    def summary(self, **extra):
+        with self._lock:
+            read, write, rx, tx = self.io
+            summary = {
+                'samples': self.samples,
+                'peak_rss': self.peak_rss,
+                'avg_cpu': self.avg_cpu,
+                'peak_cpu': self.peak_cpu,
+                'blkio_read': read,
+                'blkio_write': write,
+                'net_rx': rx,
+                'net_tx': tx,
+            }
+        summary.update(extra)
+        return summary
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def recommend(summaries, cpu_percentile=95, cpu_headroom=1.2,
+              mem_headroom=1.25, cpu_step=0.25, mem_step=64 * MEGABYTE):
+    """
+    Recommend ``cpus`` and ``mem_limit`` for one task from the summaries of
+    its runs. CPU is sized to a percentile of the per-run average, memory to
+    the largest peak seen, each with some headroom and rounded up.
+
+    A run needs two samples for its average CPU to mean anything, a single
+    sample always reads 0. When no run has two, the result is marked
+    ``insufficient_data`` and has no recommendation rather than the smallest
+    limit.
+
+    :param summaries: summaries produced by ContainerStatsSampler.summary
+    :type summaries: list of dict
+    :return: dict with runs, observed usage and recommendations or None if
+        there is nothing to go on
+    """
+    summaries = [summary for summary in summaries if summary.get('samples')]
+    if not summaries:
+        return None
+    cpu_summaries = [summary for summary in summaries
+                     if summary['samples'] >= 2]
+    peak_rss = max(summary['peak_rss'] for summary in summaries)
+    recommendation = {
+        'runs': len(summaries),
+        'cpu_runs': len(cpu_summaries),
+        'insufficient_data': not cpu_summaries,
+        'peak_rss': peak_rss,
+        'requested_cpus': summaries[-1].get('requested_cpus'),
+        'requested_mem_limit': summaries[-1].get('requested_mem_limit'),
+        'cpus': None,
+        'mem_limit': None,
+    }
+    if not cpu_summaries:
+        return recommendation
+    cpu = _percentile([summary['avg_cpu'] for summary in cpu_summaries],
+                      cpu_percentile)
+    mem = max(mem_step,
+              int(math.ceil(peak_rss * mem_headroom / mem_step)) * mem_step)
+    recommendation.update({
+        'avg_cpu_p%d' % cpu_percentile: cpu,
+        'cpus': max(cpu_step,
+                    math.ceil(cpu * cpu_headroom / cpu_step) * cpu_step),
+        'mem_limit': '%dm' % (mem // MEGABYTE),
+    })
+    return recommendation
@@ -0,0 +1,143 @@
+"""
+Per-phase timing of docker operator lifecycles.
+
+A ``PhaseTimer`` accumulates wall time per named phase (image check, pull,
+create, start, run, wait, remove...) along with the number of bytes pulled.
+Once the task is done the record is handed to each configured sink:
+
+    - ``XComTimingSink``: push the record to XCom (default)
+    - ``MetricsTimingSink``: record histograms with the configured metrics
+      backend, i.e. statsd or prometheus (default, see custom/metrics.py)
+    - ``CsvTimingSink``: append one row per run to a csv file
+"""
+import csv
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from custom.metrics import get_metrics
+
+logger = logging.root.getChild(__name__)
+
+PHASES = ['variables', 'connect', 'image_check', 'pull', 'cache', 'admission',
+          'create', 'start', 'run', 'wait', 'xcom', 'remove']
+
+
+class PhaseTimer(object):
+    """
+    Accumulates wall time per phase. Phases that are entered more than once
+    are summed.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.phases = {}
+        self.bytes_pulled = 0
+        self._layer_bytes = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + self.clock() - start
+
+    def track_pull(self, output):
+        """
+        Track download progress from a single decoded docker pull status
+        """
+        detail = output.get('progressDetail') or {}
+        if output.get('status') == 'Downloading' and 'current' in detail:
+            layer = output.get('id')
+            self._layer_bytes[layer] = max(self._layer_bytes.get(layer, 0),
+                                           detail['current'])
+            self.bytes_pulled = sum(self._layer_bytes.values())
+
+    def record(self, **extra):
+        record = {
+            'phases': dict(self.phases),
+            'bytes_pulled': self.bytes_pulled,
+            'total': self.clock() - self.started,
+        }
+        record.update(extra)
+        return record
+
+
+class XComTimingSink(object):
+    def __init__(self, key='docker_timings'):
+        self.key = key
+
+    def publish(self, record, context):
+        if context and 'ti' in context:
+            context['ti'].xcom_push(key=self.key, value=record)
+
+
+class MetricsTimingSink(object):
+    """
+    Records ``docker_phase_seconds`` per phase, ``docker_start_seconds`` (from
+    the task starting to the container running) and ``docker_pulled_bytes``,
+    labelled with the dag_id.
+
+    :param metrics: defaults to the configured metrics
+    :type metrics: custom.metrics.Metrics
+    :param task_labels: also label with the task_id. Every task then has its
+        own series (and histogram buckets) per phase, only worth it for a
+        handful of tasks.
+    :type task_labels: bool
+    """
+    def __init__(self, metrics=None, task_labels=False):
+        self.metrics = metrics
+        self.task_labels = task_labels
+
+    def publish(self, record, context):
+        metrics = self.metrics or get_metrics()
+        labels = {'dag_id': record.get('dag_id')}
+        if self.task_labels:
+            labels['task_id'] = record.get('task_id')
+        phases = record['phases']
+        for phase, seconds in sorted(phases.items()):
+            metrics.histogram('docker_phase_seconds', seconds, phase=phase,
+                              **labels)
+        if 'start' in phases:
+            metrics.histogram('docker_start_seconds', sum(
+                phases.get(phase, 0)
+                for phase in PHASES[:PHASES.index('run')]), **labels)
+        metrics.counter('docker_pulled_bytes', record['bytes_pulled'],
+                        **labels)
+        metrics.flush()
+
+
+class CsvTimingSink(object):
+    """
+    Appends one row per run to ``path``, writing the header for new files
+    """
+    FIELDS = ['dag_id', 'task_id', 'execution_date', 'image', 'total',
+              'bytes_pulled'] + PHASES
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, record, context):
+        row = dict((field, record.get(field)) for field in self.FIELDS)
+        row.update(record['phases'])
+        is_new = not os.path.exists(self.path)
+        with open(self.path, 'a') as csv_file:
+            writer = csv.DictWriter(csv_file, self.FIELDS,
+                                    extrasaction='ignore')
+            if is_new:
+                writer.writeheader()
+            writer.writerow(row)
+
+
+def publish(record, context, sinks):
+    """
+    Hand record to every sink. Timing is best effort and must never fail the
+    task.
+    """
+    for sink in sinks:
+        try:
+            sink.publish(record, context)
+        except Exception:
+            logger.exception('Failed to publish timings to %s', sink)
@@ -0,0 +1,213 @@
+"""
+Bulk construction of large layered DAGs.
+
+Wiring tasks with ``set_upstream``/``set_downstream`` gets expensive on wide
+DAGs because every call rescans the relatives already registered and walks
+everything downstream looking for cycles. Adding each task to the DAG also
+copies the DAG's whole task list. Together these make construction grow much
+faster than the number of tasks.
+
+``LayeredDagBuilder`` instead builds every layer's operators detached from
+the DAG, adds them to the DAG in one pass and registers the edges between
+consecutive layers directly. Edges only ever point from one layer to the
+next, so the result is acyclic by construction and no cycle check is needed.
+The cost is linear in the number of tasks plus edges.
+
+How consecutive layers are connected is given by a pattern, a callable taking
+the upstream and downstream widths and returning ``(upstream index,
+downstream index)`` pairs:
+
+    - ``all_to_all``: every downstream task depends on every upstream task
+    - ``one_to_one``: downstream task i depends on upstream task i
+    - ``window(*offsets)``: downstream task i depends on upstream tasks
+      ``i + offset``, skipping those that fall outside the upstream layer
+
+This bypasses the public API and relies on private internals of airflow
+1.9.0 (the v1-9-stable branch installed by docker/base): the lists
+``BaseOperator._upstream_task_ids``/``_downstream_task_ids``,
+``BaseOperator._dag``, ``DAG.task_count`` and
+``airflow.models._CONTEXT_MANAGER_DAG``. Check them again when upgrading
+airflow.
+"""
+import itertools
+
+import airflow.models
+from airflow.exceptions import AirflowException
+
+
+def all_to_all(upstream_width, downstream_width):
+    return itertools.product(range(upstream_width), range(downstream_width))
+
+
+def one_to_one(upstream_width, downstream_width):
+    if upstream_width != downstream_width:
+        raise AirflowException(
+            'one_to_one needs layers of the same width, got %s and %s' %
+            (upstream_width, downstream_width))
+    return ((index, index) for index in range(downstream_width))
+
+
+def window(*offsets):
+    """
+    Sliding window pattern, i.e. ``window(-1, 0)`` makes downstream task i
+    depend on upstream tasks i - 1 and i
+
+    :param offsets: offsets into the upstream layer from the downstream index
+    :type offsets: int
+    """
+    offsets = sorted(set(offsets))
+
+    def pattern(upstream_width, downstream_width):
+        for downstream in range(downstream_width):
+            for offset in offsets:
+                upstream = downstream + offset
+                if 0 <= upstream < upstream_width:
+                    yield upstream, downstream
+    return pattern
+
+
+def _add_relatives(task_ids, new_task_ids):
+    # airflow keeps relatives in a list, later versions in a set
+    if isinstance(task_ids, set):
+        task_ids.update(new_task_ids)
+    else:
+        task_ids.extend(new_task_ids)
+
+
+class Layer(object):
+    """
+    A row of similar tasks, only used until the builder builds it
+    """
+    def __init__(self, operator, width, pattern, task_id, per_task, kwargs):
+        self.operator = operator
+        self.width = width
+        self.pattern = pattern
+        self.task_id = task_id
+        self.per_task = per_task
+        self.kwargs = kwargs
+
+
+class LayeredDagBuilder(object):
+    """
+    Builds a DAG one layer at a time, each layer connected to the previous
+    one with a pattern.
+
+        builder = LayeredDagBuilder(dag)
+        builder.add_layer(BashOperator, task_id='begin', bash_command='date')
+        builder.add_layer(BashOperator, width=1000, task_id='work_{index}',
+                          bash_command='echo {{ params.index }}',
+                          per_task=lambda index: {'params': {'index': index}})
+        builder.add_layer(BashOperator, width=1000, pattern=one_to_one,
+                          task_id='check_{index}', bash_command='true')
+        begin, work, check = builder.build()
+
+    :param dag: dag to add the tasks to, its default_args and params are
+        applied to every task as if it was passed to the operator
+    :type dag: airflow.models.DAG
+    """
+    def __init__(self, dag):
+        self.dag = dag
+        self.layers = []
+
+    def add_layer(self, operator, width=1, pattern=all_to_all, task_id=None,
+                  per_task=None, **kwargs):
+        """
+        :param operator: operator class to instantiate for every task
+        :type operator: type
+        :param width: number of tasks in the layer
+        :type width: int
+        :param pattern: how the layer depends on the previous one, ignored for
+            the first layer
+        :type pattern: callable
+        :param task_id: formatted with ``index``, i.e. ``work_{index}``
+        :type task_id: str
+        :param per_task: called with each index, returns extra keyword
+            arguments for that task only
+        :type per_task: callable
+        :param kwargs: keyword arguments passed to every task in the layer
+        """
+        if task_id is None:
+            raise AirflowException('Every layer needs a task_id')
+        self.layers.append(
+            Layer(operator, width, pattern, task_id, per_task, kwargs))
+        return self
+
+    def make_task(self, layer, index):
+        kwargs = dict(layer.kwargs)
+        if layer.per_task is not None:
+            kwargs.update(layer.per_task(index))
+        # the same merge apply_defaults does when given the dag
+        default_args = dict(self.dag.default_args or {})
+        default_args.update(kwargs.pop('default_args', None) or {})
+        params = dict(self.dag.params or {})
+        params.update(kwargs.pop('params', None) or {})
+        params.update(default_args.pop('params', None) or {})
+        return layer.operator(task_id=layer.task_id.format(index=index),
+                              default_args=default_args, params=params,
+                              **kwargs)
+
+    def add_tasks(self, tasks):
+        """
+        Same as DAG.add_task for every task, without copying the dag's task
+        list once per task
+        """
+        dag = self.dag
+        for task in tasks:
+            if task.task_id in dag.task_dict:
+                raise AirflowException('Task %s is already in dag %s' %
+                                       (task.task_id, dag.dag_id))
+            if not dag.start_date and not task.start_date:
+                raise AirflowException('Task is missing the start_date '
+                                       'parameter')
+            elif not task.start_date:
+                task.start_date = dag.start_date
+            elif dag.start_date:
+                task.start_date = max(task.start_date, dag.start_date)
+
+            if not task.end_date:
+                task.end_date = dag.end_date
+            elif dag.end_date:
+                task.end_date = min(task.end_date, dag.end_date)
+
+            dag.task_dict[task.task_id] = task
+            task._dag = dag
+        dag.task_count = len(dag.task_dict)
+
+    @staticmethod
+    def connect(upstream_tasks, downstream_tasks, pattern):
+        upstream_of = [[] for _ in downstream_tasks]
+        downstream_of = [[] for _ in upstream_tasks]
+        for upstream, downstream in pattern(len(upstream_tasks),
+                                            len(downstream_tasks)):
+            upstream_of[downstream].append(upstream_tasks[upstream].task_id)
+            downstream_of[upstream].append(
+                downstream_tasks[downstream].task_id)
+        for task, task_ids in zip(upstream_tasks, downstream_of):
+            _add_relatives(task._downstream_task_ids, task_ids)
+        for task, task_ids in zip(downstream_tasks, upstream_of):
+            _add_relatives(task._upstream_task_ids, task_ids)
+
+    def build(self):
+        """
+        Create every task and edge
+
+        :return: list of layers, each a list of operators
+        """
+        # operators built inside a ``with dag:`` block would otherwise add
+        # themselves to the dag one by one
+        context_dag = airflow.models._CONTEXT_MANAGER_DAG
+        airflow.models._CONTEXT_MANAGER_DAG = None
+        try:
+            built = [[self.make_task(layer, index)
+                      for index in range(layer.width)]
+                     for layer in self.layers]
+        finally:
+            airflow.models._CONTEXT_MANAGER_DAG = context_dag
+
+        for tasks in built:
+            self.add_tasks(tasks)
+        for layer, upstream_tasks, downstream_tasks in zip(
+                self.layers[1:], built, built[1:]):
+            self.connect(upstream_tasks, downstream_tasks, layer.pattern)
+        self.layers = []
+        return built
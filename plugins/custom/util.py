@@ -0,0 +1,67 @@
+"""
+Helpers shared by the plugins and the celery config.
+
+Files shared between the processes of a host are replaced atomically, by
+writing a temporary file next to them and renaming it over, and updated
+under an exclusive ``flock`` of a lock file.
+
+The reaper runs this module outside of airflow, so it must only depend on
+the standard library. airflow's configuration is imported on use.
+"""
+import errno
+import fcntl
+import os
+from contextlib import contextmanager
+
+TMP_SUFFIX = '.tmp'
+LOCK_SUFFIX = '.lock'
+
+
+def get_option(section, key, default):
+    """
+    :return: the option from airflow.cfg, or default when it is not set
+    """
+    from airflow import configuration
+    if configuration.has_option(section, key):
+        return configuration.get(section, key)
+    return default
+
+
+def write_atomic(path, data):
+    """
+    Replace path with data, readers see either the old or the new content
+
+    :param data: str or bytes to write
+    :return: bytes or characters written
+    """
+    tmp_path = '%s.%d%s' % (path, os.getpid(), TMP_SUFFIX)
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+    return len(data)
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on ``path + '.lock'``, waiting for it if needed
+    """
+    with open(path + LOCK_SUFFIX, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def try_lock(path):
+    """
+    Returns an open file holding an exclusive lock on path, or None if the
+    lock is held by someone else.
+    """
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        lock_file.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
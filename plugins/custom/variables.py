@@ -0,0 +1,32 @@
+"""
+Bulk variable lookups.
+
+``Variable.get`` costs one metadata database round trip per key.
+``get_variables`` fetches every requested key in a single query instead.
+Nothing is cached: with the CeleryExecutor every task runs in a fresh
+``airflow run`` process, so a per process cache would never be hit across
+tasks.
+"""
+from airflow.models import Variable
+from airflow.utils.db import provide_session
+
+
+@provide_session
+def get_variables(keys, session=None):
+    """
+    Fetch variables in bulk
+
+    :param keys: variable keys to fetch
+    :type keys: Iterable<str>
+    :return: dict of key to (decrypted) value
+    :raises ValueError: if any of the keys does not exist, like
+        ``Variable.get``
+    """
+    keys = list(keys)
+    values = dict(
+        (variable.key, variable.val) for variable in
+        session.query(Variable).filter(Variable.key.in_(keys)))
+    missing = [key for key in keys if key not in values]
+    if missing:
+        raise ValueError('Variable(s) %s do not exist' % ', '.join(missing))
+    return dict((key, values[key]) for key in keys)
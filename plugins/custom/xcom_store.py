@@ -0,0 +1,185 @@
+"""
+Offloaded storage for large XCom values.
+
+Everything pushed to XCom is pickled into the xcom table of the metadata
+database, so a task returning a whole container log makes the database grow
+and every ``xcom_pull`` of it slow. ``XComStore.offload`` keeps values under
+``threshold`` pickled bytes as they are. Larger values are compressed and
+written to a content-addressed file (named after the sha256 of the pickle)
+under the store directory, and only a small reference dict goes to XCom:
+
+    {'__air_tasks_xcom__': 'sha256:<digest>', 'size': ..., 'stored': ...}
+
+``resolve`` turns a reference back into the value, reading the file through
+mmap, and passes anything else through untouched. Use it wherever an
+offloaded value is pulled, i.e. in templates through the ``resolve_xcom``
+macro:
+
+    {{ macros.custom_plugin.resolve_xcom(task_instance.xcom_pull('task')) }}
+
+Offloading is off unless ``AIR_TASKS_XCOM_DIR`` is set: the store has to be
+a filesystem shared by every worker host, or a task pulling a reference on
+another host can not resolve it. Identical values are only stored once.
+Files not written for ``ttl`` seconds are removed by whichever offload next
+finds that ``gc_interval`` has passed since the last collection.
+"""
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import time
+import zlib
+
+from airflow.exceptions import AirflowException
+from custom.util import try_lock, write_atomic
+
+logger = logging.root.getChild(__name__)
+
+# shared storage for offloaded values, offloading is off without it
+DEFAULT_STORE_DIR = os.environ.get('AIR_TASKS_XCOM_DIR')
+OFFLOAD_THRESHOLD = 64 * 1024
+DEFAULT_THRESHOLD = OFFLOAD_THRESHOLD if DEFAULT_STORE_DIR else None
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_GC_INTERVAL = 60 * 60
+REFERENCE_KEY = '__air_tasks_xcom__'
+DIGEST_PREFIX = 'sha256:'
+GC_LOCK_FILE = '.gc.lock'
+
+
+def is_reference(value):
+    return isinstance(value, dict) and REFERENCE_KEY in value
+
+
+class XComStore(object):
+    """
+    :param root: directory holding the offloaded values, shared by every
+        worker host
+    :type root: str
+    :param threshold: pickled size in bytes from which values are offloaded,
+        None keeps every value in the database
+    :type threshold: int
+    :param ttl: seconds an offloaded value is kept after it was last written
+    :type ttl: float
+    :param gc_interval: minimum seconds between collections
+    :type gc_interval: float
+    :param compress_level: zlib compression level
+    :type compress_level: int
+    """
+    def __init__(self, root=DEFAULT_STORE_DIR, threshold=DEFAULT_THRESHOLD,
+                 ttl=DEFAULT_TTL, gc_interval=DEFAULT_GC_INTERVAL,
+                 compress_level=6):
+        self.root = root
+        self.threshold = threshold
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self.compress_level = compress_level
+
+    def path(self, digest):
+        # shard so no single directory ends up with every value
+        return os.path.join(self.root, digest[:2], digest)
+
+    def offload(self, value):
+        """
+        :return: value itself if it is small enough, else a reference to it
+        """
+        if self.threshold is None or value is None:
+            return value
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.threshold:
+            return value
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            # already stored, refresh it so it outlives the new reference
+            os.utime(path)
+            stored = os.path.getsize(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            stored = self._write(path,
+                                 zlib.compress(data, self.compress_level))
+        self.maybe_gc()
+        return {REFERENCE_KEY: DIGEST_PREFIX + digest, 'size': len(data),
+                'stored': stored}
+
+    def _write(self, path, compressed):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return write_atomic(path, compressed)
+
+    def resolve(self, value):
+        """
+        :return: the value a reference points to, anything else unchanged
+        :raises AirflowException: when the value is no longer in the store
+        """
+        if not is_reference(value):
+            return value
+        digest = value[REFERENCE_KEY][len(DIGEST_PREFIX):]
+        try:
+            with open(self.path(digest), 'rb') as stored_file, \
+                    mmap.mmap(stored_file.fileno(), 0,
+                              access=mmap.ACCESS_READ) as stored:
+                data = zlib.decompress(stored)
+        except (IOError, OSError) as e:
+            raise AirflowException(
+                'Offloaded xcom %s is not in %s, it may have expired: %s' %
+                (value[REFERENCE_KEY], self.root, e))
+        if len(data) != value['size']:
+            raise AirflowException('Offloaded xcom %s is corrupt' %
+                                   value[REFERENCE_KEY])
+        return pickle.loads(data)
+
+    def maybe_gc(self, now=None):
+        """
+        Collect expired values unless that was done less than
+        ``gc_interval`` seconds ago or another process is collecting
+        """
+        now = time.time() if now is None else now
+        lock_path = os.path.join(self.root, GC_LOCK_FILE)
+        try:
+            if now - os.path.getmtime(lock_path) < self.gc_interval:
+                return False
+        except OSError:
+            pass
+        lock_file = try_lock(lock_path)
+        if lock_file is None:
+            return False
+        with lock_file:
+            os.utime(lock_path, (now, now))
+            self.gc(now)
+        return True
+
+    def gc(self, now=None):
+        """
+        Remove values that were not written for ``ttl`` seconds, along with
+        temporary files left behind by crashed writers
+
+        :return: number of files removed
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name == GC_LOCK_FILE:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if now - os.path.getmtime(path) > self.ttl:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        if removed:
+            logger.info('Removed %s expired xcom values from %s', removed,
+                        self.root)
+        return removed
+
+
+def offload(value):
+    return XComStore().offload(value)
+
+
+def resolve_xcom(value):
+    return XComStore().resolve(value)
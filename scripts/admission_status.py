@@ -0,0 +1,15 @@
+"""
+Print the docker host's admission control utilisation as json
+
+    python scripts/admission_status.py [docker_url]
+"""
+import json
+import sys
+
+import airflow  # noqa puts the plugins folder on the path
+from custom.admission import AdmissionController
+from docker import APIClient as Client
+
+docker_url = sys.argv[1] if len(sys.argv) > 1 else 'unix://var/run/docker.sock'
+print(json.dumps(AdmissionController(Client(base_url=docker_url)).utilisation(),
+                 indent=2, sort_keys=True))
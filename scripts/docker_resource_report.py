@@ -0,0 +1,58 @@
+"""
+Aggregate the container resource samples pushed by the docker operators and
+recommend cpus / mem_limit per (dag_id, task_id).
+
+    python scripts/docker_resource_report.py [--days 7] [--dag-id DAG] [--json]
+"""
+import argparse
+import collections
+import json
+from datetime import datetime, timedelta
+
+from airflow import settings
+from airflow.models import XCom
+from custom.resources import RESOURCES_XCOM_KEY, recommend
+
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument('--days', type=int, default=7,
+                    help='only consider runs from the last N days')
+parser.add_argument('--dag-id', help='only report tasks from this dag')
+parser.add_argument('--json', action='store_true',
+                    help='print machine readable json')
+args = parser.parse_args()
+
+session = settings.Session()
+query = (
+    session
+    .query(XCom)
+    .filter(XCom.key == RESOURCES_XCOM_KEY)
+    .filter(XCom.execution_date >= datetime.now() - timedelta(days=args.days))
+)
+if args.dag_id:
+    query = query.filter(XCom.dag_id == args.dag_id)
+
+summaries = collections.defaultdict(list)
+for xcom in query.order_by(XCom.timestamp).yield_per(1000):
+    summaries[(xcom.dag_id, xcom.task_id)].append(xcom.value)
+session.close()
+
+report = []
+for (dag_id, task_id), task_summaries in sorted(summaries.items()):
+    recommendation = recommend(task_summaries)
+    if recommendation is not None:
+        recommendation.update({'dag_id': dag_id, 'task_id': task_id})
+        report.append(recommendation)
+
+if args.json:
+    print(json.dumps(report, indent=2, sort_keys=True))
+else:
+    row = '{:<30} {:<30} {:>5} {:>10} {:>10} {:>8} {:>14} {:>10}'
+    print(row.format('dag_id', 'task_id', 'runs', 'peak_mb', 'req_cpus',
+                     'cpus', 'req_mem_limit', 'mem_limit'))
+    for entry in report:
+        print(row.format(entry['dag_id'], entry['task_id'], entry['runs'],
+                         entry['peak_rss'] // (1024 * 1024),
+                         str(entry['requested_cpus']),
+                         str(entry['cpus'] or 'n/a'),
+                         str(entry['requested_mem_limit']),
+                         entry['mem_limit'] or 'n/a'))
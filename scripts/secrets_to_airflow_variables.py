@@ -1,12 +1,134 @@
+"""
+Sync docker secrets into airflow variables named ``<secret>.secret``.
+
+Every secret is compared with the value of its variable, so only secrets
+that changed, or whose variable was edited or deleted by hand since, are
+written, all in one transaction. An unchanged set of secrets costs a single
+query.
+
+    python secrets_to_airflow_variables.py [--directory DIR] [--watch]
+"""
+import argparse
 import os
+import time
+
+from airflow import settings
 from airflow.models import Variable
+from airflow.utils.db import provide_session
+from sqlalchemy.exc import IntegrityError
+
+
+def variable_key(key):
+    return '%s.secret' % key
+
+
+def read_secrets(directory):
+    secrets = {}
+    if os.path.isdir(directory):
+        for key in os.listdir(directory):
+            path = os.path.join(directory, key)
+            if os.path.isfile(path) and not key.startswith('.'):
+                try:
+                    with open(path, 'r') as f:
+                        secrets[key] = f.read()
+                except FileNotFoundError:
+                    # removed since it was listed
+                    pass
+    return secrets
+
+
+def directory_stamp(directory):
+    """
+    Cheap fingerprint of the directory used to skip reading unchanged
+    secrets while watching
+    """
+    if not os.path.isdir(directory):
+        return None
+    stamp = []
+    for key in sorted(os.listdir(directory)):
+        try:
+            stat = os.stat(os.path.join(directory, key))
+        except FileNotFoundError:
+            # removed since it was listed, the next stamp will differ
+            continue
+        stamp.append((key, stat.st_mtime, stat.st_size, stat.st_ino))
+    return stamp
+
+
+def set_variable(session, key, value, existing):
+    variable = existing.get(key)
+    if variable is None:
+        session.add(Variable(key=key, val=value))
+    else:
+        variable.val = value
+
+
+@provide_session
+def sync(secrets, session=None):
+    """
+    Upsert the secrets whose variable is missing or holds another value
+
+    :return: keys of the secrets that were written
+    """
+    if not secrets:
+        return []
+    existing = dict(
+        (variable.key, variable) for variable in
+        session.query(Variable).filter(
+            Variable.key.in_([variable_key(key) for key in secrets])))
+    changed = sorted(
+        key for key in secrets if variable_key(key) not in existing or
+        existing[variable_key(key)].val != secrets[key])
+    if not changed:
+        session.rollback()
+        return changed
+
+    for key in changed:
+        set_variable(session, variable_key(key), secrets[key], existing)
+    session.commit()
+    return changed
+
+
+def sync_with_retry(secrets, attempts=3):
+    for attempt in range(attempts):
+        try:
+            return sync(secrets)
+        except IntegrityError:
+            # a concurrent sync inserted the same variables, the next attempt
+            # finds them. provide_session leaves the failed scoped session as
+            # it is, start a new one
+            settings.Session.rollback()
+            settings.Session.remove()
+            if attempt == attempts - 1:
+                raise
+
+
+def sync_directory(directory):
+    changed = sync_with_retry(read_secrets(directory))
+    for key in changed:
+        print('Setting key %s as airflow variable: %s' %
+              (key, variable_key(key)))
+    return changed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--directory', default='/run/secrets')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and sync whenever secrets change')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between checks when watching')
+    args = parser.parse_args()
+
+    print('Searching %s' % args.directory)
+    stamp = directory_stamp(args.directory)
+    sync_directory(args.directory)
+    print('Finished setting secrets to airflow variables')
 
-directory = '/run/secrets'
-print('Searching %s' % directory)
-if os.path.isdir(directory):
-    for key in os.listdir(directory):
-        with open(os.path.join(directory, key), 'r') as f:
-            value = f.read()
-        Variable.set('%s.secret' % key, value)
-        print('Setting key %s as airflow variable: %s.secret' % (key, key))
-print('Finished setting secrets to airflow variables')
+    while args.watch:
+        time.sleep(args.interval)
+        new_stamp = directory_stamp(args.directory)
+        if new_stamp != stamp:
+            stamp = new_stamp
+            sync_directory(args.directory)
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+from benchmarks.dag_parse import isolated
+
+
+def exits(code):
+    sys.exit(code)
+
+
+def dies(code):
+    os._exit(code)
+
+
+def parses(dag_file):
+    return {'file': dag_file}
+
+
+class TestIsolated(unittest.TestCase):
+    def test_should_return_result(self):
+        assert isolated(parses, 'a.py') == {'file': 'a.py'}
+
+    def test_should_report_sys_exit(self):
+        assert isolated(exits, 3) == {'error': 'SystemExit(3)'}
+
+    def test_should_report_process_that_died(self):
+        assert isolated(dies, 3) == {
+            'error': 'parse process exited with code 3'}
@@ -0,0 +1,97 @@
+import airflow  # noqa puts the config folder on the path
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from airflow import settings
+from airflow.utils.state import State
+from benchmarks.throughput import prepare, print_summary, query_report, \
+    task_report
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+STARTED = datetime(2017, 5, 1)
+
+# run through the sitecustomize the harness puts on the PYTHONPATH
+QUERIES = '''
+from sqlalchemy import create_engine
+engine = create_engine('sqlite://')
+engine.execute('CREATE TABLE t (a INTEGER)')
+for _ in range(3):
+    engine.execute('SELECT a FROM t')
+'''
+
+
+def at(seconds):
+    return None if seconds is None else STARTED + timedelta(seconds=seconds)
+
+
+def make_task_instance(state, queued, started=None, ended=None):
+    return mock.Mock(dag_id='dag', execution_date=STARTED, state=state,
+                     queued_dttm=at(queued), start_date=at(started),
+                     end_date=at(ended))
+
+
+class TestThroughputReport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.work_dir = os.path.join(self.tmp_dir.name, 'work')
+        os.makedirs(self.work_dir)
+        prepare(self.work_dir)
+        self.queries_dir = os.path.join(self.work_dir, 'queries')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_should_count_queries_per_role(self):
+        for _ in range(2):
+            subprocess.check_call(
+                [sys.executable, '-c', QUERIES],
+                env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+                    [os.path.join(self.work_dir, 'site')] + sys.path)))
+
+        queries = query_report(self.queries_dir, tasks=4)
+        assert queries['roles'] == {'-c': {
+            'processes': 2, 'total': 8,
+            'statements': {'CREATE': 2, 'SELECT': 6}}}
+        assert queries['total'] == 8
+        assert queries['per_task'] == 2.0
+        assert query_report(self.queries_dir, tasks=0)['per_task'] is None
+
+    def test_should_report_tasks(self):
+        task_instances = [
+            make_task_instance(State.SUCCESS, queued=1, started=2, ended=4),
+            make_task_instance(State.FAILED, queued=1, started=4, ended=8),
+            make_task_instance(State.QUEUED, queued=3),
+        ]
+        run = mock.Mock(dag_id='dag', execution_date=STARTED,
+                        start_date=STARTED, state=State.RUNNING)
+        session = mock.MagicMock(name='session')
+        session.query.side_effect = lambda model: mock.Mock(all=mock.Mock(
+            return_value=[run] if model.__name__ == 'DagRun'
+            else task_instances))
+
+        with mock.patch.object(settings, 'Session', return_value=session):
+            report = task_report(STARTED)
+
+        assert report['finished'] == 2
+        assert report['wall'] == 8
+        assert report['tasks_per_second'] == 0.25
+        assert report['dag_runs'] == {'dag': {State.RUNNING: 1}}
+        assert report['queued_to_running']['max_ms'] == 3000
+        assert report['scheduled_to_queued']['max_ms'] == 3000
+
+        report.update({'timed_out': True, 'queries': query_report(
+            self.queries_dir, report['finished'])})
+        out = io.StringIO()
+        print_summary(report, out=out)
+        assert 'timed out' in out.getvalue()
+        assert '2 task instances finished, 0.25 tasks/s' in out.getvalue()
+        assert '0 queries' in out.getvalue()
@@ -0,0 +1,87 @@
+import airflow  # noqa puts the config folder on the path
+import unittest
+from airflow.exceptions import AirflowConfigException
+from kombu import Queue
+from kombu.serialization import dumps, loads
+import celery_serialization
+from celery_serialization import COMPRESSED, EXECUTE_COMMAND, \
+    UNCOMPRESSED, QueueRouter, celery_options, parse_queue_profiles, \
+    register
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+
+def roundtrip(payload, profile):
+    content_type, encoding, body = dumps(payload, serializer=profile)
+    return body, loads(body, content_type, encoding, accept=[content_type])
+
+
+def patch_config(**options):
+    return mock.patch.object(
+        celery_serialization, 'get_option',
+        lambda section, key, default: options.get(key, default))
+
+
+class TestCompressedPickle(unittest.TestCase):
+    def setUp(self):
+        register('pickle-zlib', threshold=100)
+
+    def test_should_not_compress_small_bodies(self):
+        payload = [['airflow run dag task'], {}, {}]
+        body, decoded = roundtrip(payload, 'pickle-zlib')
+        assert body[:1] == UNCOMPRESSED
+        assert decoded == payload
+
+    def test_should_compress_large_bodies(self):
+        payload = {'params': [{'chunk': index} for index in range(1000)]}
+        body, decoded = roundtrip(payload, 'pickle-zlib')
+        assert body[:1] == COMPRESSED
+        assert len(body) < len(dumps(payload, serializer='pickle')[2])
+        assert decoded == payload
+
+
+class TestProfiles(unittest.TestCase):
+    def test_should_reject_unknown_profile(self):
+        with self.assertRaises(AirflowConfigException):
+            register('yaml-gzip')
+
+    def test_should_parse_queue_profiles(self):
+        assert parse_queue_profiles('') == {}
+        assert parse_queue_profiles(
+            'worker-gpu:pickle-zlib, manager : json,') == {
+                'worker-gpu': 'pickle-zlib', 'manager': 'json'}
+
+    def test_should_reject_queue_without_profile(self):
+        with self.assertRaises(AirflowConfigException):
+            parse_queue_profiles('worker-gpu')
+
+    def test_router_should_pick_profile_by_queue(self):
+        router = QueueRouter({'manager': 'json'})
+        assert router(EXECUTE_COMMAND, [], {}, {'queue': 'manager'}) == \
+            {'serializer': 'json'}
+        assert router(EXECUTE_COMMAND, [], {},
+                      {'queue': Queue('manager')}) == {'serializer': 'json'}
+        assert router(EXECUTE_COMMAND, [], {}, {'queue': 'worker'}) is None
+
+    def test_should_default_to_pickle(self):
+        with patch_config():
+            options = celery_options()
+        assert options['task_serializer'] == 'pickle'
+        assert options['result_serializer'] == 'pickle'
+        assert options['accept_content'] == ['json', 'pickle']
+        assert 'task_routes' not in options
+
+    def test_should_route_queue_profiles(self):
+        with patch_config(task_profile='json',
+                          queue_profiles='worker-gpu:pickle-zlib'):
+            options = celery_options()
+        assert options['task_serializer'] == 'json'
+        assert options['accept_content'] == ['json', 'pickle', 'pickle-zlib']
+        assert options['task_annotations'] == {
+            EXECUTE_COMMAND: {'serializer': None}}
+        router, = options['task_routes']
+        assert router(EXECUTE_COMMAND, [], {}, {'queue': 'worker-gpu'}) == \
+            {'serializer': 'pickle-zlib'}
@@ -0,0 +1,126 @@
+import airflow  # noqa puts the config folder on the path
+import time
+import unittest
+from collections import namedtuple
+from resource_autoscaler import MEGABYTE, ResourceAwareAutoscaler, \
+    available_memory
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+QueueDeclareOk = namedtuple('QueueDeclareOk',
+                            ['queue', 'message_count', 'consumer_count'])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class FakeHost(object):
+    def __init__(self):
+        self.load = 0.2
+        self.memory = 4096 * MEGABYTE
+
+
+class FakePool(object):
+    def __init__(self, processes):
+        self.num_processes = processes
+
+    def grow(self, n):
+        self.num_processes += n
+
+    def shrink(self, n):
+        self.num_processes -= n
+
+    def maintain_pool(self):
+        pass
+
+
+def make_worker(depths):
+    worker = mock.MagicMock(name='worker')
+    worker.app.amqp.queues.consume_from = dict(
+        (queue, None) for queue in depths)
+    channel = worker.app.connection_for_read.return_value.default_channel
+    channel.queue_declare.side_effect = \
+        lambda queue, passive: QueueDeclareOk(queue, depths[queue], 1)
+    return worker
+
+
+class TestResourceAwareAutoscaler(unittest.TestCase):
+    def setUp(self):
+        self.host = FakeHost()
+        self.clock = FakeClock()
+        self.depths = {'worker': 0}
+        self.pool = FakePool(1)
+        self.worker = make_worker(self.depths)
+        self.autoscaler = ResourceAwareAutoscaler(
+            self.pool, 4, 1, worker=self.worker, max_load=1.0,
+            shed_load=1.5, min_free_memory=512, queue_check_interval=5,
+            load=lambda: self.host.load, memory=lambda: self.host.memory,
+            clock=self.clock, keepalive=30)
+
+    def scale(self, times=1):
+        for _ in range(times):
+            self.autoscaler.maybe_scale()
+            self.clock.now += 5
+        return self.pool.num_processes
+
+    def test_should_grow_one_process_at_a_time_for_queued_messages(self):
+        self.depths['worker'] = 10
+        assert self.scale() == 2
+        assert self.scale() == 3
+        assert self.scale(5) == 4
+
+    def test_should_not_grow_without_headroom(self):
+        self.depths['worker'] = 10
+        self.host.load = 1.2
+        assert self.scale(3) == 1
+        self.host.load = 0.2
+        self.host.memory = 256 * MEGABYTE
+        assert self.scale(3) == 1
+
+    def test_should_shed_when_overloaded(self):
+        self.depths['worker'] = 10
+        assert self.scale(3) == 4
+        self.host.load = 2.0
+        assert self.scale() == 3
+        assert self.scale(5) == 1
+
+    def test_should_shrink_after_keepalive_once_idle(self):
+        self.depths['worker'] = 10
+        assert self.scale(3) == 4
+        self.depths['worker'] = 0
+        self.autoscaler._last_scale_up = time.monotonic()
+        assert self.scale() == 4
+        self.autoscaler._last_scale_up = time.monotonic() - 60
+        assert self.scale() == 1
+
+    def test_should_cache_queue_depth(self):
+        self.depths['worker'] = 3
+        assert self.autoscaler.queue_depth() == 3
+        self.depths['worker'] = 7
+        assert self.autoscaler.queue_depth() == 3
+        self.clock.now += 5
+        assert self.autoscaler.queue_depth() == 7
+
+    def test_should_survive_broker_errors(self):
+        self.worker.app.connection_for_read.side_effect = IOError('down')
+        assert self.autoscaler.queue_depth() == 0
+        assert self.autoscaler._connection is None
+
+
+class TestAvailableMemory(unittest.TestCase):
+    def test_should_read_meminfo(self):
+        with mock.patch('resource_autoscaler.open', mock.mock_open(
+                read_data='MemTotal: 100 kB\nMemAvailable: 50 kB\n'),
+                create=True):
+            assert available_memory() == 50 * 1024
+
+    def test_should_handle_missing_meminfo(self):
+        assert available_memory('/nonexistent/meminfo') is None
@@ -0,0 +1,95 @@
+import airflow  # noqa puts the config folder on the path
+import unittest
+import worker_profiles
+from celery_serialization import EXECUTE_COMMAND
+from worker_profiles import apply_profile, apply_queue_profile, \
+    concurrency_given, parse_autoscale, queue_profile
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+CONFIG = {
+    'celery_worker_docker': {'concurrency': '1', 'prefetch_multiplier': '1',
+                             'acks_late': 'True'},
+    'celery_worker_short': {'prefetch_multiplier': '8', 'acks_late': 'False',
+                            'autoscale': '6,2'},
+}
+
+
+def patch_config(config=CONFIG):
+    configuration = mock.MagicMock(name='configuration')
+    configuration.has_option.side_effect = \
+        lambda section, key: key in config.get(section, {})
+    configuration.get.side_effect = lambda section, key: config[section][key]
+    return mock.patch.object(worker_profiles, 'configuration', configuration)
+
+
+def make_worker(queues):
+    worker = mock.MagicMock(name='worker')
+    worker.concurrency = 1
+    worker.prefetch_multiplier = 1
+    worker.options = {}
+    worker.app.amqp.queues.consume_from = dict((queue, None)
+                                               for queue in queues)
+    task = mock.MagicMock(name='execute_command')
+    task.acks_late = True
+    worker.app.tasks = {EXECUTE_COMMAND: task}
+    return worker
+
+
+class TestWorkerProfiles(unittest.TestCase):
+    def test_should_parse_autoscale(self):
+        assert parse_autoscale('8,1') == [8, 1]
+        assert parse_autoscale('8') == [8, 0]
+
+    def test_should_pick_first_queue_with_profile(self):
+        with patch_config():
+            assert queue_profile(['other', 'short', 'docker']) == (
+                'short', {'prefetch_multiplier': 8, 'acks_late': False,
+                          'autoscale': [6, 2]})
+            assert queue_profile(['other']) == (None, {})
+
+    def test_should_apply_profile(self):
+        worker = make_worker(['short'])
+        apply_profile(worker, {'concurrency': 3, 'prefetch_multiplier': 8,
+                               'acks_late': False, 'autoscale': [6, 2]},
+                      argv=['airflow', 'worker', '-q', 'short'])
+        assert worker.concurrency == 3
+        assert worker.prefetch_multiplier == 8
+        assert worker.options['autoscale'] == [6, 2]
+        assert worker.app.conf.task_acks_late is False
+        assert worker.app.tasks[EXECUTE_COMMAND].acks_late is False
+
+    def test_should_keep_concurrency_from_command_line(self):
+        assert concurrency_given(['airflow', 'worker', '--concurrency', '4'])
+        assert concurrency_given(['airflow', 'worker', '--concurrency=4'])
+        assert concurrency_given(['airflow', 'worker', '-c4'])
+        assert not concurrency_given(['airflow', 'worker', '-cn', 'host'])
+        assert not concurrency_given(['airflow', 'worker', '-q', 'c'])
+
+        worker = make_worker(['short'])
+        worker.concurrency = 4
+        apply_profile(worker, {'concurrency': 1, 'prefetch_multiplier': 8},
+                      argv=['airflow', 'worker', '-c', '4'])
+        assert worker.concurrency == 4
+        assert worker.prefetch_multiplier == 8
+
+    def test_should_apply_profile_of_consumed_queue(self):
+        worker = make_worker(['docker'])
+        worker.concurrency = 16
+        with patch_config(), mock.patch.object(worker_profiles.sys, 'argv',
+                                               ['airflow', 'worker']):
+            apply_queue_profile(sender=worker)
+        assert worker.concurrency == 1
+        assert worker.prefetch_multiplier == 1
+        assert 'autoscale' not in worker.options
+        assert worker.app.tasks[EXECUTE_COMMAND].acks_late is True
+
+    def test_should_leave_workers_without_profile_alone(self):
+        worker = make_worker(['other'])
+        with patch_config():
+            apply_queue_profile(sender=worker)
+        assert worker.prefetch_multiplier == 1
+        assert worker.options == {}
@@ -0,0 +1,31 @@
+import glob
+import os
+import unittest
+from airflow import settings
+from tests.utils.import_time import budget_us, import_cost
+
+# imports a dag file adds on top of airflow and the plugins, the scheduler
+# pays this on every parse. Milliseconds per dag file, None is the default
+DAG_BUDGETS_MS = {
+    None: 100,
+    # loads the fair share, infrakit, metrics and xcom store plugins
+    'scaler.py': 150,
+}
+LAZY_MODULES = ['docker', 'requests']
+
+
+class TestDagImportTime(unittest.TestCase):
+    def test_dags_should_import_lazily(self):
+        dag_files = sorted(glob.glob(
+            os.path.join(settings.DAGS_FOLDER, '**', '*.py'), recursive=True))
+        assert dag_files
+
+        for dag_file in dag_files:
+            cost, modules = import_cost(
+                'import runpy; runpy.run_path(%r)' % dag_file)
+            for module in LAZY_MODULES:
+                assert module not in modules, \
+                    '%s imports %s at parse time' % (dag_file, module)
+            budget = budget_us(DAG_BUDGETS_MS, os.path.basename(dag_file))
+            assert cost <= budget, \
+                '%s imports took %dus, budget %dus' % (dag_file, cost, budget)
@@ -0,0 +1,44 @@
+import io
+import os
+import unittest
+from airflow import settings
+from benchmarks.dag_parse import print_summary, profile_folder
+from tests.utils.import_time import budget_us
+
+# the scheduler re-parses every file continuously, keep each one cheap.
+# Milliseconds per dag file, None is the default
+PARSE_BUDGETS_MS = {
+    None: 2000,
+}
+
+
+class TestDagParseCost(unittest.TestCase):
+    def test_dags_should_parse_within_budget(self):
+        report = profile_folder(settings.DAGS_FOLDER, repeat=1, hotspots=5)
+        assert report['files']
+
+        for entry in report['files']:
+            assert 'error' not in entry, entry
+            assert not entry['import_errors'], entry['import_errors']
+            assert entry['dags'] > 0, '%s defines no dags' % entry['file']
+            assert 'peak_error' not in entry, entry['peak_error']
+            assert 'hotspots_error' not in entry, entry['hotspots_error']
+            assert entry['peak_bytes'] > 0
+            assert entry['hotspots']
+            budget = budget_us(PARSE_BUDGETS_MS,
+                               os.path.basename(entry['file']))
+            assert entry['max'] * 1e6 <= budget, \
+                '%s took %.0fms to parse, hotspot %s' % (
+                    entry['file'], entry['max'] * 1000,
+                    entry['hotspots'][0]['function'])
+
+    def test_should_summarise_failed_extra_parses(self):
+        out = io.StringIO()
+        print_summary({'dags_folder': '/dags', 'files': [
+            {'file': '/dags/a.py', 'error': 'ImportError()'},
+            {'file': '/dags/b.py', 'tasks': 1, 'mean': 0.1, 'stdev': 0.0,
+             'peak_error': 'MemoryError()', 'hotspots_error': 'OSError()'},
+        ]}, out=out)
+        assert 'tracing failed: MemoryError()' in out.getvalue()
+        assert 'profiling failed: OSError()' in out.getvalue()
+        assert '/dags/a.py failed: ImportError()' in out.getvalue()
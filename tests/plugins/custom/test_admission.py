@@ -0,0 +1,89 @@
+import airflow  # noqa puts the plugins folder on the path
+import os
+import tempfile
+import unittest
+from custom.admission import AdmissionController, CPUS_LABEL, MEM_LABEL, \
+    labels
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+GIGABYTE = 1024 * 1024 * 1024
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+def make_cli(running=()):
+    cli = mock.MagicMock(name='APIClient')
+    cli.info.return_value = {'NCPU': 4, 'MemTotal': 8 * GIGABYTE}
+    cli.containers.return_value = [
+        {'Labels': labels(cpus, mem)} for cpus, mem in running]
+    return cli
+
+
+def make_ticket(name, cpus, mem=0):
+    return {'id': name, 'cpus': cpus, 'mem': mem}
+
+
+class TestAdmissionController(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.ledger = os.path.join(self.tmp_dir.name, 'ledger.json')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_controller(self, cli):
+        return AdmissionController(cli, ledger_path=self.ledger,
+                                   reserved_cpus=0, reserved_mem=0,
+                                   clock=self.clock)
+
+    def test_should_label_reservations(self):
+        assert labels(1.5, 1024) == {CPUS_LABEL: '1.5', MEM_LABEL: '1024'}
+
+    def test_should_admit_when_it_fits(self):
+        controller = self.make_controller(make_cli(running=[(2, GIGABYTE)]))
+        assert controller.try_admit(make_ticket('a', 2, GIGABYTE))
+        # a's reservation is held until it releases
+        assert not controller.try_admit(make_ticket('b', 1))
+        controller.release(make_ticket('a', 2))
+        assert controller.try_admit(make_ticket('b', 1))
+
+    def test_should_admit_in_order(self):
+        controller = self.make_controller(make_cli(running=[(3, 0)]))
+        big = make_ticket('big', 2)
+        small = make_ticket('small', 1)
+        assert not controller.try_admit(big)
+        # small would fit but big is first in line
+        assert not controller.try_admit(small)
+        controller.release(big)
+        assert controller.try_admit(small)
+
+    def test_should_expire_abandoned_tickets(self):
+        controller = self.make_controller(make_cli(running=[(4, 0)]))
+        assert not controller.try_admit(make_ticket('crashed', 1))
+        self.clock.now += controller.ticket_ttl
+        assert controller.utilisation()['waiting'] == 0
+
+    def test_should_admit_oversized_request_on_idle_host(self):
+        controller = self.make_controller(make_cli())
+        assert controller.try_admit(make_ticket('huge', 16, 64 * GIGABYTE))
+
+    def test_should_report_utilisation(self):
+        controller = self.make_controller(make_cli(running=[(1, GIGABYTE)]))
+        with controller.admit(1, '1g'):
+            utilisation = controller.utilisation()
+        assert utilisation['reserved_cpus'] == 2
+        assert utilisation['reserved_mem'] == 2 * GIGABYTE
+        assert utilisation['cpu_utilisation'] == 0.5
+        assert utilisation['waiting'] == 0
+        assert controller.utilisation()['reserved_cpus'] == 1
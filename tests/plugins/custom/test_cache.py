@@ -0,0 +1,114 @@
+import airflow  # noqa puts the plugins folder on the path
+import fcntl
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import custom.cache
+from custom.cache import CacheVolume, evict, LOCK_SUFFIX, COMPLETE_MARKER
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+class TestCacheVolume(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.populated = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_volume(self, name='data', key='v1', budget=1000):
+        return CacheVolume(name, key, '/data', 'true', budget=budget,
+                           root=self.root)
+
+    def populate(self, volume):
+        self.populated.append(volume.entry)
+        write_file(os.path.join(volume.path, 'payload'), 100)
+
+    def test_should_key_entries_by_content_key(self):
+        assert self.make_volume(key='v1').entry != \
+            self.make_volume(key='v2').entry
+        assert self.make_volume().bind().endswith(':/data:ro')
+
+    def test_should_populate_once(self):
+        volume = self.make_volume()
+        volume.acquire(self.populate).close()
+        volume.acquire(self.populate).close()
+        assert self.populated == [volume.entry]
+        assert volume.is_complete()
+
+    def test_should_clean_up_failed_populate(self):
+        volume = self.make_volume()
+
+        def fail(volume):
+            raise IOError()
+
+        with self.assertRaises(IOError):
+            volume.acquire(fail)
+        assert not os.path.exists(volume.path)
+        volume.acquire(self.populate).close()
+        assert self.populated == [volume.entry]
+
+    def test_should_populate_again_when_evicted_before_shared_lock(self):
+        volume = self.make_volume()
+        flock = fcntl.flock
+        evicted = []
+
+        def evicting_flock(lock_file, operation):
+            # another task evicts the entry once it is populated and the
+            # exclusive lock released
+            if operation == fcntl.LOCK_SH and volume.is_complete() and \
+                    not evicted:
+                evicted.append(True)
+                os.remove(os.path.join(volume.path, COMPLETE_MARKER))
+            return flock(lock_file, operation)
+
+        with mock.patch.object(custom.cache.fcntl, 'flock',
+                               side_effect=evicting_flock):
+            volume.acquire(self.populate).close()
+        assert self.populated == [volume.entry, volume.entry]
+        assert volume.is_complete()
+
+    def test_should_only_count_removed_entries(self):
+        old = self.make_volume('old')
+        new = self.make_volume('new')
+        old.acquire(self.populate).close()
+        new.acquire(self.populate).close()
+        os.utime(old.path + LOCK_SUFFIX, (0, 0))
+        os.utime(new.path + LOCK_SUFFIX, (1, 1))
+
+        with mock.patch.object(custom.cache, 'remove_directory',
+                               side_effect=[False, True]) as remove:
+            evict(self.root, 150)
+        assert remove.call_args_list == [mock.call(old.path),
+                                         mock.call(new.path)]
+
+    def test_should_evict_least_recently_used(self):
+        old = self.make_volume('old')
+        used = self.make_volume('used')
+        old.acquire(self.populate).close()
+        used.acquire(self.populate).close()
+        os.utime(old.path + LOCK_SUFFIX, (0, 0))
+        os.utime(used.path + LOCK_SUFFIX, (1, 1))
+
+        evict(self.root, 150)
+
+        assert not os.path.exists(old.path)
+        assert used.is_complete()
+
+    def test_should_not_evict_entries_in_use(self):
+        in_use = self.make_volume('in_use')
+        lock = in_use.acquire(self.populate)
+        try:
+            evict(self.root, 0)
+            assert in_use.is_complete()
+        finally:
+            lock.close()
+        evict(self.root, 0)
+        assert not in_use.is_complete()
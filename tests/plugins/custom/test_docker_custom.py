@@ -1,6 +1,11 @@
 from airflow.operators.docker_plugin import DockerRemovableContainer
 from airflow.operators.docker_plugin import DockerWithVariablesOperator
+from custom.admission import CPUS_LABEL
+from custom.reaper import REAP_LABEL
+import os
+import time
 import unittest
+from tempfile import TemporaryDirectory, gettempdir
 from tests.utils.mock_helpers import patch_plugin_file
 from datetime import datetime, timedelta
 from docker.errors import NotFound, APIError
@@ -15,6 +20,7 @@ DAG_ARGS = {
     'retry_exponential_backoff': True,
 }
 TASK_ID = 'test_docker_with_variables'
+REAPER_WAIT_SECONDS = 30
 IMAGE = 'alpine:latest'
 MOUNT_POINT = '/run/secret'
 COMMAND_CHECK_MOUNT_TEMPLATE = 'sh -c "mount | grep %s > /dev/null && ls %s"'
@@ -33,6 +39,13 @@ DEFAULT_VARIABLES = {
 }
 
 
+def get_default_variables(keys):
+    missing = [key for key in keys if key not in DEFAULT_VARIABLES]
+    if missing:
+        raise ValueError('Variable(s) %s do not exist' % ', '.join(missing))
+    return dict((key, DEFAULT_VARIABLES[key]) for key in keys)
+
+
 def variables_to_show_items(variables):
     show_items_builder = []
     for key in sorted(DEFAULT_VARIABLES):
@@ -76,6 +89,19 @@ class TestDockerConfigurableOperator(unittest.TestCase):
             )
         assert '%s\n' % NEW_TEXT == operator.execute(None).decode('utf-8')
 
+    def test_should_time_phases(self):
+        operator = DockerRemovableContainer(
+            task_id=TASK_ID,
+            default_args=DAG_ARGS,
+            image=IMAGE,
+            command='echo timed',
+            )
+        operator.execute(None)
+
+        for phase in ['connect', 'image_check', 'create', 'start', 'run',
+                      'wait', 'remove']:
+            assert phase in operator.timer.phases
+
 
 class TestDockerRemovableContainer(unittest.TestCase):
     def test_should_keep_container(self):
@@ -105,6 +131,28 @@ class TestDockerRemovableContainer(unittest.TestCase):
             )
         operator.execute(None)
 
+        try:
+            with self.assertRaises(NotFound):
+                # removal is handed off to the reaper, give it a moment
+                for _ in range(REAPER_WAIT_SECONDS * 10):
+                    operator.cli.inspect_container(operator.container)
+                    time.sleep(0.1)
+        finally:
+            try:
+                operator.cli.remove_container(operator.container)
+            except Exception:
+                pass
+
+    def test_should_remove_container_synchronously(self):
+        operator = DockerRemovableContainer(
+            task_id=TASK_ID,
+            default_args=DAG_ARGS,
+            image=IMAGE,
+            reap_async=False,
+            command='echo should remove before returning'
+            )
+        operator.execute(None)
+
         try:
             with self.assertRaises(NotFound):
                 operator.cli.inspect_container(operator.container)
@@ -114,6 +162,46 @@ class TestDockerRemovableContainer(unittest.TestCase):
             except Exception:
                 pass
 
+    def test_should_label_removable_container(self):
+        operator = DockerRemovableContainer(
+            task_id=TASK_ID,
+            default_args=DAG_ARGS,
+            image=IMAGE,
+            container_args={'labels': {'keep': 'me'}},
+            command='echo labels'
+            )
+        assert operator.container_args['labels'] == {
+            'keep': 'me', REAP_LABEL: 'true'}
+
+    def test_should_not_label_kept_container(self):
+        operator = DockerRemovableContainer(
+            task_id=TASK_ID,
+            default_args=DAG_ARGS,
+            image=IMAGE,
+            remove=False,
+            command='echo labels'
+            )
+        assert 'labels' not in operator.container_args
+
+    def test_should_keep_reservation_labels(self):
+        operator = DockerRemovableContainer(
+            task_id=TASK_ID,
+            default_args=DAG_ARGS,
+            image=IMAGE,
+            cpus=0.5,
+            remove=False,
+            container_args={'labels': {CPUS_LABEL: '0', 'keep': 'me'}},
+            command='echo labels'
+            )
+        operator.execute(None)
+        try:
+            labels = operator.cli.inspect_container(
+                operator.container)['Config']['Labels']
+            assert labels['keep'] == 'me'
+            assert labels[CPUS_LABEL] == '0.5'
+        finally:
+            operator.cli.remove_container(operator.container)
+
 
 class TestDockerWithVariables(unittest.TestCase):
     def test_should_mount_and_be_empty_with_default_mount_point(self):
@@ -149,9 +237,10 @@ class TestDockerWithVariables(unittest.TestCase):
         assert operator.task_id == TASK_ID
         assert not items  # mount was found but check to make sure it's empty
 
-    @patch_plugin_file('plugins/custom/docker', 'Variable', autospec=True)
-    def test_should_find_variables(self, variable_class):
-        variable_class.get.side_effect = DEFAULT_VARIABLES.__getitem__
+    @patch_plugin_file('plugins/custom/docker', 'get_variables',
+                       autospec=True)
+    def test_should_find_variables(self, get_variables):
+        get_variables.side_effect = get_default_variables
 
         operator = DockerWithVariablesOperator(
             variables=DEFAULT_VARIABLES.keys(),
@@ -171,9 +260,10 @@ class TestDockerWithVariables(unittest.TestCase):
         assert str(show_items, 'utf-8') == variables_to_show_items(
             DEFAULT_VARIABLES)
 
-    @patch_plugin_file('plugins/custom/docker', 'Variable', autospec=True)
-    def test_should_fail_when_variable_not_found(self, variable_class):
-        variable_class.get.side_effect = DEFAULT_VARIABLES.__getitem__
+    @patch_plugin_file('plugins/custom/docker', 'get_variables',
+                       autospec=True)
+    def test_should_fail_when_variable_not_found(self, get_variables):
+        get_variables.side_effect = get_default_variables
 
         bad_keys = list(DEFAULT_VARIABLES.keys())
         bad_keys.append('bad_key')
@@ -189,5 +279,46 @@ class TestDockerWithVariables(unittest.TestCase):
             command='ls'
         )
 
-        with self.assertRaises(KeyError):
+        with self.assertRaises(ValueError):
             operator.execute(None)
+
+    @patch_plugin_file('plugins/custom/docker', 'get_variables',
+                       autospec=True)
+    def test_should_write_variables_to_variables_dir(self, get_variables):
+        get_variables.side_effect = get_default_variables
+
+        with TemporaryDirectory() as variables_dir:
+            operator = DockerWithVariablesOperator(
+                variables=['char'],
+                variables_dir=variables_dir,
+                mount_point=MOUNT_POINT,
+                task_id=TASK_ID,
+                default_args=DAG_ARGS,
+                image=IMAGE,
+                command='ls'
+            )
+            operator.execute(None)
+
+        assert operator.volumes[-1].startswith(
+            os.path.join(variables_dir, 'dockervariables'))
+
+    @patch_plugin_file('plugins/custom/docker', 'get_variables',
+                       autospec=True)
+    @patch_plugin_file('plugins/custom/docker', 'VARIABLES_DIR', None)
+    def test_should_not_write_variables_to_shm_by_default(self,
+                                                          get_variables):
+        get_variables.side_effect = get_default_variables
+
+        operator = DockerWithVariablesOperator(
+            variables=['char'],
+            mount_point=MOUNT_POINT,
+            task_id=TASK_ID,
+            default_args=DAG_ARGS,
+            image=IMAGE,
+            command='ls'
+        )
+        operator.execute(None)
+
+        # the container's own /dev/shm would not be the host's
+        assert operator.volumes[-1].startswith(
+            os.path.join(gettempdir(), 'dockervariables'))
@@ -0,0 +1,86 @@
+from airflow.exceptions import AirflowException
+from airflow.operators.docker_plugin import DockerRemovableContainer
+from custom import admission, reaper
+from custom.xcom_store import XComStore, OFFLOAD_THRESHOLD
+import functools
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from benchmarks.fake_docker import FakeDockerDaemon
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+IMAGE = 'alpine:latest'
+TASK_ID = 'test_docker_lifecycle'
+
+
+class TestDockerLifecycle(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmp_dir.name, 'docker.sock')
+        self.spool_dir = os.path.join(self.tmp_dir.name, 'reaper')
+        # keep the plugin state out of the host's /tmp, the defaults are
+        # bound when the plugins are imported
+        for target, attribute, new in [
+                (reaper, 'submit', functools.partial(
+                    reaper.submit, spool_dir=self.spool_dir)),
+                (admission, 'AdmissionController', functools.partial(
+                    admission.AdmissionController, ledger_path=os.path.join(
+                        self.tmp_dir.name, 'admission.json')))]:
+            patcher = mock.patch.object(target, attribute, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        reaper.stop(self.spool_dir)
+        self.tmp_dir.cleanup()
+
+    def make_operator(self, daemon, **kwargs):
+        return DockerRemovableContainer(
+            task_id=TASK_ID,
+            start_date=datetime(2017, 5, 1),
+            image=IMAGE,
+            command='true',
+            docker_url=daemon.url,
+            reap_async=False,
+            sample_interval=None,
+            admission_control=True,
+            xcom_store=XComStore(os.path.join(self.tmp_dir.name, 'xcom'),
+                                 threshold=OFFLOAD_THRESHOLD),
+            **kwargs)
+
+    def test_should_run_container(self):
+        with FakeDockerDaemon(self.socket_path, log_lines=2,
+                              images=[IMAGE]) as daemon:
+            operator = self.make_operator(daemon, xcom_push=True,
+                                          xcom_all=True)
+            assert operator.execute(None) == b'log line 0\nlog line 1\n'
+            assert daemon.containers == {}
+        assert 'POST /images/create' not in daemon.calls
+        for phase in ['connect', 'image_check', 'create', 'start', 'run',
+                      'wait', 'remove']:
+            assert phase in operator.timer.phases
+
+    def test_should_time_daemon_latencies(self):
+        with FakeDockerDaemon(self.socket_path, pull=0.2, create=0.1,
+                              run=0.2) as daemon:
+            operator = self.make_operator(daemon)
+            operator.execute(None)
+        assert daemon.calls['POST /images/create'] == 1
+        assert operator.timer.bytes_pulled == 4096
+        assert operator.timer.phases['pull'] >= 0.2
+        assert operator.timer.phases['create'] >= 0.1
+        # the container was already running when start returned
+        assert operator.timer.phases['run'] >= 0.15
+
+    def test_should_fail_on_exit_code(self):
+        with FakeDockerDaemon(self.socket_path, exit_code=1,
+                              images=[IMAGE]) as daemon:
+            operator = self.make_operator(daemon)
+            with self.assertRaises(AirflowException):
+                operator.execute(None)
+            assert daemon.containers == {}
@@ -0,0 +1,118 @@
+import airflow  # noqa puts the plugins folder on the path
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import custom.fairshare
+from custom.fairshare import FairShareDispatcher, allowance, split, \
+    make_run_id, run_tenant, releases_by_queue
+
+QUOTAS = {
+    'capacity': 10,
+    'tenants': {
+        'alice': {'weight': 3},
+        'bob': {'weight': 1},
+        'batch': {'weight': 1, 'max_active_runs': 2},
+    },
+}
+
+
+class TestAllowance(unittest.TestCase):
+    def test_should_share_capacity_by_weight(self):
+        quotas = dict(QUOTAS, capacity=12)
+        assert allowance(quotas, {}, {'alice': 100, 'bob': 100}) == \
+            {'alice': 9, 'bob': 3}
+
+    def test_should_start_small_tenants_right_away(self):
+        assert allowance(QUOTAS, {'alice': 6}, {'alice': 100, 'bob': 1}) == \
+            {'alice': 3, 'bob': 1}
+
+    def test_should_cap_max_active_runs(self):
+        assert allowance(QUOTAS, {'batch': 1}, {'batch': 100}) == \
+            {'batch': 1}
+
+    def test_should_not_exceed_capacity(self):
+        assert allowance(QUOTAS, {'alice': 12}, {'bob': 5}) == {'bob': 0}
+
+    def test_should_release_everything_without_capacity(self):
+        assert allowance({}, {'alice': 50}, {'alice': 100}) == {'alice': 100}
+
+
+class TestSplit(unittest.TestCase):
+    def test_should_split_by_weight(self):
+        assert split(10, {'a': 1, 'b': 1, 'c': 2}) == \
+            {'a': 3, 'b': 2, 'c': 5}
+        assert sum(split(7, {'a': 1, 'b': 1, 'c': 1}).values()) == 7
+
+    def test_should_split_nothing_without_weight(self):
+        assert split(5, {'a': 0}) == {'a': 0}
+
+
+class TestRunId(unittest.TestCase):
+    def test_should_keep_tenant(self):
+        now = datetime(2017, 5, 1)
+        assert run_tenant(make_run_id('dag', 3, 'alice', now)) == 'alice'
+        assert run_tenant(make_run_id('dag', 3, now=now)) is None
+        assert make_run_id('dag', 3, now=now) == \
+            'trig_dag_3_2017-05-01T00:00:00'
+
+
+class TestDispatcher(unittest.TestCase):
+    def dispatch(self, params_list, batches, lookahead=1000):
+        created = []
+        published = []
+        dispatcher = FairShareDispatcher(
+            ('trigger', 'fanout', None), 'alice', queues=['gpu', 'gpu'],
+            publish=published.append, poll_interval=5, lookahead=lookahead,
+            clock=lambda: 100, sleep=mock.Mock())
+        with mock.patch.object(dispatcher, 'next_batch',
+                               side_effect=batches) as next_batch:
+            assert dispatcher.dispatch(
+                params_list,
+                lambda index, params: created.append((index, params))) == \
+                len(created)
+        return dispatcher, next_batch, created, published
+
+    def test_should_release_in_batches(self):
+        dispatcher, next_batch, created, published = self.dispatch(
+            ['a', 'b', 'c', 'd', 'e'], [2, 0, 3])
+        assert created == list(enumerate(['a', 'b', 'c', 'd', 'e']))
+        assert [call[0][0] for call in next_batch.call_args_list] == \
+            [5, 3, 3]
+        assert [record['pending'] for record in published] == [3, 3, 0]
+        assert published[0]['queues'] == ['gpu']
+        dispatcher.sleep.assert_called_once_with(5)
+
+    def test_should_look_ahead_of_generators(self):
+        dispatcher, next_batch, created, published = self.dispatch(
+            iter(['a', 'b', 'c', 'd', 'e']), [1, 1, 1, 1, 1], lookahead=2)
+        assert created == list(enumerate(['a', 'b', 'c', 'd', 'e']))
+        # never more than lookahead runs taken ahead of the released ones
+        assert [call[0][0] for call in next_batch.call_args_list] == \
+            [2, 2, 2, 2, 1]
+        assert [record['pending'] for record in published] == \
+            [2, 2, 2, 1, 0]
+
+    def test_should_ask_for_its_share(self):
+        other = {'tenant': 'alice', 'share_weight': 3, 'pending': 100,
+                 'queues': ['cpu'], 'updated': 100}
+        dispatcher = FairShareDispatcher(('trigger', 'fanout', None),
+                                         'alice', queues=['gpu'],
+                                         clock=lambda: 100)
+        with mock.patch.object(custom.fairshare, 'load_quotas',
+                               return_value=QUOTAS), \
+                mock.patch.object(custom.fairshare, 'active_runs',
+                                  return_value={'alice': 2}), \
+                mock.patch.object(custom.fairshare, 'pending_fanouts',
+                                  return_value={('other', 'fanout', None):
+                                                other}):
+            assert dispatcher.next_batch(100) == 2
+
+    def test_should_sum_releases_by_queue(self):
+        fanouts = {
+            'first': {'tenant': 'alice', 'pending': 3, 'queues': ['gpu']},
+            'second': {'tenant': 'bob', 'pending': 100,
+                       'queues': ['gpu', 'cpu']},
+        }
+        assert releases_by_queue(QUOTAS, {}, fanouts) == \
+            {'gpu': 10, 'cpu': 7}
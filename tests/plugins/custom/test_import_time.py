@@ -0,0 +1,45 @@
+import glob
+import os
+import tempfile
+import unittest
+from airflow import configuration
+from tests.utils.import_time import budget_us, import_cost
+
+# every airflow process loads the plugins, keep them cheap. Milliseconds per
+# plugin file on top of airflow, None is the default
+PLUGIN_BUDGETS_MS = {
+    None: 100,
+    # loads most of the other custom modules
+    'docker_custom.py': 200,
+    'custom.py': 150,
+}
+LAZY_MODULES = ['docker', 'requests']
+
+LOAD_PLUGIN = '''
+import imp, sys
+sys.path.append({folder!r})
+imp.load_source('plugin_probe', {path!r})
+'''
+
+
+class TestPluginImportTime(unittest.TestCase):
+    def test_plugins_should_import_lazily(self):
+        folder = os.path.expanduser(
+            configuration.get('core', 'plugins_folder'))
+        paths = sorted(glob.glob(os.path.join(folder, '**', '*.py'),
+                                 recursive=True))
+        assert paths
+
+        with tempfile.TemporaryDirectory() as empty_folder:
+            for path in paths:
+                # import airflow without plugins, then load one on its own
+                cost, modules = import_cost(
+                    LOAD_PLUGIN.format(folder=folder, path=path),
+                    env={'AIRFLOW__CORE__PLUGINS_FOLDER': empty_folder})
+
+                for module in LAZY_MODULES:
+                    assert module not in modules, \
+                        '%s imports %s' % (path, module)
+                budget = budget_us(PLUGIN_BUDGETS_MS, os.path.basename(path))
+                assert cost <= budget, \
+                    'loading %s took %dus, budget %dus' % (path, cost, budget)
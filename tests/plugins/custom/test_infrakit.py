@@ -0,0 +1,179 @@
+import airflow  # noqa puts the plugins folder on the path
+import multiprocessing
+import os
+import tempfile
+import unittest
+from custom.infrakit import ColdStartWatcher, Infrakit
+
+GROUPS_URL = 'https://example.com/groups.json'
+
+
+class FakeCli(object):
+    """
+    Records infrakit commands, with the groups that exist
+    """
+    def __init__(self, groups=()):
+        self.groups = set(groups)
+        self.commands = []
+
+    def __call__(self, command):
+        args = command[command.index('infrakit', 1) + 1:]
+        self.commands.append(args)
+        if args[:2] == ['group', 'describe']:
+            return 0 if args[2] in self.groups else 1
+        if args[:2] == ['manager', 'commit']:
+            self.groups.update(['workers-gpu', 'workers-worker'])
+        if args[:2] == ['group', 'destroy']:
+            self.groups.discard(args[2])
+        return 0
+
+
+class TestInfrakit(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cli = FakeCli()
+        self.fetched = []
+        self.now = 1000.0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        return b'[]'
+
+    def make_infrakit(self, idle='standby', fetch=None):
+        return Infrakit(image='infrakit/devbundle', groups_url=GROUPS_URL,
+                        idle=idle, groups_ttl=60,
+                        directory=self.tmp_dir.name, run=self.cli,
+                        fetch=fetch or self.fetch, clock=lambda: self.now)
+
+    def test_should_commit_cached_groups(self):
+        infrakit = self.make_infrakit()
+        infrakit.scale('gpu', 2)
+        infrakit.destroy('gpu')
+        self.now = os.stat(infrakit.groups_path).st_mtime + 30
+        infrakit.scale('gpu', 1)
+
+        assert self.fetched == [GROUPS_URL]
+        assert ['manager', 'commit',
+                'file:///air-tasks-infrakit/groups.json'] in self.cli.commands
+        assert self.cli.commands[-1] == ['group', 'scale', 'workers-gpu', '1']
+
+    def test_should_fall_back_to_stale_groups(self):
+        infrakit = self.make_infrakit()
+        assert infrakit.cache_groups()
+
+        def unreachable(url):
+            raise IOError('unreachable')
+        infrakit = self.make_infrakit(fetch=unreachable)
+        self.now = os.stat(infrakit.groups_path).st_mtime + 120
+        assert infrakit.commit_url() == \
+            'file:///air-tasks-infrakit/groups.json'
+        self.tmp_dir.cleanup()
+        assert infrakit.commit_url() == GROUPS_URL
+
+    def test_should_keep_idle_groups_in_standby(self):
+        infrakit = self.make_infrakit()
+        infrakit.rescale({'gpu': 3, 'worker': 0})
+        infrakit.rescale({'gpu': 0, 'worker': 0})
+
+        assert infrakit.standby_queues() == set(['gpu', 'worker'])
+        assert self.cli.groups == set(['workers-gpu', 'workers-worker'])
+        scales = [args for args in self.cli.commands if args[1] == 'scale']
+        # a group already in standby is left alone
+        assert scales == [['group', 'scale', 'workers-gpu', '3'],
+                          ['group', 'scale', 'workers-worker', '0'],
+                          ['group', 'scale', 'workers-gpu', '0']]
+
+    def test_should_destroy_idle_groups(self):
+        infrakit = self.make_infrakit(idle='destroy')
+        infrakit.rescale({'gpu': 3})
+        infrakit.rescale({'gpu': 0})
+
+        assert self.cli.commands[-1] == ['group', 'destroy', 'workers-gpu']
+        assert not infrakit.standby_queues()
+
+    def test_should_check_again_before_scaling_down(self):
+        infrakit = self.make_infrakit()
+        infrakit.rescale({'gpu': 3})
+        infrakit.rescale({'gpu': 0}, queue_depth=lambda queue: 2)
+
+        assert self.cli.commands[-1] == ['group', 'scale', 'workers-gpu', '2']
+        assert not infrakit.standby_queues()
+
+    def test_should_not_lose_concurrent_updates(self):
+        def toggle(queue):
+            infrakit = self.make_infrakit()
+            for size in [0, 1] * 20 + [0]:
+                infrakit.scale(queue, size)
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=toggle, args=(queue,))
+                     for queue in ['gpu', 'worker']]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+        assert self.make_infrakit().standby_queues() == \
+            set(['gpu', 'worker'])
+
+
+class TestColdStartWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cli = FakeCli()
+        self.infrakit = Infrakit(image='infrakit/devbundle',
+                                 groups_url=GROUPS_URL, idle='standby',
+                                 directory=self.tmp_dir.name, run=self.cli,
+                                 fetch=lambda url: b'[]')
+        self.infrakit.rescale({'gpu': 0, 'worker': 0})
+        self.now = 0
+        self.sleeps = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_should_start_on_first_message(self):
+        depths = {'gpu': [0, 0, 2], 'worker': [0, 0, 0]}
+        watcher = ColdStartWatcher(
+            self.infrakit, lambda queue: depths[queue].pop(0),
+            poll_interval=2, clock=lambda: self.now, sleep=self.sleep)
+
+        assert watcher.watch(5) == ['gpu']
+        assert self.sleeps == [2, 2]
+        assert self.cli.commands[-1] == ['group', 'scale', 'workers-gpu', '2']
+        assert self.infrakit.standby_queues() == set(['worker'])
+
+    def test_should_keep_cold_started_groups(self):
+        # the scaler measured no tasks on gpu, then the watcher cold starts
+        # it before the scaler rescales from its measurement
+        measured_at = self.now
+        self.now += 5
+        watcher = ColdStartWatcher(self.infrakit, lambda queue: 1,
+                                   clock=lambda: self.now)
+        self.infrakit.clock = lambda: self.now
+        assert watcher.check() == ['gpu', 'worker']
+        self.infrakit.rescale({'gpu': 0, 'worker': 0},
+                              queue_depth=lambda queue: 0,
+                              measured_at=measured_at)
+
+        assert self.cli.commands[-1] == \
+            ['group', 'scale', 'workers-worker', '1']
+        assert not self.infrakit.standby_queues()
+
+    def test_should_skip_unreachable_queues(self):
+        def depth(queue):
+            if queue == 'gpu':
+                raise IOError('broker down')
+            return 1
+        watcher = ColdStartWatcher(self.infrakit, depth, poll_interval=2,
+                                   clock=lambda: self.now, sleep=self.sleep)
+
+        assert watcher.check() == ['worker']
+        assert watcher.check() == []
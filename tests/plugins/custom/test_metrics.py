@@ -0,0 +1,160 @@
+import airflow  # noqa puts the plugins folder on the path
+import os
+import socket
+import tempfile
+import unittest
+from urllib.request import urlopen
+from custom.metrics import Metrics, NullBackend, StatsdBackend, \
+    PrometheusTextfileBackend, PrometheusHttpBackend, read_textfile, \
+    backend_from_config
+from custom.timing import MetricsTimingSink
+
+
+class RecordingBackend(object):
+    def __init__(self):
+        self.samples = []
+
+    def record(self, kind, name, value, labels):
+        self.samples.append((kind, name, value, labels))
+
+    def flush(self):
+        pass
+
+
+def free_port():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+class TestStatsdBackend(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(5)
+        self.metrics = Metrics(StatsdBackend(
+            host='127.0.0.1', port=self.listener.getsockname()[1]))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def receive(self, count):
+        return [self.listener.recv(4096).decode('utf-8')
+                for _ in range(count)]
+
+    def test_should_send_every_kind(self):
+        self.metrics.counter('trigger_dag_runs', 3, dag_id='dag')
+        self.metrics.gauge('scaler_queue_depth', 12, queue='worker-gpu')
+        self.metrics.histogram('docker_start_seconds', 0.5, dag_id='dag',
+                               task_id='task')
+        assert self.receive(3) == [
+            'air_tasks.trigger_dag_runs.dag:3|c',
+            'air_tasks.scaler_queue_depth.worker-gpu:12|g',
+            'air_tasks.docker_start_seconds.dag.task:0.5|h',
+        ]
+
+    def test_should_not_raise_without_listener(self):
+        metrics = Metrics(StatsdBackend(host='127.0.0.1', port=free_port()))
+        for _ in range(100):
+            metrics.counter('dropped')
+
+    def test_should_record_docker_timings(self):
+        MetricsTimingSink(self.metrics).publish(
+            {'dag_id': 'dag', 'task_id': 'task', 'bytes_pulled': 10,
+             'phases': {'pull': 2, 'create': 0.25, 'start': 0.25,
+                        'run': 5}}, None)
+        lines = self.receive(6)
+        assert 'air_tasks.docker_phase_seconds.dag.create:0.25|h' in lines
+        assert 'air_tasks.docker_start_seconds.dag:2.5|h' in lines
+        assert 'air_tasks.docker_pulled_bytes.dag:10|c' in lines
+
+    def test_should_label_docker_timings_with_task_if_asked(self):
+        MetricsTimingSink(self.metrics, task_labels=True).publish(
+            {'dag_id': 'dag', 'task_id': 'task', 'bytes_pulled': 10,
+             'phases': {'create': 0.25}}, None)
+        assert self.receive(2) == [
+            'air_tasks.docker_phase_seconds.dag.create.task:0.25|h',
+            'air_tasks.docker_pulled_bytes.dag.task:10|c',
+        ]
+
+
+class TestPrometheusBackends(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_metrics(self, backend=PrometheusTextfileBackend, **kwargs):
+        return Metrics(backend(directory=self.tmp_dir.name,
+                               buckets=(1, 10), **kwargs))
+
+    def samples(self):
+        return read_textfile(os.path.join(self.tmp_dir.name,
+                                          'air_tasks.prom'))[0]
+
+    def test_should_merge_processes(self):
+        first = self.make_metrics()
+        second = self.make_metrics()
+        first.counter('trigger_dag_runs', 2, dag_id='dag')
+        first.gauge('scaler_queue_depth', 5, queue='worker')
+        first.flush()
+        second.counter('trigger_dag_runs', 3, dag_id='dag')
+        second.gauge('scaler_queue_depth', 1, queue='worker')
+        second.flush()
+
+        samples = self.samples()
+        assert samples[('air_tasks_trigger_dag_runs', 'dag_id="dag"')] == 5
+        assert samples[('air_tasks_scaler_queue_depth', 'queue="worker"')] == 1
+
+    def test_should_bucket_histograms(self):
+        metrics = self.make_metrics()
+        for seconds in [0.5, 5, 50]:
+            metrics.histogram('docker_start_seconds', seconds, task_id='t')
+        metrics.flush()
+
+        samples = self.samples()
+        bucket = 'air_tasks_docker_start_seconds_bucket'
+        assert samples[(bucket, 'le="1",task_id="t"')] == 1
+        assert samples[(bucket, 'le="10",task_id="t"')] == 2
+        assert samples[(bucket, 'le="+Inf",task_id="t"')] == 3
+        assert samples[('air_tasks_docker_start_seconds_sum',
+                        'task_id="t"')] == 55.5
+        with open(os.path.join(self.tmp_dir.name, 'air_tasks.prom')) as f:
+            assert '# TYPE air_tasks_docker_start_seconds histogram\n' in \
+                f.read()
+
+    def test_should_flush_every_interval(self):
+        metrics = self.make_metrics(flush_interval=0)
+        metrics.counter('trigger_dag_runs', dag_id='dag')
+        assert self.samples()
+
+    def test_should_serve_textfile(self):
+        port = free_port()
+        metrics = self.make_metrics(PrometheusHttpBackend, port=port)
+        metrics.counter('trigger_dag_runs', dag_id='dag')
+        metrics.flush()
+        try:
+            body = urlopen('http://127.0.0.1:%d/metrics' % port,
+                           timeout=5).read().decode('utf-8')
+        finally:
+            metrics.backend.server.shutdown()
+            metrics.backend.server.server_close()
+        assert 'air_tasks_trigger_dag_runs{dag_id="dag"} 1' in body
+
+
+class TestMetrics(unittest.TestCase):
+    def test_should_time(self):
+        backend = RecordingBackend()
+        with Metrics(backend).timer('scaler_queue_check_seconds',
+                                    clock=iter([1, 3]).__next__,
+                                    queue='worker'):
+            pass
+        assert backend.samples == [
+            ('histogram', 'scaler_queue_check_seconds', 2,
+             {'queue': 'worker'})]
+
+    def test_should_be_disabled_by_default(self):
+        assert isinstance(backend_from_config(), NullBackend)
@@ -0,0 +1,114 @@
+import airflow  # noqa puts the plugins folder on the path
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from custom.reaper import ContainerReaper, DEFAULT_DOCKER_URL, REAP_LABEL, \
+    SPOOL_SUFFIX, stop
+from concurrent.futures import ThreadPoolExecutor
+from docker.errors import APIError, NotFound
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+
+def write_job(spool_dir, container_id, **kwargs):
+    job = {'id': container_id, 'docker_url': DEFAULT_DOCKER_URL,
+           'attempts': 0, 'next_attempt': 0}
+    job.update(kwargs)
+    with open(os.path.join(spool_dir, container_id + SPOOL_SUFFIX), 'w') as f:
+        json.dump(job, f)
+
+
+class TestContainerReaper(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp(prefix='reapertest')
+        self.cli = mock.MagicMock(name='APIClient')
+        self.reaper = ContainerReaper(spool_dir=self.spool_dir, batch_size=2,
+                                      max_attempts=2, retry_delay=60)
+        self.reaper.clients[(DEFAULT_DOCKER_URL, None)] = self.cli
+        self.executor = ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def spooled(self):
+        return sorted(os.listdir(self.spool_dir))
+
+    def test_should_remove_in_batches(self):
+        for container_id in ['a', 'b', 'c']:
+            write_job(self.spool_dir, container_id)
+
+        assert self.reaper.reap(self.executor) == 2
+        assert len(self.spooled()) == 1
+        assert self.reaper.reap(self.executor) == 1
+        assert self.spooled() == []
+        assert self.cli.remove_container.call_count == 3
+
+    def test_should_treat_missing_container_as_removed(self):
+        self.cli.stop.side_effect = NotFound('gone')
+        write_job(self.spool_dir, 'a')
+
+        self.reaper.reap(self.executor)
+
+        assert self.spooled() == []
+
+    def test_should_retry_with_backoff_then_give_up(self):
+        self.cli.remove_container.side_effect = APIError('busy')
+        write_job(self.spool_dir, 'a')
+
+        self.reaper.reap(self.executor)
+        with open(os.path.join(self.spool_dir, 'a' + SPOOL_SUFFIX)) as f:
+            job = json.load(f)
+        assert job['attempts'] == 1
+        assert job['next_attempt'] > time.time()
+        # not due yet
+        assert self.reaper.reap(self.executor) == 0
+
+        write_job(self.spool_dir, 'a', attempts=1)
+        self.reaper.reap(self.executor)
+        assert self.spooled() == []
+
+    def test_should_sweep_only_old_orphans(self):
+        write_job(self.spool_dir, 'spooled', next_attempt=time.time() + 60)
+        self.cli.containers.return_value = [
+            {'Id': 'spooled'}, {'Id': 'old'}, {'Id': 'recent'}]
+        self.cli.inspect_container.side_effect = lambda container_id: {
+            'State': {'FinishedAt': '2018-01-01T00:00:00.123456789Z'
+                      if container_id == 'old' else
+                      time.strftime('%Y-%m-%dT%H:%M:%S.0Z', time.gmtime())}}
+
+        self.reaper.sweep()
+
+        self.cli.containers.assert_called_once_with(
+            all=True, filters={'label': REAP_LABEL, 'status': 'exited'})
+        self.cli.remove_container.assert_called_once_with('old')
+
+    def test_should_tolerate_missing_spool_dir(self):
+        self.cli.containers.return_value = []
+        shutil.rmtree(self.spool_dir)
+
+        assert self.reaper.reap(self.executor) == 0
+        self.reaper.sweep()
+        assert stop(self.spool_dir)
+
+    def test_should_stop_when_asked(self):
+        self.cli.containers.return_value = []
+        self.reaper.poll_interval = 0.01
+        thread = threading.Thread(target=self.reaper.run, daemon=True)
+        thread.start()
+        try:
+            # wait for the reaper to hold its lock
+            while not self.cli.containers.called:
+                time.sleep(0.01)
+            assert stop(self.spool_dir, timeout=5)
+        finally:
+            thread.join(5)
+        assert not thread.is_alive()
+        assert self.spooled() == ['reaper.lock']
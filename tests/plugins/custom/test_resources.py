@@ -0,0 +1,89 @@
+import airflow  # noqa puts the plugins folder on the path
+import threading
+import unittest
+from custom.resources import ContainerStatsSampler, MEGABYTE, recommend
+
+
+def make_stats(total_usage, usage=0, cache=0, read=0, rx=0):
+    return {
+        'cpu_stats': {'cpu_usage': {'total_usage': total_usage}},
+        'memory_stats': {'usage': usage, 'stats': {'cache': cache}},
+        'blkio_stats': {'io_service_bytes_recursive': [
+            {'op': 'Read', 'value': read}, {'op': 'Write', 'value': 1}]},
+        'networks': {'eth0': {'rx_bytes': rx, 'tx_bytes': 2},
+                     'eth1': {'rx_bytes': rx, 'tx_bytes': 2}},
+    }
+
+
+class TestContainerStatsSampler(unittest.TestCase):
+    def test_should_summarise_samples(self):
+        sampler = ContainerStatsSampler(None, 'container')
+        sampler.add(make_stats(0, usage=100, cache=50), now=0)
+        sampler.add(make_stats(int(3e9), usage=500, cache=100, read=7, rx=3),
+                    now=2)
+        sampler.add(make_stats(int(4e9), usage=200), now=4)
+        # exited containers report empty stats
+        sampler.add({'memory_stats': {}}, now=6)
+
+        summary = sampler.summary(task_id='task')
+        assert summary['samples'] == 3
+        assert summary['peak_rss'] == 400
+        assert summary['avg_cpu'] == 1.0
+        assert summary['peak_cpu'] == 1.5
+        assert summary['blkio_read'] == 0
+        assert summary['blkio_write'] == 1
+        assert summary['net_tx'] == 4
+        assert summary['task_id'] == 'task'
+
+    def test_should_report_no_cpu_for_single_sample(self):
+        sampler = ContainerStatsSampler(None, 'container')
+        sampler.add(make_stats(int(1e9), usage=1), now=0)
+        assert sampler.summary()['avg_cpu'] == 0.0
+
+    def test_should_wait_for_in_flight_sample_on_stop(self):
+        sampling = threading.Event()
+        release = threading.Event()
+
+        class SlowCli(object):
+            def stats(self, container_id, stream):
+                sampling.set()
+                release.wait(5)
+                return make_stats(0, usage=100)
+
+        sampler = ContainerStatsSampler(SlowCli(), 'container', interval=60)
+        sampler.start()
+        assert sampling.wait(5)
+        threading.Timer(0.1, release.set).start()
+        sampler.stop()
+        assert not sampler._thread.is_alive()
+        assert sampler.summary()['samples'] == 1
+
+
+class TestRecommend(unittest.TestCase):
+    def test_should_recommend_with_headroom(self):
+        summaries = [{'samples': 2, 'avg_cpu': cpu, 'peak_rss': rss,
+                      'requested_cpus': 4, 'requested_mem_limit': '4g'}
+                     for cpu, rss in [(0.1, 100 * MEGABYTE),
+                                      (0.5, 300 * MEGABYTE),
+                                      (0.3, 200 * MEGABYTE)]]
+        recommendation = recommend(summaries)
+        assert recommendation['runs'] == 3
+        assert not recommendation['insufficient_data']
+        assert recommendation['cpus'] == 0.75
+        assert recommendation['mem_limit'] == '384m'
+        assert recommendation['requested_cpus'] == 4
+
+    def test_should_not_size_cpu_from_single_samples(self):
+        summaries = [{'samples': 1, 'avg_cpu': 0.0, 'peak_rss': MEGABYTE},
+                     {'samples': 3, 'avg_cpu': 2.0, 'peak_rss': MEGABYTE}]
+        assert recommend(summaries[1:])['cpus'] == 2.5
+        assert recommend(summaries)['cpus'] == 2.5
+        assert recommend(summaries)['cpu_runs'] == 1
+
+        recommendation = recommend(summaries[:1])
+        assert recommendation['insufficient_data']
+        assert recommendation['cpus'] is None
+        assert recommendation['mem_limit'] is None
+
+    def test_should_skip_runs_without_samples(self):
+        assert recommend([{'samples': 0}]) is None
@@ -0,0 +1,80 @@
+import airflow  # noqa puts the plugins folder on the path
+import csv
+import os
+import tempfile
+import unittest
+from custom.timing import PhaseTimer, CsvTimingSink, XComTimingSink, publish
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def make_record():
+    return {'dag_id': 'dag', 'task_id': 'task', 'phases': {'pull': 1.5},
+            'bytes_pulled': 10, 'total': 2}
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def test_should_accumulate_phases(self):
+        clock = FakeClock()
+        timer = PhaseTimer(clock=clock)
+        with timer.phase('run'):
+            clock.now += 2
+        with timer.phase('run'):
+            clock.now += 3
+        with self.assertRaises(ValueError):
+            with timer.phase('wait'):
+                clock.now += 1
+                raise ValueError()
+
+        record = timer.record(task_id='task')
+        assert record['phases'] == {'run': 5, 'wait': 1}
+        assert record['total'] == 6
+        assert record['task_id'] == 'task'
+
+    def test_should_count_largest_progress_per_layer(self):
+        timer = PhaseTimer()
+        for layer, current in [('a', 10), ('b', 5), ('a', 30), ('b', 7)]:
+            timer.track_pull({'status': 'Downloading', 'id': layer,
+                              'progressDetail': {'current': current}})
+        timer.track_pull({'status': 'Download complete', 'id': 'a',
+                          'progressDetail': {}})
+        assert timer.bytes_pulled == 37
+
+
+class TestTimingSinks(unittest.TestCase):
+    def test_should_push_xcom(self):
+        ti = mock.MagicMock()
+        record = make_record()
+        XComTimingSink().publish(record, {'ti': ti})
+        ti.xcom_push.assert_called_once_with(key='docker_timings',
+                                             value=record)
+
+    def test_should_append_csv(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'timings.csv')
+            sink = CsvTimingSink(path)
+            sink.publish(make_record(), None)
+            sink.publish(make_record(), None)
+            with open(path) as csv_file:
+                rows = list(csv.DictReader(csv_file))
+        assert len(rows) == 2
+        assert rows[0]['pull'] == '1.5'
+        assert rows[0]['task_id'] == 'task'
+
+    def test_should_not_raise_on_sink_failure(self):
+        broken = mock.MagicMock()
+        broken.publish.side_effect = IOError()
+        working = mock.MagicMock()
+        publish(make_record(), None, [broken, working])
+        working.publish.assert_called_once()
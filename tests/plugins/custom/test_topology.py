@@ -0,0 +1,141 @@
+import airflow  # noqa puts the plugins folder on the path
+import unittest
+from datetime import datetime
+from airflow import DAG
+from airflow.exceptions import AirflowException
+from airflow.operators.bash_operator import BashOperator
+from custom.topology import LayeredDagBuilder, all_to_all, one_to_one, window
+
+DEFAULT_ARGS = {
+    'owner': 'airflow',
+    'start_date': datetime(2017, 5, 1),
+    'retries': 3,
+}
+
+
+def make_dag(**kwargs):
+    return DAG('test_topology', default_args=dict(DEFAULT_ARGS),
+               schedule_interval=None, **kwargs)
+
+
+def edges(dag):
+    return sorted((upstream, task.task_id)
+                  for task in dag.task_dict.values()
+                  for upstream in task.upstream_task_ids)
+
+
+def downstream_edges(dag):
+    return sorted((task.task_id, downstream)
+                  for task in dag.task_dict.values()
+                  for downstream in task.downstream_task_ids)
+
+
+class TestPatterns(unittest.TestCase):
+    def test_all_to_all(self):
+        assert sorted(all_to_all(2, 2)) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    def test_one_to_one(self):
+        assert list(one_to_one(3, 3)) == [(0, 0), (1, 1), (2, 2)]
+
+    def test_one_to_one_should_require_same_width(self):
+        with self.assertRaises(AirflowException):
+            one_to_one(2, 3)
+
+    def test_window_should_clip_at_edges(self):
+        assert list(window(0, -1)(3, 3)) == [
+            (0, 0), (0, 1), (1, 1), (1, 2), (2, 2)]
+        assert list(window(0, 1)(2, 3)) == [(0, 0), (1, 0), (1, 1)]
+
+
+class TestLayeredDagBuilder(unittest.TestCase):
+    def test_should_match_set_upstream(self):
+        width = 4
+        expected = make_dag()
+        begin = BashOperator(task_id='begin', bash_command='true',
+                             dag=expected)
+        first = [BashOperator(task_id='first_%d' % index, bash_command='true',
+                              dag=expected) for index in range(width)]
+        second = [BashOperator(task_id='second_%d' % index,
+                               bash_command='true', dag=expected)
+                  for index in range(width)]
+        third = [BashOperator(task_id='third_%d' % index, bash_command='true',
+                              dag=expected) for index in range(width)]
+        for index in range(width):
+            first[index].set_upstream(begin)
+            second[index].set_upstream(first[max(index - 1, 0):index + 1])
+            third[index].set_upstream(second[index])
+
+        dag = make_dag()
+        layers = (
+            LayeredDagBuilder(dag)
+            .add_layer(BashOperator, task_id='begin', bash_command='true')
+            .add_layer(BashOperator, width=width, task_id='first_{index}',
+                       bash_command='true')
+            .add_layer(BashOperator, width=width, pattern=window(-1, 0),
+                       task_id='second_{index}', bash_command='true')
+            .add_layer(BashOperator, width=width, pattern=one_to_one,
+                       task_id='third_{index}', bash_command='true')
+            .build()
+        )
+
+        assert [len(layer) for layer in layers] == [1, width, width, width]
+        assert sorted(dag.task_dict) == sorted(expected.task_dict)
+        assert dag.task_count == len(expected.tasks)
+        assert edges(dag) == edges(expected)
+        assert downstream_edges(dag) == downstream_edges(expected)
+        assert sorted(task.task_id for task in dag.roots) == \
+            sorted(task.task_id for task in expected.roots)
+
+    def test_should_apply_dag_defaults(self):
+        dag = make_dag(params={'dag_param': 1})
+        (task,), = (
+            LayeredDagBuilder(dag)
+            .add_layer(BashOperator, task_id='task', bash_command='true',
+                       params={'task_param': 2})
+            .build()
+        )
+        assert task.dag is dag
+        assert task.retries == 3
+        assert task.start_date == DEFAULT_ARGS['start_date']
+        assert task.params == {'dag_param': 1, 'task_param': 2}
+
+    def test_should_pass_per_task_arguments(self):
+        dag = make_dag()
+        (tasks,) = (
+            LayeredDagBuilder(dag)
+            .add_layer(BashOperator, width=3, task_id='task_{index}',
+                       bash_command='true',
+                       per_task=lambda index: {'params': {'index': index},
+                                               'retries': index})
+            .build()
+        )
+        assert [task.params['index'] for task in tasks] == [0, 1, 2]
+        assert [task.retries for task in tasks] == [0, 1, 2]
+
+    def test_should_not_add_tasks_one_by_one_in_dag_context(self):
+        with make_dag() as dag:
+            (tasks,) = (
+                LayeredDagBuilder(dag)
+                .add_layer(BashOperator, width=3, task_id='task_{index}',
+                           bash_command='true')
+                .build()
+            )
+            after = BashOperator(task_id='after', bash_command='true')
+        assert sorted(dag.task_dict) == ['after', 'task_0', 'task_1',
+                                         'task_2']
+        assert after.dag is dag
+
+    def test_should_reject_duplicate_task_ids(self):
+        dag = make_dag()
+        BashOperator(task_id='task_0', bash_command='true', dag=dag)
+        with self.assertRaises(AirflowException):
+            (
+                LayeredDagBuilder(dag)
+                .add_layer(BashOperator, width=2, task_id='task_{index}',
+                           bash_command='true')
+                .build()
+            )
+
+    def test_should_require_task_id(self):
+        with self.assertRaises(AirflowException):
+            LayeredDagBuilder(make_dag()).add_layer(BashOperator)
@@ -0,0 +1,48 @@
+import unittest
+from airflow.models import Variable
+from custom.variables import get_variables
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+
+def make_variable(key, stored):
+    variable = mock.MagicMock(spec=Variable)
+    variable.key = key
+    type(variable).val = mock.PropertyMock(
+        return_value='decrypted %s' % stored)
+    return variable
+
+
+@mock.patch('airflow.settings.Session', autospec=True)
+class TestGetVariables(unittest.TestCase):
+    def setUp(self):
+        self.stored = {'a': 'A1', 'b': 'B1'}
+
+    def mock_query(self, session_class):
+        session = session_class.return_value
+        session.query.return_value.filter.side_effect = lambda *args: [
+            make_variable(key, stored)
+            for key, stored in sorted(self.stored.items())]
+        return session
+
+    def test_should_fetch_in_one_query(self, session_class):
+        session = self.mock_query(session_class)
+        assert get_variables(['a', 'b']) == {
+            'a': 'decrypted A1', 'b': 'decrypted B1'}
+        assert session.query.call_count == 1
+
+    def test_should_fetch_changed_values(self, session_class):
+        session = self.mock_query(session_class)
+        get_variables(['a', 'b'])
+        self.stored['a'] = 'A2'
+        assert get_variables(['a', 'b']) == {
+            'a': 'decrypted A2', 'b': 'decrypted B1'}
+        assert session.query.call_count == 2
+
+    def test_should_fail_when_missing(self, session_class):
+        self.mock_query(session_class)
+        with self.assertRaises(ValueError):
+            get_variables(['a', 'missing'])
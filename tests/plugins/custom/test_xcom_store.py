@@ -0,0 +1,78 @@
+import airflow  # noqa puts the plugins folder on the path
+import os
+import tempfile
+import unittest
+from airflow.exceptions import AirflowException
+from custom.xcom_store import XComStore, is_reference, GC_LOCK_FILE
+from custom.xcom_store import REFERENCE_KEY, DIGEST_PREFIX
+
+
+class TestXComStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = XComStore(root=self.tmp_dir.name, threshold=1024,
+                               ttl=100, gc_interval=10)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def stored_path(self, reference):
+        return self.store.path(
+            reference[REFERENCE_KEY][len(DIGEST_PREFIX):])
+
+    def stored_files(self):
+        return [name for _, _, files in os.walk(self.tmp_dir.name)
+                for name in files if name != GC_LOCK_FILE]
+
+    def test_should_keep_small_values(self):
+        value = {'worker-cpu': 3}
+        assert self.store.offload(value) is value
+        assert self.store.offload(None) is None
+        assert self.stored_files() == []
+
+    def test_should_offload_large_values(self):
+        value = b'container log line\n' * 10000
+        reference = self.store.offload(value)
+        assert is_reference(reference)
+        assert reference['stored'] < reference['size']
+        assert self.store.resolve(reference) == value
+        assert self.store.resolve('plain') == 'plain'
+
+    def test_should_store_identical_values_once(self):
+        value = list(range(1000))
+        assert self.store.offload(value) == self.store.offload(list(value))
+        assert len(self.stored_files()) == 1
+
+    def test_should_not_offload_without_threshold(self):
+        store = XComStore(root=self.tmp_dir.name, threshold=None)
+        value = 'x' * 10000
+        assert store.offload(value) is value
+
+    @unittest.skipIf(os.environ.get('AIR_TASKS_XCOM_DIR'),
+                     'offloading is on with AIR_TASKS_XCOM_DIR')
+    def test_should_not_offload_by_default(self):
+        value = 'x' * 100000
+        assert XComStore().offload(value) is value
+
+    def test_should_collect_expired_values(self):
+        old = self.store.offload('old' * 1000)
+        new = self.store.offload('new' * 1000)
+        os.utime(self.stored_path(old), (0, 0))
+
+        assert self.store.gc() == 1
+        assert self.store.resolve(new) == 'new' * 1000
+        with self.assertRaises(AirflowException):
+            self.store.resolve(old)
+
+    def test_should_refresh_values_stored_again(self):
+        reference = self.store.offload('value' * 1000)
+        os.utime(self.stored_path(reference), (0, 0))
+        self.store.offload('value' * 1000)
+        assert self.store.gc() == 0
+
+    def test_should_only_collect_every_interval(self):
+        self.store.offload('value' * 1000)
+        lock_mtime = os.path.getmtime(
+            os.path.join(self.tmp_dir.name, GC_LOCK_FILE))
+        assert not self.store.maybe_gc(now=lock_mtime + 5)
+        assert self.store.maybe_gc(now=lock_mtime + 20)
@@ -0,0 +1,114 @@
+import airflow  # noqa
+import os
+import sys
+import tempfile
+import unittest
+from airflow import settings
+from airflow.models import Variable
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, 'scripts'))
+import secrets_to_airflow_variables as sync_script  # noqa
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Variable.__table__.create(engine)
+        self.Session = scoped_session(sessionmaker(bind=engine))
+        patcher = mock.patch.object(settings, 'Session', self.Session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.Session.remove)
+
+    def values(self):
+        session = self.Session()
+        try:
+            return dict((variable.key, variable.val)
+                        for variable in session.query(Variable))
+        finally:
+            session.close()
+
+    def sync(self, secrets):
+        return sync_script.sync(secrets, session=self.Session())
+
+    def test_should_only_write_changed_secrets(self):
+        assert self.sync({'a': '1', 'b': '2'}) == ['a', 'b']
+        assert self.sync({'a': '1', 'b': '2'}) == []
+        assert self.sync({'a': '1', 'b': '3'}) == ['b']
+        values = self.values()
+        assert values['a.secret'] == '1'
+        assert values['b.secret'] == '3'
+
+    def test_should_not_query_without_secrets(self):
+        session = mock.MagicMock(name='session')
+        assert sync_script.sync({}, session=session) == []
+        assert not session.query.called
+
+    def test_should_restore_variables_changed_by_hand(self):
+        self.sync({'a': '1', 'b': '2'})
+        session = self.Session()
+        variables = dict((variable.key, variable)
+                         for variable in session.query(Variable))
+        variables['a.secret'].val = 'edited'
+        session.delete(variables['b.secret'])
+        session.commit()
+
+        # the secrets are unchanged, the variables are not
+        assert self.sync({'a': '1', 'b': '2'}) == ['a', 'b']
+        values = self.values()
+        assert values['a.secret'] == '1'
+        assert values['b.secret'] == '2'
+
+    def test_should_retry_concurrent_first_sync(self):
+        sync = sync_script.sync
+        attempts = []
+
+        def racing_sync(secrets):
+            attempts.append(secrets)
+            if len(attempts) == 1:
+                # what a concurrent first sync inserting the same variable
+                # does to this one's scoped session
+                session = self.Session()
+                session.add(Variable(key='a.secret', val='1'))
+                session.add(Variable(key='a.secret', val='1'))
+                session.flush()
+            return sync(secrets)
+
+        with mock.patch.object(sync_script, 'sync', side_effect=racing_sync):
+            assert sync_script.sync_with_retry({'a': '1'}) == ['a']
+        assert len(attempts) == 2
+        assert self.values() == {'a.secret': '1'}
+
+    def test_should_give_up_after_attempts(self):
+        with mock.patch.object(sync_script, 'sync',
+                               side_effect=IntegrityError('', {}, None)):
+            with self.assertRaises(IntegrityError):
+                sync_script.sync_with_retry({'a': '1'}, attempts=2)
+
+
+class TestDirectoryStamp(unittest.TestCase):
+    def test_should_skip_files_removed_while_stamping(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for key in ['a', 'b']:
+                with open(os.path.join(directory, key), 'w') as f:
+                    f.write(key)
+            stat = os.stat
+
+            def removed_b(path):
+                if path.endswith('b'):
+                    raise FileNotFoundError(path)
+                return stat(path)
+
+            with mock.patch.object(sync_script.os, 'stat',
+                                   side_effect=removed_b):
+                stamp = sync_script.directory_stamp(directory)
+        assert [key for key, _, _, _ in stamp] == ['a']
@@ -0,0 +1,82 @@
+"""
+Measure import cost in a fresh interpreter with ``python -X importtime``
+(python >= 3.7, wall time of the statement on older interpreters)
+
+Budgets are generous, a few times what the modules cost today, so they only
+fail when a module starts importing something heavy. Set
+``IMPORT_TIME_BUDGET_SCALE`` to scale them, more than ``1`` for slow
+machines or less to tighten them.
+"""
+import json
+import os
+import subprocess
+import sys
+
+MARKER = '@@import-time@@'
+HAS_IMPORTTIME = sys.version_info >= (3, 7)
+# budgets are in milliseconds, scale them for slow machines
+BUDGET_SCALE = float(os.environ.get('IMPORT_TIME_BUDGET_SCALE') or '1')
+
+PROBE = '''
+{setup}
+import json as _json, sys as _sys, time as _time
+_before = set(_sys.modules)
+_sys.stderr.write({marker!r} + '\\n')
+_start = _time.perf_counter()
+{statement}
+_elapsed = _time.perf_counter() - _start
+_sys.stderr.write({marker!r} + _json.dumps({{
+    'elapsed': _elapsed, 'modules': sorted(set(_sys.modules) - _before)}}))
+'''
+
+
+def parse_importtime(lines):
+    """
+    Sum of the cumulative microseconds of the top level imports in lines of
+    ``-X importtime`` output
+    """
+    total = 0
+    for line in lines:
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|', 2)
+        # nested imports are indented and already part of a cumulative time
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return total
+
+
+def import_cost(statement, setup='import airflow', env=None):
+    """
+    Run ``setup`` and then ``statement`` in a fresh interpreter
+
+    :return: (microseconds, modules) spent importing and the modules
+        imported by ``statement`` alone
+    """
+    command = [sys.executable]
+    if HAS_IMPORTTIME:
+        command.extend(['-X', 'importtime'])
+    code = PROBE.format(setup=setup, statement=statement, marker=MARKER)
+    process = subprocess.run(command + ['-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True,
+                             env=dict(os.environ, **(env or {})))
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr)
+    _, measured, result = process.stderr.split(MARKER)
+    result = json.loads(result)
+    if HAS_IMPORTTIME:
+        cost = parse_importtime(measured.splitlines())
+    else:
+        cost = int(result['elapsed'] * 1e6)
+    return cost, set(result['modules'])
+
+
+def budget_us(budgets, name):
+    """
+    Scaled budget in microseconds of a module
+
+    :param budgets: milliseconds per module name, ``None`` for the default
+    :type budgets: dict
+    """
+    return budgets.get(name, budgets[None]) * 1000 * BUDGET_SCALE